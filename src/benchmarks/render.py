@@ -0,0 +1,67 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+
+from traffic_scanner.sketch import group_sketches
+from traffic_scanner.storage import RouteTrafficSketches, Route, User, rollup_stats, make_rollup, rollup_keys
+from traffic_scanner.traffic_view import TrafficView, figure_png
+from traffic_scanner.yandex_maps_stub import synthetic_duration
+
+# CPU time and PNG size of every plot, rendered from scratch and with fast_render:
+#   python -m benchmarks.render --days 30 --dpi 100 72
+
+logger = logging.getLogger('benchmarks/render.py')
+
+DAY = 24 * 60 * 60
+
+
+def median_ms(func, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = time.process_time()
+        func()
+        times.append(time.process_time() - t0)
+    return np.median(times) * 1000
+
+
+def run(args):
+    now = int(time.time())
+    timestamps = np.arange(now - args.days * DAY, now, args.period)
+    durations = np.array([synthetic_duration('route', timestamp) for timestamp in timestamps.tolist()])
+    durations += np.random.default_rng(0).integers(-300, 300, len(durations))
+    route = Route(55.7, 37.6, 55.8, 37.5, title='Route', user=User(user_id=1, timezone=3))
+    rollup = make_rollup(route, args.period, rollup_stats(timestamps, durations, args.period))
+    sketches = RouteTrafficSketches(route, args.period,
+                                    group_sketches(rollup_keys(timestamps, args.period), durations))
+    quantiles = sketches.merge_days().quantiles((0.1, 0.5, 0.9))
+
+    for dpi in args.dpi:
+        for fast_render in False, True:
+            view = TrafficView(args.period, fast_render=fast_render, dpi=dpi)
+            plots = {
+                'plot_traffic_minmax': lambda: view.plot_traffic_minmax(timestamps, durations, 3, route.title),
+                'plot_traffic_by_day': lambda: view.plot_traffic_by_day(timestamps, durations, 3, route.title),
+                'plot_rollup_minmax': lambda: view.plot_rollup_minmax(rollup, route.title, quantiles),
+            }
+            print(f'dpi {dpi}, fast_render {fast_render}:')
+            for name, plot in plots.items():
+                png = figure_png(plot(), view.png_colors)
+                t_ms = median_ms(lambda: figure_png(plot(), view.png_colors), args.repeats)
+                print(f'  {name}: {t_ms:.1f} ms, {len(png) / 1024:.1f} KB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rendering time and size of route plots')
+    parser.add_argument('--days', type=int, default=14)
+    parser.add_argument('--period', type=int, default=10 * 60, help='Seconds between samples and rollup bucket')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--dpi', type=float, nargs='+', default=[100, 72])
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    np.seterr(all='ignore')
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import logging
+import tempfile
+import time
+from unittest import mock
+
+import numpy as np
+
+from traffic_scanner.storage import TrafficStorageSQL
+from traffic_scanner.storage_columnar import TrafficStorageColumnar
+from traffic_scanner.storage_memory import TrafficStorageMemory
+from traffic_scanner.traffic_view import TrafficView, figure_png
+from traffic_scanner.yandex_maps_stub import synthetic_duration
+
+# Splits the latency of a route plot into storage and rendering time for every storage backend:
+#   python -m benchmarks.reports --days 30 --period 600
+
+logger = logging.getLogger('benchmarks/reports.py')
+
+DAY = 24 * 60 * 60
+
+
+def make_storage(name, args, data_dir):
+    if name == 'memory':
+        return TrafficStorageMemory(rollup_bucket=args.period)
+    if name == 'columnar':
+        return TrafficStorageColumnar(db_url=args.db_url, data_dir=data_dir, rollup_bucket=args.period)
+    return TrafficStorageSQL(db_url=args.db_url, rollup_bucket=args.period)
+
+
+def fill(storage, days, period):
+    now = int(time.time())
+    with storage.session_scope() as s:
+        route = storage.add_route((55.7, 37.6), (55.8, 37.5), title='Route', user_id=1, s=s)
+        for timestamp in range(now - days * DAY, now, period):
+            with mock.patch('time.time', return_value=timestamp):
+                storage.append_traffic(route, duration_sec=synthetic_duration('route', timestamp), s=s)
+        return route.route_id
+
+
+def median_ms(func, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return np.median(times) * 1000
+
+
+def run(args):
+    view = TrafficView(args.period)
+    for name in args.storage:
+        with tempfile.TemporaryDirectory() as data_dir:
+            storage = make_storage(name, args, data_dir)
+            t0 = time.perf_counter()
+            route_id = fill(storage, args.days, args.period)
+            t_fill = time.perf_counter() - t0
+
+            with storage.session_scope() as s:
+                route = storage.get_route(user_id=1, route_id=route_id, s=s)
+                report = storage.make_report(route, s)
+                rollup = storage.get_rollup(route, s)
+                timings = {
+                    'make_report': median_ms(lambda: storage.make_report(route, s), args.repeats),
+                    'make_report_day': median_ms(lambda: storage.make_report_day(route, s, day_id=0), args.repeats),
+                    'get_rollup': median_ms(lambda: storage.get_rollup(route, s), args.repeats),
+                    'plot_traffic_minmax': median_ms(lambda: figure_png(view.plot_traffic_minmax(
+                        report.timestamps, report.durations, report.timezone, route.title, report.weights)),
+                        args.repeats),
+                    'plot_rollup_minmax': median_ms(lambda: figure_png(view.plot_rollup_minmax(rollup, route.title)),
+                                                    args.repeats),
+                }
+        print(f'{name}: {len(report.timestamps)} samples written in {t_fill:.2f} sec')
+        for operation, t_ms in timings.items():
+            print(f'  {operation}: {t_ms:.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Storage and rendering time of route plots')
+    parser.add_argument('--days', type=int, default=14)
+    parser.add_argument('--period', type=int, default=10 * 60, help='Seconds between samples and rollup bucket')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--storage', nargs='+', choices=('sql', 'columnar', 'memory'),
+                        default=['sql', 'columnar', 'memory'])
+    parser.add_argument('--db-url', default='sqlite://')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    np.seterr(all='ignore')
+    logging.basicConfig(level=logging.WARNING)
+    main()
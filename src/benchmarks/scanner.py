@@ -0,0 +1,99 @@
+import argparse
+import logging
+import random
+import time
+
+import numpy as np
+
+from traffic_scanner.rate_limiter import TokenBucket, AdaptiveTokenBucket
+from traffic_scanner.storage import TrafficStorageSQL
+from traffic_scanner.storage_memory import TrafficStorageMemory
+from traffic_scanner.traffic_scanner import TrafficScanner
+from traffic_scanner.yandex_maps_client import YandexMapsClient
+from traffic_scanner.yandex_maps_stub import YandexMapsStub, ResponseRecorder
+
+# Runs full scan cycles of TrafficScanner against the local yandex maps stub:
+#   python -m benchmarks.scanner --routes 1000 --workers 8 --latency 0.05
+
+logger = logging.getLogger('benchmarks/scanner.py')
+
+
+def timed(func, times):
+    def closure(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            times.append(time.perf_counter() - t0)
+
+    return closure
+
+
+def add_synthetic_routes(storage, num_routes, num_users, seed=0):
+    rng = random.Random(seed)
+    with storage.session_scope() as s:
+        for i in range(num_routes):
+            start = round(55.5 + rng.random(), 6), round(37.3 + rng.random(), 6)
+            end = round(55.5 + rng.random(), 6), round(37.3 + rng.random(), 6)
+            storage.add_route(start, end, title=f'Route {i}', user_id=i % num_users, s=s)
+
+
+def run(args):
+    recording = ResponseRecorder.load(args.recording) if args.recording else None
+    with YandexMapsStub(latency=args.latency, error_rate=args.error_rate, max_rps=args.max_rps,
+                        recording=recording, seed=0) as stub:
+        if args.adaptive:
+            rate_limiter = AdaptiveTokenBucket(min(10.0, args.rps), min_rate=1, max_rate=args.rps)
+        else:
+            rate_limiter = TokenBucket(args.rps)
+        client = YandexMapsClient(rate_limiter=rate_limiter, pool_size=args.workers, endpoint=stub.endpoint)
+        storage = TrafficStorageMemory() if args.storage == 'memory' else TrafficStorageSQL(db_url=args.db_url)
+        scanner = TrafficScanner(period=10 * 60, yandex_maps_client=client, storage=storage, num_workers=args.workers)
+        add_synthetic_routes(storage, args.routes, args.users)
+
+        scan_latencies, write_times = [], []
+        scanner.fetch_duration = timed(scanner.fetch_duration, scan_latencies)
+        storage.append_traffic = timed(storage.append_traffic, write_times)
+
+        for cycle in range(args.cycles):
+            t0 = time.perf_counter()
+            with storage.session_scope() as s:
+                try:
+                    scanner.update_traffic(s)
+                except Exception as e:
+                    logger.warning(f'Cycle {cycle} finished with an error: {e!r}')
+                t_commit = time.perf_counter()
+            write_times.append(time.perf_counter() - t_commit)
+            t_cycle = time.perf_counter() - t0
+            print(f'Cycle {cycle}: {args.routes / t_cycle:.1f} routes/sec, {t_cycle:.2f} sec, '
+                  f'client rate {rate_limiter.rate:.1f} requests/sec')
+
+        latencies_ms = np.array(scan_latencies) * 1000
+        print(f'Scan latency: p50 {np.percentile(latencies_ms, 50):.1f} ms, '
+              f'p99 {np.percentile(latencies_ms, 99):.1f} ms')
+        print(f'DB write time: {sum(write_times):.3f} sec in total')
+        print(f'Stub stats: {stub.stats}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scanner throughput benchmark against a local yandex maps stub')
+    parser.add_argument('--routes', type=int, default=500)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rps', type=float, default=1000, help='Client side requests per second limit')
+    parser.add_argument('--adaptive', action='store_true', help='Adapt the client rate up to --rps')
+    parser.add_argument('--latency', type=float, default=0.02, help='Stub latency per request, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--max-rps', type=float, default=None, help='Stub throttles requests above this rate')
+    parser.add_argument('--recording', default=None, help='Replay responses saved by ResponseRecorder')
+    parser.add_argument('--db-url', default='sqlite://')
+    parser.add_argument('--storage', choices=('sql', 'memory'), default='sql',
+                        help='Run without a database to separate storage from scanning time')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    np.seterr(all='ignore')
+    logging.basicConfig(level=logging.WARNING)
+    main()
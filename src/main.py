@@ -5,11 +5,16 @@ import traceback
 import numpy
 from telegram.ext import Updater
 
-from traffic_scanner.bot_controller import BotController
-from traffic_scanner.storage import TrafficStorageSQL
+from traffic_scanner.bot_controller import BotController, PRERENDER_ROUTES
+from traffic_scanner.plot_cache import PlotCache, PLOT_CACHE_SIZE
+from traffic_scanner.plot_renderer import PlotRenderer, RENDER_PROCESSES
+from traffic_scanner.storage import TrafficStorageSQL, DB_POOL_SIZE
+from traffic_scanner.storage_columnar import TrafficStorageColumnar
 from traffic_scanner.traffic_scanner import TrafficScanner
+from traffic_scanner.rate_limiter import AdaptiveTokenBucket
 from traffic_scanner.traffic_view import TrafficView
-from traffic_scanner.yandex_maps_client import YandexMapsClient
+from traffic_scanner.yandex_maps_client import YandexMapsClient, REQUESTS_PER_SECOND, MIN_REQUESTS_PER_SECOND, \
+    MAX_REQUESTS_PER_SECOND
 
 
 def error_callback(update, context):
@@ -22,14 +27,35 @@ numpy.seterr(all="ignore")
 logging.basicConfig(level=logging.INFO)
 
 period = 10 * 60
-yandex_map_client = YandexMapsClient()
-yandex_map_client.update_session()
+scan_workers = int(os.environ.get('SCAN_WORKERS', 1))
+requests_per_second = float(os.environ.get('REQUESTS_PER_SECOND', REQUESTS_PER_SECOND))
+max_requests_per_second = float(os.environ.get('MAX_REQUESTS_PER_SECOND', MAX_REQUESTS_PER_SECOND))
 
-storage = TrafficStorageSQL(db_url=os.environ.get('DATABASE_URL', 'sqlite:///:memory:'))
-traffic_scanner = TrafficScanner(period=period, yandex_maps_client=yandex_map_client, storage=storage)
-traffic_plotter = TrafficView(period)
+yandex_map_client = YandexMapsClient(rate_limiter=AdaptiveTokenBucket(requests_per_second,
+                                                                      min_rate=MIN_REQUESTS_PER_SECOND,
+                                                                      max_rate=max_requests_per_second),
+                                     pool_size=scan_workers,
+                                     state_path=os.environ.get('YANDEX_STATE_PATH'))
+
+# The default in-memory database is lost on restart and runs the sessions of all threads one at a time
+db_url = os.environ.get('DATABASE_URL', 'sqlite:///:memory:')
+db_pool_size = int(os.environ.get('DB_POOL_SIZE', DB_POOL_SIZE))
+if os.environ.get('TRAFFIC_DATA_DIR'):
+    storage = TrafficStorageColumnar(db_url=db_url, data_dir=os.environ['TRAFFIC_DATA_DIR'], rollup_bucket=period,
+                                     pool_size=db_pool_size)
+else:
+    storage = TrafficStorageSQL(db_url=db_url, rollup_bucket=period, pool_size=db_pool_size)
+traffic_scanner = TrafficScanner(period=period, yandex_maps_client=yandex_map_client, storage=storage,
+                                 num_workers=scan_workers, worker_id=os.environ.get('SCANNER_WORKER_ID'))
+render_dpi = os.environ.get('RENDER_DPI')
+traffic_view = TrafficView(period, fast_render=os.environ.get('FAST_RENDER', '0') == '1',
+                           dpi=float(render_dpi) if render_dpi else None)
+plot_renderer = PlotRenderer(traffic_view,
+                             num_processes=int(os.environ.get('RENDER_PROCESSES', RENDER_PROCESSES)))
 bc = BotController(traffic_scanner=traffic_scanner,
-                   traffic_plotter=traffic_plotter)
+                   plot_renderer=plot_renderer,
+                   plot_cache=PlotCache(int(os.environ.get('PLOT_CACHE_SIZE', PLOT_CACHE_SIZE))),
+                   prerender_routes=int(os.environ.get('PRERENDER_ROUTES', PRERENDER_ROUTES)))
 updater = Updater(token=os.environ['TELEGRAM_BOT_TOKEN'])
 
 dp = updater.dispatcher
@@ -37,6 +63,8 @@ bc.initialize_dispatcher(dp)
 dp.add_error_handler(error_callback)
 
 if __name__ == '__main__':
-    dp.run_async(bc.traffic_scanner.serve_restart)
+    if os.environ.get('RUN_SCANNER', '1') == '1':
+        dp.run_async(bc.traffic_scanner.serve_restart)
     updater.start_polling()
     updater.idle()
+    plot_renderer.shutdown()
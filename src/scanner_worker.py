@@ -0,0 +1,36 @@
+import logging
+import os
+import socket
+
+from traffic_scanner.rate_limiter import AdaptiveTokenBucket
+from traffic_scanner.storage import TrafficStorageSQL
+from traffic_scanner.traffic_scanner import TrafficScanner
+from traffic_scanner.yandex_maps_client import YandexMapsClient, REQUESTS_PER_SECOND, MIN_REQUESTS_PER_SECOND, \
+    MAX_REQUESTS_PER_SECOND
+
+# Standalone scanner process. Any number of them can run against the same database,
+# routes are shared evenly between them through leases, at most LEASE_MAX_ROUTES groups of identical routes each.
+
+logging.basicConfig(level=logging.INFO)
+
+period = 10 * 60
+scan_workers = int(os.environ.get('SCAN_WORKERS', 1))
+requests_per_second = float(os.environ.get('REQUESTS_PER_SECOND', REQUESTS_PER_SECOND))
+max_requests_per_second = float(os.environ.get('MAX_REQUESTS_PER_SECOND', MAX_REQUESTS_PER_SECOND))
+worker_id = os.environ.get('SCANNER_WORKER_ID', f'{socket.gethostname()}-{os.getpid()}')
+lease_max_routes = int(os.environ.get('LEASE_MAX_ROUTES', 1000))
+
+yandex_map_client = YandexMapsClient(rate_limiter=AdaptiveTokenBucket(requests_per_second,
+                                                                      min_rate=MIN_REQUESTS_PER_SECOND,
+                                                                      max_rate=max_requests_per_second),
+                                     pool_size=scan_workers,
+                                     state_path=os.environ.get('YANDEX_STATE_PATH'))
+storage = TrafficStorageSQL(db_url=os.environ['DATABASE_URL'], rollup_bucket=period)
+traffic_scanner = TrafficScanner(period=period, yandex_maps_client=yandex_map_client, storage=storage,
+                                 num_workers=scan_workers, worker_id=worker_id, lease_max_routes=lease_max_routes)
+
+if __name__ == '__main__':
+    try:
+        traffic_scanner.serve_restart()
+    finally:
+        traffic_scanner.release_leases()
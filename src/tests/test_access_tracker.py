@@ -0,0 +1,27 @@
+import unittest
+
+from traffic_scanner.access_tracker import AccessTracker
+
+
+class TestAccessTracker(unittest.TestCase):
+
+    def test_scores_decay(self):
+        tracker = AccessTracker(half_life=100)
+        for _ in range(4):
+            tracker.record('old', now=0)
+        tracker.record('new', now=200)
+        assert abs(tracker.score('old', now=200) - 1) < 1e-9
+        tracker.record('new', now=200)
+        assert tracker.hot(2, now=200) == ['new', 'old']
+
+    def test_keeps_hottest_keys(self):
+        tracker = AccessTracker(max_keys=2)
+        for key in reversed(range(5)):
+            for _ in range(key + 1):
+                tracker.record(key, now=0)
+        assert len(tracker.scores) == 2
+        assert tracker.hot(2, now=0) == [4, 3]
+
+
+if __name__ == '__main__':
+    unittest.main()
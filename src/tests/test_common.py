@@ -1,21 +1,109 @@
+import threading
+import time
 import unittest
+from unittest import mock
 
-from traffic_scanner.storage import User
-from traffic_scanner.storage.storage_sqlalchemy import TrafficStorageSQL
+from traffic_scanner.storage import User, TrafficStorageSQL
 from traffic_scanner.traffic_scanner import TrafficScanner
 from traffic_scanner.yandex_maps_client import YandexMapsClient
+from traffic_scanner.yandex_maps_stub import YandexMapsStub
 
 
 class TestParseCoordinates(unittest.TestCase):
 
     def test_common(self):
         user_id = 1829
-        yandex_map_client = YandexMapsClient()
-        storage = TrafficStorageSQL(db_url='sqlite:///db_test')
-        traffic_scanner = TrafficScanner(period=600, yandex_maps_client=yandex_map_client, storage=storage)
-        yandex_map_client.update_session()
+        with YandexMapsStub() as stub:
+            yandex_map_client = YandexMapsClient(endpoint=stub.endpoint)
+            storage = TrafficStorageSQL(db_url='sqlite://')
+            traffic_scanner = TrafficScanner(period=600, yandex_maps_client=yandex_map_client, storage=storage)
+            yandex_map_client.update_session()
+            with storage.session_scope() as s:
+                traffic_scanner.add_route((37.5229855552, 55.9271870459),
+                                          (37.4460039634, 55.8852399212964),
+                                          title='Долгопрудный -> Москва',
+                                          user_idx=user_id, s=s)
+            with storage.session_scope() as s:
+                route, = storage.get_routes(user_id, s)
+                assert len(storage.make_report(route, s).durations) == 1
+
+            assert stub.stats['sessions'] == 1 and stub.stats['routes'] == 1
+
+    def test_scan_scheduled_in_chunks(self):
+        with YandexMapsStub() as stub:
+            storage = TrafficStorageSQL(db_url='sqlite://')
+            traffic_scanner = TrafficScanner(period=600, yandex_maps_client=YandexMapsClient(endpoint=stub.endpoint),
+                                             storage=storage, commit_chunk_size=2)
+            with storage.session_scope() as s:
+                for i in range(5):
+                    storage.add_route((55.0 + i, 37.0), (55.5, 37.5), title=str(i), user_id=1, s=s)
+
+            scanned = []
+            traffic_scanner.add_scan_listener(scanned.extend)
+            commits = []
+            storage.flush_traffic = lambda s, flush_traffic=storage.flush_traffic: \
+                commits.append(len(storage._traffic_buffer(s))) or flush_traffic(s)
+            with storage.session_scope() as s:
+                traffic_scanner.sync_schedule(s)
+            # New routes are spread over the period, after it they are all due
+            with mock.patch('time.time', return_value=time.time() + 600):
+                traffic_scanner.scan_scheduled()
+            assert [num_samples for num_samples in commits if num_samples > 0] == [2, 2, 1]
+            assert sorted(scanned) == [1, 2, 3, 4, 5]
+
+            # The in-memory database is shared by the threads
+            reports = []
+            thread = threading.Thread(target=lambda: reports.extend(self._report_lengths(storage)))
+            thread.start()
+            thread.join()
+            assert reports == [1] * 5
+
+    def test_leases_are_renewed_during_scan(self):
+        with YandexMapsStub() as stub:
+            storage = TrafficStorageSQL(db_url='sqlite://')
+            traffic_scanner = TrafficScanner(period=600, yandex_maps_client=YandexMapsClient(endpoint=stub.endpoint),
+                                             storage=storage, commit_chunk_size=2, worker_id='worker', lease_ttl=60)
+            with storage.session_scope() as s:
+                for i in range(5):
+                    storage.add_route((55.0 + i, 37.0), (55.5, 37.5), title=str(i), user_id=1, s=s)
+            traffic_scanner.renew_leases()
+            with storage.session_scope() as s:
+                traffic_scanner.sync_schedule(s)
+
+            t_scan = time.time() + 600
+            with mock.patch('time.time', side_effect=lambda: t_scan), \
+                    mock.patch.object(storage, 'claim_routes', wraps=storage.claim_routes) as claim_routes:
+                # Every chunk takes longer than the leases live
+                scan_chunk = traffic_scanner.scan_chunk
+
+                def slow_scan_chunk(*args):
+                    nonlocal t_scan
+                    t_scan += 60
+                    return scan_chunk(*args)
+                traffic_scanner.scan_chunk = slow_scan_chunk
+                traffic_scanner.scan_scheduled()
+            assert claim_routes.call_count == 3
+
+    def test_workers_share_groups_of_routes(self):
+        storage = TrafficStorageSQL(db_url='sqlite://')
+        with storage.session_scope() as s:
+            for i in range(4):
+                for user_id in 1, 2:
+                    # The same route of two users is one group
+                    storage.add_route((55.0 + i, 37.0), (55.5, 37.5), title=str(i), user_id=user_id, s=s)
+        scanners = [TrafficScanner(period=600, yandex_maps_client=mock.Mock(), storage=storage, worker_id=worker_id)
+                    for worker_id in ('first', 'second')]
+        for _ in range(2):
+            for traffic_scanner in scanners:
+                traffic_scanner.t_leases_renewed = -1
+                traffic_scanner.renew_leases()
+        with storage.session_scope() as s:
+            groups = [traffic_scanner.sync_schedule(s) for traffic_scanner in scanners]
+        assert len(groups[0]) == len(groups[1]) == 2
+        assert set(groups[0]).isdisjoint(groups[1])
+        assert all(len(routes) == 2 for worker_groups in groups for routes in worker_groups.values())
+
+    @staticmethod
+    def _report_lengths(storage):
         with storage.session_scope() as s:
-            traffic_scanner.add_route((37.5229855552, 55.9271870459),
-                                      (37.4460039634, 55.8852399212964),
-                                      title='Долгопрудный -> Москва',
-                                      user_idx=user_id, s=s)
+            return [len(storage.make_report(route, s).durations) for route in storage.get_routes(None, s)]
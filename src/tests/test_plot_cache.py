@@ -0,0 +1,131 @@
+import unittest
+from unittest import mock
+
+from telegram import Message
+
+from tests.test_storage import add_routes
+from traffic_scanner.bot_controller import BotController
+from traffic_scanner.plot_cache import PlotCache
+from traffic_scanner.plot_renderer import PlotRenderer
+from traffic_scanner.storage import TrafficStorageSQL
+from traffic_scanner.storage_memory import TrafficStorageMemory
+from traffic_scanner.traffic_view import TrafficView
+
+
+class TestPlotCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = PlotCache(max_size=2)
+        cache.put('a', b'a')
+        cache.put('b', b'b')
+        assert cache.get('a').png == b'a'
+        cache.put('c', b'c')
+        assert cache.get('b') is None
+        assert cache.get('a') is not None and cache.get('c') is not None
+        assert len(cache) == 2
+
+    def test_file_id(self):
+        cache = PlotCache()
+        cache.put('a', b'a')
+        cache.set_file_id('a', 'file')
+        cache.set_file_id('missing', 'file')
+        assert cache.get('a').file_id == 'file'
+        assert cache.get('missing') is None
+
+    def test_plot_is_rendered_again_after_scan(self):
+        storage = TrafficStorageMemory()
+        add_routes(storage, 1)
+        traffic_scanner = mock.Mock(storage=storage)
+        traffic_plotter = TrafficView(10 * 60)
+        controller = BotController(traffic_scanner, PlotRenderer(traffic_plotter, num_processes=0))
+        update = mock.Mock()
+        update.effective_user.id = 1
+        update.effective_message.photo = [mock.Mock()]
+        update.callback_query.edit_message_media.return_value = mock.Mock(
+            spec=Message, photo=[mock.Mock(file_id='file')])
+
+        with mock.patch.object(traffic_plotter, 'plot_rollup_minmax', wraps=traffic_plotter.plot_rollup_minmax) \
+                as plot_rollup_minmax:
+            controller._send_route_plot(update, 1)
+            controller._send_route_plot(update, 1)
+            assert plot_rollup_minmax.call_count == 1
+            media = update.callback_query.edit_message_media.call_args[0][0]
+            assert media.media == 'file'
+
+            with storage.session_scope() as s:
+                storage.append_traffic(storage.get_route(user_id=1, route_id=1, s=s), duration_sec=600, s=s)
+            controller._send_route_plot(update, 1)
+            assert plot_rollup_minmax.call_count == 2
+
+            with storage.session_scope() as s:
+                storage.rebuild_rollups(s)
+            controller._send_route_plot(update, 1)
+            assert plot_rollup_minmax.call_count == 3
+
+    def test_plots_are_rendered_outside_sessions(self):
+        storage = TrafficStorageSQL(db_url='sqlite://')
+        add_routes(storage, 1)
+        controller = BotController(mock.Mock(storage=storage), PlotRenderer(TrafficView(10 * 60), num_processes=0))
+        update = mock.Mock()
+        update.effective_user.id = 1
+        update.effective_message.photo = [mock.Mock()]
+        update.callback_query.data = BotController.CALLBACK_SELECT_DAY + '1__0'
+        sessions_during_render = []
+        render_rollup_minmax = controller.plot_renderer.render_rollup_minmax
+
+        def render(*args):
+            sessions_during_render.append(storage.Session.registry.has())
+            return render_rollup_minmax(*args)
+        with mock.patch.object(controller.plot_renderer, 'render_rollup_minmax', side_effect=render):
+            controller._send_route_plot(update, '1')
+            controller.select_day(update, None)
+            controller._prerender([(1, 1)])
+        # Today may be the day rendered before
+        assert len(sessions_during_render) >= 2 and not any(sessions_during_render)
+
+    def test_prerender_hot_routes(self):
+        storage = TrafficStorageMemory()
+        add_routes(storage, 2)
+        traffic_scanner = mock.Mock(storage=storage)
+        controller = BotController(traffic_scanner, PlotRenderer(TrafficView(10 * 60), num_processes=0))
+        traffic_scanner.add_scan_listener.assert_called_once_with(controller.prerender_hot_routes)
+        update = mock.Mock()
+        update.effective_user.id = 1
+        update.effective_message.photo = [mock.Mock()]
+        controller._send_route_plot(update, '1')
+        assert len(controller.plot_cache) == 1
+
+        with storage.session_scope() as s:
+            for route in storage.get_routes(user_id=None, s=s):
+                storage.append_traffic(route, duration_sec=600, s=s)
+        controller.prerender_hot_routes([1, 2])
+        controller.prerender_executor.shutdown()
+        # The week and today of the viewed route
+        assert len(controller.plot_cache) == 3
+        with mock.patch.object(controller.plot_renderer, 'render_rollup_minmax') as render_rollup_minmax:
+            controller._send_route_plot(update, '1')
+            render_rollup_minmax.assert_not_called()
+
+    def test_compare_road_back(self):
+        storage = TrafficStorageMemory()
+        with storage.session_scope() as s:
+            storage.add_route((55.7, 37.6), (55.8, 37.5), title='There', user_id=1, s=s)
+            storage.add_route((55.1, 37.1), (55.2, 37.2), title='Elsewhere', user_id=1, s=s)
+            storage.add_route((55.8000001, 37.5), (55.7, 37.6), title='Back', user_id=1, s=s)
+        controller = BotController(mock.Mock(storage=storage), PlotRenderer(TrafficView(10 * 60), num_processes=0))
+        update = mock.Mock()
+        update.effective_user.id = 1
+        with mock.patch.object(storage, 'get_rollups', wraps=storage.get_rollups) as get_rollups:
+            update.callback_query.data = BotController.CALLBACK_COMPARE_ROAD_BACK + '1'
+            controller.choose_compare_road_back(update, None)
+            assert [route.title for route in get_rollups.call_args[0][0]] == ['There', 'Back']
+            update.effective_message.reply_photo.assert_called_once()
+
+            update.callback_query.data = BotController.CALLBACK_COMPARE_ROAD_BACK + '2'
+            controller.choose_compare_road_back(update, None)
+            update.effective_message.reply_text.assert_called_once_with(BotController.RESPONSE_NO_ROAD_BACK)
+            assert get_rollups.call_count == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
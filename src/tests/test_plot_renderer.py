@@ -0,0 +1,58 @@
+import os
+import signal
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from tests.test_storage import add_routes
+from traffic_scanner.plot_renderer import PlotRenderer
+from traffic_scanner.storage_memory import TrafficStorageMemory
+from traffic_scanner.traffic_view import TrafficView, DAY
+
+
+class TestPlotRenderer(unittest.TestCase):
+
+    def test_parallel_renders_match_inline(self):
+        storage = TrafficStorageMemory()
+        add_routes(storage, 1)
+        with storage.session_scope() as s:
+            route, = storage.get_routes(user_id=None, s=s)
+        rng = np.random.default_rng(0)
+        timestamps = np.arange(0, 7 * DAY, 600) + 1614556800
+        durations = rng.integers(600, 3600, len(timestamps))
+        view = TrafficView(600)
+        renderer = PlotRenderer(view, num_processes=2)
+        try:
+            names = [f'Route {i}' for i in range(8)]
+            with ThreadPoolExecutor(4) as threads:
+                pngs = list(threads.map(
+                    lambda name: renderer.render('plot_traffic_minmax', timestamps, durations, 3, name), names))
+            inline = PlotRenderer(view, num_processes=0)
+            for name, png in zip(names, pngs):
+                assert png.startswith(b'\x89PNG')
+                assert png == inline.render('plot_traffic_minmax', timestamps, durations, 3, name)
+
+            rollup = storage.get_rollup(route, None)
+            assert renderer.render_rollup_minmax(rollup, 'Route') == inline.render_rollup_minmax(rollup, 'Route')
+        finally:
+            renderer.shutdown()
+
+    def test_dead_render_process(self):
+        view = TrafficView(600)
+        renderer = PlotRenderer(view, num_processes=1)
+        timestamps = np.arange(0, DAY, 600) + 1614556800
+        durations = np.full(len(timestamps), 600)
+        try:
+            broken_executor = renderer.executor
+            for process in broken_executor._processes.values():
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+            for _ in range(2):
+                assert renderer.render('plot_traffic_minmax', timestamps, durations, 3, 'Route').startswith(b'\x89PNG')
+            assert renderer.executor is not broken_executor
+        finally:
+            renderer.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import threading
+import time
+import unittest
+
+from traffic_scanner.rate_limiter import TokenBucket, AdaptiveTokenBucket
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_rate_is_shared_between_threads(self):
+        rate = 50
+        bucket = TokenBucket(rate)
+        num_threads, calls_per_thread = 4, 10
+
+        def worker():
+            for _ in range(calls_per_thread):
+                bucket.acquire()
+
+        threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+        t0 = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - t0
+
+        # The first token is available immediately, the rest are refilled with `rate` per second
+        assert elapsed >= (num_threads * calls_per_thread - 1) / rate * 0.9
+
+
+class TestAdaptiveTokenBucket(unittest.TestCase):
+
+    def test_additive_increase_multiplicative_decrease(self):
+        bucket = AdaptiveTokenBucket(10, min_rate=1, max_rate=12, increase=1, cooldown=60)
+        for _ in range(100):
+            bucket.on_success()
+        assert bucket.rate == 12
+
+        bucket.on_throttled()
+        assert bucket.rate == 6
+        # Requests that were in flight fail too, they do not slow us down again
+        bucket.on_throttled()
+        bucket.on_error()
+        assert bucket.rate == 6
@@ -0,0 +1,44 @@
+import unittest
+
+from traffic_scanner.scheduler import RouteScheduler, MIN_RETRY_DELAY, RETRY_JITTER
+
+
+class TestRouteScheduler(unittest.TestCase):
+
+    def test_new_routes_are_spread_across_period(self):
+        scheduler = RouteScheduler(period=600)
+        scheduler.sync({1: None, 2: None, 3: 900}, last_scans={}, now=0)
+
+        assert [entry.key for entry in scheduler.pop_due(now=0)] == [1]
+        assert scheduler.time_until_next(now=0) == 200
+        assert [entry.key for entry in scheduler.pop_due(now=250)] == [2]
+        assert [entry.key for entry in scheduler.pop_due(now=600)] == [3]
+
+    def test_overdue_routes_are_caught_up_first(self):
+        scheduler = RouteScheduler(period=600)
+        scheduler.sync({1: None, 2: None, 3: None}, last_scans={1: 900, 2: 100, 3: 300}, now=1000)
+
+        due = scheduler.pop_due(now=1000)
+        assert [entry.key for entry in due] == [2, 3]
+        assert scheduler.time_until_next(now=1000) == 500
+
+    def test_reschedule_keeps_phase(self):
+        scheduler = RouteScheduler(period=600)
+        scheduler.sync({1: None}, last_scans={1: 0}, now=0)
+
+        entry, = scheduler.pop_due(now=2000)
+        scheduler.reschedule(entry, now=2000)
+        assert scheduler.time_until_next(now=2000) == 400
+
+    def test_retry_and_removal(self):
+        scheduler = RouteScheduler(period=600)
+        scheduler.sync({1: None, 2: None}, last_scans={1: 0, 2: 0}, now=600)
+
+        first, second = scheduler.pop_due(now=600)
+        scheduler.retry(first, now=600)
+        scheduler.reschedule(second, now=600)
+        assert MIN_RETRY_DELAY <= scheduler.time_until_next(now=600) <= MIN_RETRY_DELAY * (1 + RETRY_JITTER)
+
+        scheduler.sync({2: None}, last_scans={}, now=600)
+        assert scheduler.pop_due(now=600 + MIN_RETRY_DELAY * (1 + RETRY_JITTER)) == []
+        assert len(scheduler) == 1
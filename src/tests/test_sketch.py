@@ -0,0 +1,43 @@
+import unittest
+
+import numpy as np
+
+from traffic_scanner.sketch import QuantileSketch, group_sketches, SKETCH_ACCURACY
+
+
+class TestQuantileSketch(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.durations = np.round(rng.lognormal(np.log(1800), 0.4, 20000)).astype(np.int64)
+
+    def test_quantiles_are_within_accuracy(self):
+        sketch = QuantileSketch.from_durations(self.durations)
+        qs = np.array([0, 0.1, 0.5, 0.9, 0.99, 1])
+        exact = np.sort(self.durations)[(qs * (len(self.durations) - 1)).astype(int)]
+        assert np.all(np.abs(sketch.quantiles(qs) - exact) <= SKETCH_ACCURACY * exact)
+        assert len(sketch) == len(self.durations) and len(sketch.bins) < 300
+
+    def test_merge(self):
+        first, second = self.durations[:5000], self.durations[5000:]
+        merged = QuantileSketch.from_durations(first).merge(QuantileSketch.from_durations(second))
+        assert merged == QuantileSketch.from_durations(self.durations)
+        assert QuantileSketch().merge(merged) == merged
+
+    def test_bytes(self):
+        sketch = QuantileSketch.from_durations(self.durations)
+        assert QuantileSketch.from_bytes(sketch.to_bytes()) == sketch
+        assert len(QuantileSketch.from_bytes(QuantileSketch().to_bytes())) == 0
+        assert np.isnan(QuantileSketch().quantiles([0.5])).all()
+
+    def test_group_sketches(self):
+        keys = np.arange(len(self.durations)) % 7 * 100
+        sketches = group_sketches(keys, self.durations)
+        assert sorted(sketches) == [key * 100 for key in range(7)]
+        for key, sketch in sketches.items():
+            assert sketch == QuantileSketch.from_durations(self.durations[keys == key])
+        assert group_sketches([], []) == {}
+
+
+if __name__ == '__main__':
+    unittest.main()
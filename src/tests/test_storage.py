@@ -0,0 +1,390 @@
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from sqlalchemy import event
+
+from traffic_scanner.sketch import QuantileSketch
+from traffic_scanner.storage import TrafficStorageSQL, traffic_table, traffic_rollup_table, traffic_hourly_table, \
+    traffic_sketch_table, local_weekday, DAY, HOUR
+from traffic_scanner.storage_columnar import TrafficStorageColumnar
+from traffic_scanner.storage_memory import TrafficStorageMemory
+
+
+def add_routes(storage, num_routes, user_id=1):
+    with storage.session_scope() as s:
+        for i in range(num_routes):
+            storage.add_route((55.0 + i, 37.0), (55.5, 37.5), title=str(i), user_id=user_id, s=s)
+
+
+def add_traffic(storage, route_id, timestamps, duration_sec=600):
+    with storage.session_scope() as s:
+        s.execute(traffic_table.insert(), [{'route_id': route_id, 'timestamp': timestamp, 'duration_sec': duration_sec}
+                                           for timestamp in timestamps])
+
+
+class TestRetention(unittest.TestCase):
+
+    def test_delete_old_traffic_entries(self):
+        storage = TrafficStorageSQL(db_url='sqlite://')
+        add_routes(storage, 2)
+        now = int(time.time())
+        for route_id in 1, 2:
+            add_traffic(storage, route_id, [now - days * DAY - 60 for days in range(10)])
+
+        report = storage.delete_old_traffic_entries(keep_days=3, chunk_size=3, vacuum=True)
+        assert report.rows_deleted == 2 * 7
+        with storage.session_scope() as s:
+            for route in storage.get_routes(user_id=None, s=s):
+                assert len(storage.make_report(route, s).timestamps) == 3
+
+
+class TestTimeBounds(unittest.TestCase):
+
+    def test_make_report_time_bounds(self):
+        now = int(time.time())
+        with tempfile.TemporaryDirectory() as data_dir:
+            for storage in TrafficStorageSQL(db_url='sqlite://'), TrafficStorageMemory(), \
+                    TrafficStorageColumnar(db_url='sqlite://', data_dir=data_dir):
+                add_routes(storage, 1)
+                with storage.session_scope() as s:
+                    route, = storage.get_routes(user_id=None, s=s)
+                    for timestamp in range(now - 10 * DAY, now, HOUR):
+                        with mock.patch('time.time', return_value=timestamp):
+                            storage.append_traffic(route, duration_sec=600, s=s)
+
+                with storage.session_scope() as s:
+                    route, = storage.get_routes(user_id=None, s=s)
+                    report = storage.make_report(route, s, t_from=now - 2 * DAY, t_to=now - DAY)
+                    assert report.timestamps.dtype == np.int64 and report.durations.dtype == np.int32
+                    assert len(report.timestamps) == 24
+                    assert report.timestamps.min() >= now - 2 * DAY and report.timestamps.max() < now - DAY
+                    day = storage.make_report_day(route, s, day_id=0, t_from=now - 7 * DAY)
+                    assert abs(len(day.timestamps) - 24) <= 1
+
+
+class TestCompaction(unittest.TestCase):
+
+    def test_compact_traffic(self):
+        storage = TrafficStorageSQL(db_url='sqlite://')
+        add_routes(storage, 1)
+        now = int(time.time())
+        timestamps = range(now - 60 * DAY, now, 10 * 60)
+        with storage.session_scope() as s:
+            s.execute(traffic_table.insert(), [{'route_id': 1, 'timestamp': timestamp, 'duration_sec': 600 + i % 7}
+                                               for i, timestamp in enumerate(timestamps)])
+            route, = storage.get_routes(user_id=None, s=s)
+            day_before = storage.make_report_day(route, s, day_id=4)
+
+        report = storage.compact_traffic(keep_days=7, keep_hourly_days=30)
+        assert report.raw_rows_folded > 0 and report.hourly_rows_folded > 0
+        with storage.session_scope() as s:
+            assert s.query(traffic_table).count() < 8 * DAY // (10 * 60)
+            route, = storage.get_routes(user_id=None, s=s)
+            compacted = storage.make_report(route, s)
+            assert compacted.weights.sum() == len(timestamps)
+            assert min(compacted.durations) == 600 and max(compacted.durations) == 606
+            # Means of the folded traffic are rounded to seconds
+            mean = sum(600 + i % 7 for i in range(len(timestamps))) / len(timestamps)
+            assert abs(sum(compacted.durations * compacted.weights) / len(timestamps) - mean) < 0.5
+
+            day = storage.make_report_day(route, s, day_id=4)
+            assert day.weights.sum() == len(day_before.timestamps)
+
+        # Nothing is left to fold
+        assert storage.compact_traffic(keep_days=7, keep_hourly_days=30).raw_rows_folded == 0
+
+    def test_compact_traffic_into_folded_hours(self):
+        storage = TrafficStorageSQL(db_url='sqlite://')
+        add_routes(storage, 1)
+        hour = int(time.time()) // HOUR * HOUR - 30 * DAY
+        add_traffic(storage, 1, [hour, hour + 60], duration_sec=600)
+        storage.compact_traffic(keep_days=7)
+        # Written late into the folded hour
+        add_traffic(storage, 1, [hour + 120], duration_sec=900)
+        assert storage.compact_traffic(keep_days=7).raw_rows_folded == 1
+        with storage.session_scope() as s:
+            row, = s.query(traffic_hourly_table).all()
+        assert tuple(row) == (1, hour, 3, 2100, 600, 900)
+
+
+class TestReports(unittest.TestCase):
+
+    def test_make_report_day(self):
+        storage = TrafficStorageSQL(db_url='sqlite://')
+        add_routes(storage, 1)
+        # Every 6 hours during two weeks from Monday 00:00 UTC
+        monday = int(datetime(2021, 3, 1, tzinfo=timezone.utc).timestamp())
+        add_traffic(storage, 1, range(monday, monday + 14 * DAY, 6 * HOUR))
+
+        with storage.session_scope() as s:
+            route, = storage.get_routes(user_id=None, s=s)
+            route.user.timezone = 3
+            report = storage.make_report_day(route, s, day_id=1)
+            local_dates = [datetime.utcfromtimestamp(timestamp) + timedelta(hours=3) for timestamp in report.timestamps]
+            assert len(local_dates) == 8
+            assert all(date.weekday() == 1 for date in local_dates)
+
+    def test_make_report_day_reads_day_ranges(self):
+        storage = TrafficStorageSQL(db_url='sqlite://')
+        add_routes(storage, 2)
+        monday = int(datetime(2021, 3, 1, tzinfo=timezone.utc).timestamp())
+        timestamps = np.arange(monday + 5 * HOUR, monday + 30 * DAY, 5 * HOUR + 7 * 60)
+        add_traffic(storage, 1, timestamps.tolist())
+
+        with storage.session_scope() as s:
+            route, empty_route = storage.get_routes(user_id=None, s=s)
+            for tz in -11, 0, 3:
+                route.user.timezone = tz
+                s.flush()
+                statements = count_queries(storage)
+                for day_id in range(7):
+                    report = storage.make_report_day(route, s, day_id=day_id, t_from=monday + 2 * DAY)
+                    expected = timestamps[(local_weekday(timestamps, tz) == day_id) & (timestamps >= monday + 2 * DAY)]
+                    assert report.timestamps.tolist() == expected.tolist()
+                # Days are selected by the index, not by the weekday of every row
+                assert not any('%' in statement for statement in statements)
+            assert len(storage.make_report_day(empty_route, s, day_id=0).timestamps) == 0
+
+
+class TestRollups(unittest.TestCase):
+
+    def test_rollup_matches_raw_traffic(self):
+        storage = TrafficStorageSQL(db_url='sqlite://', buffer_size=7)
+        add_routes(storage, 2)
+        monday = int(datetime(2021, 3, 1, tzinfo=timezone.utc).timestamp())
+        with storage.session_scope() as s:
+            routes = storage.get_routes(user_id=None, s=s)
+            for i, timestamp in enumerate(range(monday, monday + 21 * DAY, 5 * HOUR + 7 * 60)):
+                with mock.patch('time.time', return_value=timestamp):
+                    storage.append_traffic(routes[i % 2], duration_sec=600 + i % 13 * 60, s=s)
+
+        with storage.session_scope() as s:
+            route = storage.get_routes(user_id=None, s=s)[0]
+            route.user.timezone = 3
+            rollup = storage.get_rollup(route, s)
+            storage.rebuild_rollups(s)
+            rebuilt = storage.get_rollup(route, s)
+            for incremental_stat, rebuilt_stat in zip(rollup._stats(), rebuilt._stats()):
+                assert (incremental_stat == rebuilt_stat).all()
+
+            report = storage.make_report_day(route, s, day_id=2)
+            day = rollup.day(2)
+            assert day.num_samples.sum() == len(report.durations)
+            assert day.sum_duration.sum() == sum(report.durations)
+            assert day.merge_days().max_duration.max() == max(report.durations)
+
+    def test_merge_stats(self):
+        storage = TrafficStorageSQL(db_url='sqlite://')
+        add_routes(storage, 1)
+        with storage.session_scope() as s:
+            storage._merge_stats(traffic_rollup_table, [(1, 0, 0, 1, 600, 600 ** 2, 600, 600)], s)
+        with storage.session_scope() as s:
+            # The existing row is merged by the database, without being read first
+            storage._merge_stats(traffic_rollup_table, [(1, 0, 0, 2, 1300, 500 ** 2 + 800 ** 2, 500, 800),
+                                                        (1, 0, 1, 1, 700, 700 ** 2, 700, 700)], s)
+            rows = s.query(traffic_rollup_table).order_by(traffic_rollup_table.c.bucket).all()
+        assert [tuple(row) for row in rows] == [(1, 0, 0, 3, 1900, 600 ** 2 + 500 ** 2 + 800 ** 2, 500, 800),
+                                                (1, 0, 1, 1, 700, 700 ** 2, 700, 700)]
+
+
+class TestSketches(unittest.TestCase):
+
+    def test_sketches_match_raw_traffic(self):
+        monday = int(datetime(2021, 3, 1, tzinfo=timezone.utc).timestamp())
+        timestamps = range(monday, monday + 21 * DAY, 3 * HOUR + 7 * 60)
+        with tempfile.TemporaryDirectory() as data_dir:
+            storages = TrafficStorageSQL(db_url='sqlite://', buffer_size=7), TrafficStorageMemory(), \
+                TrafficStorageColumnar(db_url='sqlite://', data_dir=data_dir, buffer_size=7)
+            all_sketches = []
+            for storage in storages:
+                add_routes(storage, 2)
+                with storage.session_scope() as s:
+                    routes = storage.get_routes(user_id=None, s=s)
+                    for i, timestamp in enumerate(timestamps):
+                        with mock.patch('time.time', return_value=timestamp):
+                            storage.append_traffic(routes[i % 2], duration_sec=600 + i % 13 * 60, s=s)
+
+                with storage.session_scope() as s:
+                    route = storage.get_routes(user_id=None, s=s)[0]
+                    route.user.timezone = 3
+                    sketches = storage.get_sketches(route, s)
+                    storage.rebuild_rollups(s)
+                    assert storage.get_sketches(route, s).sketches == sketches.sketches
+                    all_sketches.append(sketches.sketches)
+
+                    report = storage.make_report_day(route, s, day_id=2)
+                    day = sketches.day(2)
+                    assert sum(map(len, day.sketches.values())) == len(report.durations)
+                    buckets, values = day.merge_days().quantiles([0, 1])
+                    assert values.shape == (2, len(day.sketches))
+                    assert abs(values[1].max() - max(report.durations)) <= 0.02 * max(report.durations)
+            assert all_sketches[0] == all_sketches[1] == all_sketches[2]
+
+    def test_merge_sketches(self):
+        storage = TrafficStorageSQL(db_url='sqlite://')
+        add_routes(storage, 1)
+        sketch = QuantileSketch.from_durations([600, 700, 700])
+        for _ in range(2):
+            with storage.session_scope() as s:
+                storage._merge_sketches({7 * (DAY // storage.rollup_bucket) + 5: sketch}, s)
+        with storage.session_scope() as s:
+            route, = storage.get_routes(user_id=None, s=s)
+            assert storage.get_sketches(route, s).sketches == {5: sketch.merge(sketch)}
+
+    def test_new_sketch_table_keeps_rollup(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            db_url = f'sqlite:///{data_dir}/traffic.db'
+            storage = TrafficStorageSQL(db_url=db_url)
+            add_routes(storage, 1)
+            now = int(time.time())
+            add_traffic(storage, 1, [now - 30 * DAY, now - 60])
+            with storage.session_scope() as s:
+                storage.rebuild_rollups(s)
+            storage.compact_traffic(keep_days=7)
+            # A database from before the sketches
+            traffic_sketch_table.drop(storage.engine)
+            storage.engine.dispose()
+
+            storage = TrafficStorageSQL(db_url=db_url)
+            with storage.session_scope() as s:
+                route, = storage.get_routes(user_id=None, s=s)
+                assert storage.get_rollup(route, s).num_samples.sum() == 2
+                assert sum(map(len, storage.get_sketches(route, s).sketches.values())) == 1
+            storage.engine.dispose()
+
+
+def count_queries(storage):
+    statements = []
+    event.listen(storage.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    return statements
+
+
+class TestScanTargets(unittest.TestCase):
+
+    def test_scan_targets_are_cached(self):
+        storage = TrafficStorageSQL(db_url='sqlite://')
+        add_routes(storage, 3)
+        statements = count_queries(storage)
+        for _ in range(2):
+            with storage.session_scope() as s:
+                assert [target.route_id for target in storage.get_scan_targets(s)] == [1, 2, 3]
+        assert len(statements) == 1
+
+        add_routes(storage, 1, user_id=2)
+        with storage.session_scope() as s:
+            storage.rename_route(user_id=1, route_id=1, new_name='renamed', s=s)
+            # Not committed yet
+            assert len(storage.get_scan_targets(s)) == 4
+        with storage.session_scope() as s:
+            storage.remove_route(user_id=1, route_id=2, s=s)
+        with storage.session_scope() as s:
+            assert [target.route_id for target in storage.get_scan_targets(s)] == [1, 3, 4]
+
+    def test_reports_do_not_load_users_one_by_one(self):
+        storage = TrafficStorageSQL(db_url='sqlite://')
+        for user_id in range(5):
+            add_routes(storage, 1, user_id=user_id)
+        statements = count_queries(storage)
+        with storage.session_scope() as s:
+            for route in storage.get_routes(user_id=None, s=s):
+                storage.make_report_day(route, s, day_id=0)
+        assert sum('users' in statement for statement in statements) == 1
+
+
+class TestBatchedRollups(unittest.TestCase):
+
+    def test_get_rollups(self):
+        storage = TrafficStorageSQL(db_url='sqlite://', buffer_size=5)
+        add_routes(storage, 3)
+        monday = int(datetime(2021, 3, 1, tzinfo=timezone.utc).timestamp())
+        with storage.session_scope() as s:
+            routes = storage.get_routes(user_id=None, s=s)
+            for i, timestamp in enumerate(range(monday, monday + 7 * DAY, 2 * HOUR + 11 * 60)):
+                with mock.patch('time.time', return_value=timestamp):
+                    # The third route has no traffic
+                    storage.append_traffic(routes[i % 2], duration_sec=600 + i % 7 * 60, s=s)
+
+        with storage.session_scope() as s:
+            routes = storage.get_routes(user_id=None, s=s)[::-1]
+            routes[0].user.timezone = 3
+            s.flush()
+            storage.flush_traffic(s)
+            statements = count_queries(storage)
+            rollups = storage.get_rollups(routes, s)
+            assert len(statements) == 1
+            assert [rollup.route for rollup in rollups] == routes
+            assert rollups[0].num_samples.sum() == 0 and rollups[1].num_samples.sum() > 0
+            for route, rollup in zip(routes, rollups):
+                for batched_stat, stat in zip(rollup._stats(), storage.get_rollup(route, s)._stats()):
+                    assert (batched_stat == stat).all()
+
+
+class TestSessions(unittest.TestCase):
+
+    def test_in_memory_sessions_do_not_interleave(self):
+        storage = TrafficStorageSQL(db_url='sqlite://')
+        entered = threading.Event()
+
+        def failing_session():
+            entered.wait()
+            try:
+                with storage.session_scope():
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        thread = threading.Thread(target=failing_session)
+        thread.start()
+        with storage.session_scope() as s:
+            storage.add_route((55.0, 37.0), (55.5, 37.5), title='route', user_id=1, s=s)
+            s.flush()
+            entered.set()
+            # The rollback of the other thread waits for this transaction
+            thread.join(0.2)
+            assert thread.is_alive()
+        thread.join()
+        with storage.session_scope() as s:
+            assert len(storage.get_routes(user_id=None, s=s)) == 1
+
+
+class TestRouteLeases(unittest.TestCase):
+
+    def test_claim_routes(self):
+        storage = TrafficStorageSQL(db_url='sqlite://')
+        add_routes(storage, 5)
+        with storage.session_scope() as s:
+            storage.sync_leases([1, 2, 3, 4, 5], s)
+
+        with storage.session_scope() as s:
+            first = storage.claim_routes('first', max_routes=3, lease_ttl=60, s=s)
+        with storage.session_scope() as s:
+            second = storage.claim_routes('second', max_routes=3, lease_ttl=60, s=s)
+        assert len(first) == 3 and len(second) == 2
+        assert set(first).isdisjoint(second)
+
+        with storage.session_scope() as s:
+            assert storage.claim_routes('first', max_routes=3, lease_ttl=60, s=s) == first
+            storage.release_routes('first', s)
+        with storage.session_scope() as s:
+            assert len(storage.claim_routes('second', max_routes=5, lease_ttl=60, s=s)) == 5
+
+    def test_leases_are_shared_evenly(self):
+        for storage in TrafficStorageSQL(db_url='sqlite://'), TrafficStorageMemory():
+            add_routes(storage, 7)
+            with storage.session_scope() as s:
+                storage.sync_leases([1, 2, 3, 4, 5, 6], s)
+                assert len(storage.claim_routes('first', max_routes=1000, lease_ttl=60, s=s)) == 6
+                # Every lease is held, the new worker gets its share after the first one renews
+                assert storage.claim_routes('second', max_routes=1000, lease_ttl=60, s=s) == []
+                first = storage.claim_routes('first', max_routes=1000, lease_ttl=60, s=s)
+                second = storage.claim_routes('second', max_routes=1000, lease_ttl=60, s=s)
+                assert len(first) == len(second) == 3 and set(first).isdisjoint(second)
+
+                storage.sync_leases([1, 2, 3, 4, 5, 7], s)
+                assert sorted(storage.claim_routes('second', max_routes=1000, lease_ttl=60, s=s)
+                              + storage.claim_routes('first', max_routes=1000, lease_ttl=60, s=s)) == [1, 2, 3, 4, 5, 7]
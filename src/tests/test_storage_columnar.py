@@ -0,0 +1,101 @@
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from datetime import datetime, timezone
+
+import numpy as np
+
+from tests.test_storage import add_routes
+from traffic_scanner.storage import DAY, HOUR
+from traffic_scanner.storage_columnar import TrafficStorageColumnar, TIMESTAMP_DTYPE
+
+
+def append_traffic(storage, route_id, timestamps, duration_sec=600):
+    with storage.session_scope() as s:
+        route = storage.get_route(user_id=1, route_id=route_id, s=s)
+        for timestamp in timestamps:
+            with mock.patch('time.time', return_value=timestamp):
+                storage.append_traffic(route, duration_sec=duration_sec, s=s)
+
+
+class TestTrafficStorageColumnar(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.storage = TrafficStorageColumnar(db_url='sqlite://', data_dir=self.data_dir.name, buffer_size=5)
+        add_routes(self.storage, 2)
+        with self.storage.session_scope() as s:
+            self.route_ids = [route.route_id for route in self.storage.get_routes(user_id=None, s=s)]
+
+    def tearDown(self):
+        self.data_dir.cleanup()
+
+    def test_reports(self):
+        monday = int(datetime(2021, 3, 1, tzinfo=timezone.utc).timestamp())
+        append_traffic(self.storage, self.route_ids[0], range(monday, monday + 14 * DAY, 6 * HOUR))
+        append_traffic(self.storage, self.route_ids[1], [monday])
+
+        with self.storage.session_scope() as s:
+            route = self.storage.get_route(user_id=1, route_id=self.route_ids[0], s=s)
+            assert len(self.storage.make_report(route, s).timestamps) == 14 * 4
+            assert len(self.storage.make_report_day(route, s, day_id=1).timestamps) == 8
+            assert self.storage.get_last_scan_timestamps(s) == {self.route_ids[0]: monday + 14 * DAY - 6 * HOUR,
+                                                                 self.route_ids[1]: monday}
+            rollup = self.storage.get_rollup(route, s)
+            self.storage.rebuild_rollups(s)
+            rebuilt = self.storage.get_rollup(route, s)
+            for incremental_stat, rebuilt_stat in zip(rollup._stats(), rebuilt._stats()):
+                assert (incremental_stat == rebuilt_stat).all()
+
+            self.storage.remove_route(user_id=1, route_id=self.route_ids[1], s=s)
+            assert list(self.storage.get_last_scan_timestamps(s)) == [self.route_ids[0]]
+
+    def test_partial_append(self):
+        append_traffic(self.storage, self.route_ids[0], [1000, 2000, 3000])
+        timestamps_path, durations_path = self.storage._column_paths(self.route_ids[0])
+        # Values being appended, only some of their bytes are written
+        with open(timestamps_path, 'ab') as f:
+            f.write(b'\x00' * 5)
+        with open(durations_path, 'ab') as f:
+            f.write(b'\x00')
+        timestamps, durations = self.storage.read_columns(self.route_ids[0])
+        assert timestamps.tolist() == [1000, 2000, 3000] and durations.tolist() == [600] * 3
+
+    def test_append_after_torn_writes(self):
+        timestamps_path, durations_path = self.storage._column_paths(self.route_ids[0])
+        append_traffic(self.storage, self.route_ids[0], [1000, 2000])
+        # A crash in the middle of a timestamp
+        with open(timestamps_path, 'ab') as f:
+            f.write(b'\x01' * 5)
+        append_traffic(self.storage, self.route_ids[0], [3000])
+        # A crash between the appends of the two files
+        with open(timestamps_path, 'ab') as f:
+            f.write(np.array([3500], dtype=TIMESTAMP_DTYPE).tobytes())
+        append_traffic(self.storage, self.route_ids[0], [4000], duration_sec=700)
+        timestamps, durations = self.storage.read_columns(self.route_ids[0])
+        assert timestamps.tolist() == [1000, 2000, 3000, 4000] and durations.tolist() == [600] * 3 + [700]
+
+    def test_delete_old_traffic_entries(self):
+        now = int(time.time())
+        for route_id in self.route_ids:
+            append_traffic(self.storage, route_id, [now - days * DAY - 60 for days in reversed(range(10))])
+
+        report = self.storage.delete_old_traffic_entries(keep_days=3)
+        assert report.rows_deleted == 2 * 7
+        with self.storage.session_scope() as s:
+            for route in self.storage.get_routes(user_id=None, s=s):
+                assert len(self.storage.make_report(route, s).timestamps) == 3
+
+    def test_compact_traffic(self):
+        now = int(time.time())
+        timestamps = range(now - 60 * DAY, now, HOUR)
+        append_traffic(self.storage, self.route_ids[0], timestamps)
+
+        report = self.storage.compact_traffic(keep_days=7, keep_hourly_days=30)
+        assert report.raw_rows_folded > 0 and report.hourly_rows_folded > 0
+        with self.storage.session_scope() as s:
+            route = self.storage.get_route(user_id=1, route_id=self.route_ids[0], s=s)
+            assert len(self.storage.read_columns(route.route_id)[0]) <= 8 * 24
+            assert self.storage.make_report(route, s).weights.sum() == len(timestamps)
@@ -0,0 +1,56 @@
+import time
+import unittest
+from unittest import mock
+
+from datetime import datetime, timezone
+
+from tests.test_storage import add_routes
+from traffic_scanner.storage import TrafficStorageSQL, DAY, HOUR
+from traffic_scanner.storage_memory import TrafficStorageMemory
+
+
+def append_traffic(storage, timestamps):
+    with storage.session_scope() as s:
+        routes = storage.get_routes(user_id=None, s=s)
+        for i, timestamp in enumerate(timestamps):
+            with mock.patch('time.time', return_value=timestamp):
+                storage.append_traffic(routes[i % len(routes)], duration_sec=600 + i % 13 * 60, s=s)
+
+
+class TestTrafficStorageMemory(unittest.TestCase):
+
+    def test_matches_sql_storage(self):
+        monday = int(datetime(2021, 3, 1, tzinfo=timezone.utc).timestamp())
+        timestamps = range(monday, monday + 21 * DAY, 5 * HOUR + 7 * 60)
+        storages = TrafficStorageMemory(), TrafficStorageSQL(db_url='sqlite://')
+        for storage in storages:
+            add_routes(storage, 2)
+            append_traffic(storage, timestamps)
+
+        reports = []
+        for storage in storages:
+            with storage.session_scope() as s:
+                route = storage.get_route(user_id=1, route_id=1, s=s)
+                route.user.timezone = 3
+                reports.append((list(storage.make_report(route, s).durations),
+                                list(storage.make_report_day(route, s, day_id=2).timestamps),
+                                [stat.tolist() for stat in storage.get_rollup(route, s)._stats()],
+                                storage.get_last_scan_timestamps(s)))
+        assert reports[0] == reports[1]
+
+    def test_compact_traffic(self):
+        storage = TrafficStorageMemory()
+        add_routes(storage, 1)
+        now = int(time.time())
+        timestamps = range(now - 60 * DAY, now, HOUR)
+        append_traffic(storage, timestamps)
+
+        report = storage.compact_traffic(keep_days=7, keep_hourly_days=30)
+        assert report.raw_rows_folded > 0 and report.hourly_rows_folded > 0
+        with storage.session_scope() as s:
+            route, = storage.get_routes(user_id=None, s=s)
+            assert storage.make_report(route, s).weights.sum() == len(timestamps)
+            assert storage.make_report_day(route, s, day_id=0).weights.sum() > 0
+
+            storage.remove_route(user_id=1, route_id=route.route_id, s=s)
+            assert storage.get_routes(user_id=None, s=s) == [] and storage.hourly == {} and storage.weekly == {}
@@ -0,0 +1,58 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from tests.test_storage import add_routes
+from traffic_scanner.storage import TrafficStorageSQL, traffic_rollup_table, traffic_sketch_table, DAY, HOUR
+from traffic_scanner.storage_columnar import TrafficStorageColumnar
+from traffic_scanner.traffic_export import export_history, import_history, table_path
+
+
+def reports(storage):
+    with storage.session_scope() as s:
+        return [(route.route_id, route.title, route.user.user_id,
+                 list(map(int, storage.make_report(route, s).timestamps)),
+                 list(map(int, storage.make_report(route, s).durations)),
+                 storage.get_rollup(route, s).num_samples.tolist(),
+                 storage.get_sketches(route, s).sketches)
+                for route in storage.get_routes(user_id=None, s=s)]
+
+
+class TestTrafficExport(unittest.TestCase):
+
+    def test_export_import(self):
+        storage = TrafficStorageSQL(db_url='sqlite://')
+        add_routes(storage, 3)
+        add_routes(storage, 1, user_id=2)
+        now = int(time.time())
+        with storage.session_scope() as s:
+            for route_id in 1, 2, 4:
+                route = storage.get_route(user_id=2 if route_id == 4 else 1, route_id=route_id, s=s)
+                for timestamp in range(now - 20 * DAY, now, route_id * HOUR):
+                    with mock.patch('time.time', return_value=timestamp):
+                        storage.append_traffic(route, duration_sec=600 + route_id, s=s)
+        # The rollup keeps the samples folded by compaction, it is never rebuilt
+        storage.compact_traffic(keep_days=7, keep_hourly_days=14)
+        expected = reports(storage)
+        assert sum(map(sum, expected[0][-2])) == 20 * 24
+
+        for traffic_format in 'csv', 'npy':
+            with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as data_dir:
+                counts = export_history(storage, directory, traffic_format=traffic_format, chunk_size=7)
+                assert counts['routes'] == 4 and counts['traffic'] > 0
+                for imported in TrafficStorageSQL(db_url='sqlite://'), \
+                        TrafficStorageColumnar(db_url='sqlite://', data_dir=data_dir):
+                    assert import_history(imported, directory, chunk_size=7) == counts
+                    assert reports(imported) == expected
+                    with self.assertRaises(ValueError):
+                        import_history(imported, directory)
+
+                # Exports without sketches or rollups get them rebuilt from the raw traffic
+                for table in traffic_sketch_table, traffic_rollup_table:
+                    os.remove(table_path(directory, table))
+                    imported = TrafficStorageSQL(db_url='sqlite://')
+                    import_history(imported, directory, chunk_size=7)
+                    with imported.session_scope() as s:
+                        assert s.query(traffic_rollup_table).count() > 0 and s.query(traffic_sketch_table).count() > 0
@@ -0,0 +1,114 @@
+import datetime
+import math
+import pickle
+import unittest
+
+import numpy as np
+
+from traffic_scanner.traffic_view import TrafficView, sort_intervals, sort_days_intervals, interval_stats, \
+    figure_png, DAY, HOUR, MINUTE
+from traffic_scanner.storage import Route, User, make_rollup, rollup_stats
+
+
+def reference_intervals(dates, durations, timedelta):
+    # The loops that sort_intervals used before it was vectorized
+    seconds = [date.hour * HOUR + date.minute * MINUTE + date.second for date in dates]
+    intervals_indices = [[j for j in range(len(dates)) if timedelta * i <= seconds[j] < timedelta * (i + 1)]
+                         for i in range(math.ceil(DAY / timedelta))]
+    return ([durations[indices] for indices in intervals_indices if len(indices) > 0],
+            [i for i, indices in enumerate(intervals_indices) if len(indices) > 0])
+
+
+def reference_days_intervals(timestamps, durations, timedelta):
+    dates = np.array(list(map(datetime.datetime.utcfromtimestamp, timestamps)))
+    durations_days_intervals, nonzero_intervals = [], []
+    for day_id in range(7):
+        day_indices = [j for j in range(len(dates)) if dates[j].weekday() == day_id]
+        durations_day, intervals_day = reference_intervals(dates[day_indices], durations[day_indices], timedelta)
+        durations_days_intervals.append(durations_day)
+        nonzero_intervals.append(intervals_day)
+    return durations_days_intervals, nonzero_intervals
+
+
+class TestTrafficView(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.timestamps = np.sort(rng.integers(1614556800, 1614556800 + 60 * DAY, 2000))
+        self.durations = rng.integers(300, 3 * HOUR, len(self.timestamps)).astype(np.int32)
+
+    def assertIntervalsEqual(self, expected, actual):
+        self.assertEqual(expected[1], actual[1])
+        self.assertEqual(len(expected[0]), len(actual[0]))
+        for expected_day, actual_day in zip(expected[0], actual[0]):
+            self.assertEqual([d.tolist() for d in expected_day], [d.tolist() for d in actual_day])
+
+    def test_sort_intervals_matches_reference(self):
+        for timedelta in 15 * MINUTE, 7 * MINUTE, HOUR:
+            dates = np.array(list(map(datetime.datetime.utcfromtimestamp, self.timestamps.tolist())))
+            durations, intervals = reference_intervals(dates, self.durations, timedelta)
+            self.assertIntervalsEqual(([durations], [intervals]),
+                                      sort_intervals(self.timestamps, self.durations, timedelta))
+
+    def test_sort_days_intervals_matches_reference(self):
+        for timedelta in 15 * MINUTE, 7 * MINUTE, HOUR:
+            self.assertIntervalsEqual(reference_days_intervals(self.timestamps.tolist(), self.durations, timedelta),
+                                      sort_days_intervals(self.timestamps, self.durations, timedelta))
+
+    def test_empty(self):
+        self.assertEqual(([[]], [[]]), sort_intervals([], [], HOUR))
+        self.assertEqual(([[]] * 7, [[]] * 7), sort_days_intervals([], [], HOUR))
+        self.assertEqual(0, len(interval_stats([], [], HOUR).keys))
+
+    def test_interval_stats(self):
+        weights = np.arange(len(self.timestamps)) % 3 + 1
+        stats = interval_stats(self.timestamps, self.durations, 15 * MINUTE, weights=weights, by_day=True)
+        durations_days, intervals_days = sort_days_intervals(self.timestamps, self.durations, 15 * MINUTE)
+        weights_days, _ = sort_days_intervals(self.timestamps, weights, 15 * MINUTE)
+        self.assertEqual(sum(map(len, intervals_days)), len(stats.keys))
+        i = 0
+        for durations_day, weights_day in zip(durations_days, weights_days):
+            for durations, interval_weights in zip(durations_day, weights_day):
+                self.assertEqual(len(durations), stats.num_samples[i])
+                self.assertEqual(durations.min(), stats.min[i])
+                self.assertEqual(durations.max(), stats.max[i])
+                self.assertAlmostEqual(np.average(durations, weights=interval_weights), stats.mean[i])
+                i += 1
+
+    def test_fast_render_reuses_figures(self):
+        view = TrafficView(15 * MINUTE, fast_render=True, figsize=(6, 2), dpi=50)
+        fig = view.plot_traffic_minmax(self.timestamps, self.durations, 0, 'First')
+        png = figure_png(fig, view.png_colors)
+        assert png.startswith(b'\x89PNG') and tuple(fig.canvas.get_width_height()) == (300, 100)
+
+        halved = self.durations // 2
+        assert view.plot_traffic_minmax(self.timestamps, halved, 0, 'Second') is fig
+        stats = interval_stats(self.timestamps, halved, 15 * MINUTE)
+        line_max = fig.axes[0].lines[0]
+        assert line_max.get_xdata().tolist() == (stats.keys * 15 * MINUTE).tolist()
+        assert list(line_max.get_ydata()) == list(map(int, stats.max))
+        assert fig.axes[0].get_title() == 'Second'
+        assert view.plot_traffic_by_day(self.timestamps, halved, 0, 'Second') is not fig
+
+        copy = pickle.loads(pickle.dumps(view))
+        assert copy.plot_traffic_minmax(self.timestamps, halved, 0, 'Second') is not fig
+
+    def test_rollups_comparison(self):
+        user = User(user_id=1, timezone=0)
+        rollups = [make_rollup(Route(55.7, 37.6, 55.8, 37.5, title=title, user=user), 15 * MINUTE,
+                               rollup_stats(self.timestamps, self.durations // divisor, 15 * MINUTE))
+                   for title, divisor in (('There', 1), ('Back', 2))]
+        view = TrafficView(15 * MINUTE, fast_render=True, figsize=(6, 2), dpi=50)
+        fig = view.plot_rollups_comparison(rollups, ['There', 'Back'])
+        assert figure_png(fig, view.png_colors).startswith(b'\x89PNG')
+        there, back = fig.axes[0].lines[:2]
+        assert np.allclose(np.asarray(back.get_ydata()) * 2, there.get_ydata(), atol=1)
+        assert fig.axes[0].get_title() == 'There / Back'
+
+        assert view.plot_rollups_comparison(rollups[1:], ['Back']) is fig
+        assert [text.get_text() for text in fig.legends[-1].get_texts()] == ['Back']
+        assert len(fig.legends) == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import threading
+import time
+from typing import Hashable
+
+ACCESS_HALF_LIFE = 24 * 60 * 60
+MAX_TRACKED_KEYS = 10000
+
+
+class AccessTracker:
+    """
+    Thread-safe count of accesses per key that halves every half_life seconds, so keys viewed often and recently
+    are the hottest. When more than 2 * max_keys keys are tracked, only the max_keys hottest ones are kept.
+    """
+
+    def __init__(self, half_life=ACCESS_HALF_LIFE, max_keys=MAX_TRACKED_KEYS):
+        self.half_life: float = half_life
+        self.max_keys: int = max_keys
+        # Key -> (score, time of the score)
+        self.scores = {}
+        self.lock = threading.Lock()
+
+    def _decayed(self, score, t_score, now) -> float:
+        return score * 2 ** (-(now - t_score) / self.half_life)
+
+    def record(self, key: Hashable, now=None) -> None:
+        now = time.time() if now is None else now
+        with self.lock:
+            score, t_score = self.scores.get(key, (0, now))
+            self.scores[key] = self._decayed(score, t_score, now) + 1, now
+            if len(self.scores) > 2 * self.max_keys:
+                self.scores = dict(self._hottest(self.max_keys, now))
+
+    def score(self, key: Hashable, now=None) -> float:
+        now = time.time() if now is None else now
+        with self.lock:
+            score, t_score = self.scores.get(key, (0, now))
+            return self._decayed(score, t_score, now)
+
+    def hot(self, max_keys, now=None) -> [Hashable]:
+        """
+        Up to max_keys hottest keys, the hottest first.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            return [key for key, _ in self._hottest(max_keys, now)]
+
+    def _hottest(self, max_keys, now):
+        return sorted(self.scores.items(), key=lambda item: self._decayed(*item[1], now), reverse=True)[:max_keys]
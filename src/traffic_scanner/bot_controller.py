@@ -1,20 +1,28 @@
 import io
 import logging
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
-from matplotlib import pyplot as plt
 from requests import get as get_request
 from requests.exceptions import MissingSchema, HTTPError
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputFile
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputFile, Message
 from telegram.ext import CommandHandler, MessageHandler, ConversationHandler, Filters, CallbackQueryHandler
 
-from traffic_scanner.traffic_scanner import TrafficScanner
-from traffic_scanner.traffic_view import TrafficView
+from traffic_scanner.access_tracker import AccessTracker
+from traffic_scanner.plot_cache import PlotCache, CachedPlot
+from traffic_scanner.plot_renderer import PlotRenderer
+from traffic_scanner.storage import RouteTrafficRollup, route_timezone, local_weekday
+from traffic_scanner.traffic_scanner import TrafficScanner, COORDS_PRECISION
 
 logger = logging.getLogger('traffic_scanner/bot_controller.py')
 
 COORDS_REGEX = re.compile(r'-?\d+\.\d+')
 COORDS_FROM_URL_REGEX = re.compile(r'\"point\":[^}]*-?\d+\.\d+')
+PRERENDER_ROUTES = 50
+PLOT_QUANTILES = 0.1, 0.5, 0.9
+MAX_COMPARED_ROUTES = 6
 
 
 def cancelable(func):
@@ -36,6 +44,13 @@ def get_coords_string_from_url(input_string):
     return coordinate_strings.group()
 
 
+def is_road_back(route, other, precision=COORDS_PRECISION) -> bool:
+    def rounded(coords):
+        return tuple(round(coord, precision) for coord in coords)
+    return rounded(route.start_coords) == rounded(other.end_coords) \
+        and rounded(route.end_coords) == rounded(other.start_coords)
+
+
 def parse_coordinates_or_url(input_str):
     # Determine if input_str is url or coordinates
     try:
@@ -72,6 +87,7 @@ To begin, send me a link from yandex maps of the route start
 Commands:
 /add_route
 /routes
+/compare
 ''')
     PROPOSAL_ENTER_START = 'Enter start point coordinates or url 🤓'
     PROPOSAL_ENTER_FINISH = 'Now enter finish coordinates 🧐'
@@ -81,18 +97,27 @@ Commands:
     RESPONSE_ON_SUCCESS = '🆗'
     RESPONSE_ON_FAILURE = 'Not ok 😔'
     RESPONSE_NO_ROUTES = 'No routes 🙌'
+    RESPONSE_NO_ROAD_BACK = 'No road back, add it in Edit 🛠'
 
     BUTTON_EDIT = 'Edit 🛠'
     BUTTON_SHOW_BY_DAY = 'Show day'
+    BUTTON_COMPARE_ROAD_BACK = 'Compare with road back ↔️'
 
     FAILURE_PARSING_COORDINATES = '''Could not understand your coordinates
  Retry? 🤔
  Please, send coordinates or link from Yandex maps
  '''
 
-    def __init__(self, traffic_scanner, traffic_plotter):
+    def __init__(self, traffic_scanner, plot_renderer, plot_cache=None, prerender_routes=PRERENDER_ROUTES):
         self.traffic_scanner: TrafficScanner = traffic_scanner
-        self.traffic_plotter: TrafficView = traffic_plotter
+        self.plot_renderer: PlotRenderer = plot_renderer
+        self.plot_cache: PlotCache = plot_cache if plot_cache is not None else PlotCache()
+        # Views of (user_id, route_id), plots of the hottest prerender_routes routes are rendered after their scans
+        self.access_tracker = AccessTracker()
+        self.prerender_routes: int = prerender_routes
+        self.prerender_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prerender')
+        if prerender_routes > 0:
+            traffic_scanner.add_scan_listener(self.prerender_hot_routes)
 
     def initialize_dispatcher(self, dispatcher):
         conversation_add_route = ConversationHandler(
@@ -137,13 +162,20 @@ Commands:
         dispatcher.add_handler(CommandHandler('list', self.list_routes))
         dispatcher.add_handler(CommandHandler('routes', self.show_routes))
         dispatcher.add_handler(CommandHandler('add_route', self.add_route))
-        dispatcher.add_handler(CallbackQueryHandler(self.choose_route, pattern=self.CALLBACK_SHOW_ROUTES))
+        dispatcher.add_handler(CommandHandler('compare', self.compare_routes, run_async=True))
+        # Handlers of plots wait for the renderer in the dispatcher's worker threads, not in the one that polls updates
+        dispatcher.add_handler(CallbackQueryHandler(self.choose_route, pattern=self.CALLBACK_SHOW_ROUTES,
+                                                    run_async=True))
         dispatcher.add_handler(CallbackQueryHandler(self.choose_edit, pattern=self.CALLBACK_EDIT_ROUTE))
         dispatcher.add_handler(CallbackQueryHandler(self.choose_delete_route, pattern=self.CALLBACK_DELETE_ROUTE))
-        dispatcher.add_handler(CallbackQueryHandler(self.choose_close_edit, pattern=self.CALLBACK_CLOSE_EDIT))
+        dispatcher.add_handler(CallbackQueryHandler(self.choose_close_edit, pattern=self.CALLBACK_CLOSE_EDIT,
+                                                    run_async=True))
 
         dispatcher.add_handler(CallbackQueryHandler(self.show_by_day, pattern=self.CALLBACK_SHOW_BY_DAY))
-        dispatcher.add_handler(CallbackQueryHandler(self.select_day, pattern=self.CALLBACK_SELECT_DAY))
+        dispatcher.add_handler(CallbackQueryHandler(self.choose_compare_road_back,
+                                                    pattern=self.CALLBACK_COMPARE_ROAD_BACK, run_async=True))
+        dispatcher.add_handler(CallbackQueryHandler(self.select_day, pattern=self.CALLBACK_SELECT_DAY,
+                                                    run_async=True))
 
         dispatcher.add_handler(conversation_rename_route)
         dispatcher.add_handler(conversation_add_road_back)
@@ -224,13 +256,112 @@ Commands:
 
     CALLBACK_EDIT_ROUTE = '__edit_image__'
     CALLBACK_SHOW_BY_DAY = '__show_by_day__'
+    CALLBACK_COMPARE_ROAD_BACK = '__compare_road_back__'
 
     def _get_route_inline_markup(self, route_id):
         return [
             [InlineKeyboardButton(self.BUTTON_EDIT, callback_data=self.CALLBACK_EDIT_ROUTE + str(route_id))],
             [InlineKeyboardButton(self.BUTTON_SHOW_BY_DAY, callback_data=self.CALLBACK_SHOW_BY_DAY + str(route_id))],
+            [InlineKeyboardButton(self.BUTTON_COMPARE_ROAD_BACK,
+                                  callback_data=self.CALLBACK_COMPARE_ROAD_BACK + str(route_id))],
         ]
 
+    def _read_comparison(self, routes, s) -> ([RouteTrafficRollup], [str]):
+        """
+        Arguments of the chart of the routes for render_rollups_comparison, their rollups are read by one query.
+        """
+        return self.traffic_scanner.storage.get_rollups(routes, s), [route.title for route in routes]
+
+    def compare_routes(self, update, context):
+        user_id = update.effective_message.from_user.id
+        with self.traffic_scanner.storage.session_scope() as s:
+            routes = self.traffic_scanner.storage.get_routes(user_id, s)[:MAX_COMPARED_ROUTES]
+            if len(routes) == 0:
+                update.effective_message.reply_text(self.RESPONSE_NO_ROUTES)
+                return
+            update.effective_user.send_chat_action('upload_photo')
+            comparison = self._read_comparison(routes, s)
+        png = self.plot_renderer.render_rollups_comparison(*comparison)
+        update.effective_message.reply_photo(InputFile(io.BytesIO(png)))
+
+    def choose_compare_road_back(self, update, context):
+        query = update.callback_query
+        query.answer()
+        route_id = query.data[len(self.CALLBACK_COMPARE_ROAD_BACK):]
+
+        with self.traffic_scanner.storage.session_scope() as s:
+            routes = self.traffic_scanner.storage.get_routes(update.effective_user.id, s)
+            route = next((route for route in routes if str(route.route_id) == route_id), None)
+            if route is None:
+                return
+            roads_back = [other for other in routes if is_road_back(route, other)]
+            if len(roads_back) == 0:
+                update.effective_message.reply_text(self.RESPONSE_NO_ROAD_BACK)
+                return
+            comparison = self._read_comparison([route] + roads_back[:MAX_COMPARED_ROUTES - 1], s)
+        png = self.plot_renderer.render_rollups_comparison(*comparison)
+        update.effective_message.reply_photo(InputFile(io.BytesIO(png)))
+
+    def _read_route_plot(self, route, day_id, s) -> (tuple, Optional[CachedPlot], Optional[tuple]):
+        """
+        Key of the plot of the route's week, or of one day if day_id is given, with the plot from the cache if
+        the route was not scanned and the rollups were not rebuilt since it was rendered, or else the arguments to
+        render it by _route_plot. Only reads the database, so the session is not held during the render.
+        """
+        key = (route.route_id, 'week' if day_id is None else 'day', day_id,
+               self.traffic_scanner.storage.get_last_scan_timestamp(route.route_id, s),
+               self.traffic_scanner.storage.rollups_version,
+               route.title, route_timezone(route))
+        plot = self.plot_cache.get(key)
+        if plot is not None:
+            return key, plot, None
+
+        rollup = self.traffic_scanner.storage.get_rollup(route, s)
+        sketches = self.traffic_scanner.storage.get_sketches(route, s)
+        if day_id is None:
+            return key, None, (rollup, route.title, sketches.merge_days().quantiles(PLOT_QUANTILES))
+        return key, None, (rollup.day(day_id), route.title + ': ' + self.DAYS[day_id],
+                           sketches.day(day_id).quantiles(PLOT_QUANTILES))
+
+    def _route_plot(self, key, plot, render_args) -> (tuple, CachedPlot):
+        """
+        Renders and caches the plot read by _read_route_plot unless it was cached.
+        """
+        if plot is None:
+            plot = self.plot_cache.put(key, self.plot_renderer.render_rollup_minmax(*render_args))
+        return key, plot
+
+    def prerender_hot_routes(self, route_ids):
+        """
+        Renders in the background the plots of the scanned routes that were viewed recently: the week and today.
+        Only routes scanned in this process are prerendered.
+        """
+        route_ids = set(route_ids)
+        keys = [key for key in self.access_tracker.hot(self.prerender_routes) if key[1] in route_ids]
+        if len(keys) > 0:
+            self.prerender_executor.submit(self._prerender, keys)
+
+    def _prerender(self, keys):
+        t0 = time.time()
+        for user_id, route_id in keys:
+            try:
+                with self.traffic_scanner.storage.session_scope() as s:
+                    route = self.traffic_scanner.storage.get_route(user_id=user_id, route_id=route_id, s=s)
+                    if route is None:
+                        continue
+                    plots = [self._read_route_plot(route, None, s),
+                             self._read_route_plot(route, local_weekday(int(time.time()), route_timezone(route)), s)]
+                for plot in plots:
+                    self._route_plot(*plot)
+            except Exception as e:
+                logger.exception(e)
+        logger.info(f'Prerendered plots of {len(keys)} routes in {time.time() - t0:.2f} seconds.')
+
+    def _remember_file_id(self, key, message):
+        # Editing an inline message returns True instead of the message
+        if isinstance(message, Message) and len(message.photo) > 0:
+            self.plot_cache.set_file_id(key, message.photo[-1].file_id)
+
     def _send_route_plot(self, update, route_id):
         user_id = update.effective_user.id
         query = update.callback_query
@@ -242,24 +373,18 @@ Commands:
                                                         s=s)
             if route is None:
                 return
+            self.access_tracker.record((user_id, route.route_id))
+            route_plot = self._read_route_plot(route, None, s)
+        key, plot = self._route_plot(*route_plot)
 
-            report = self.traffic_scanner.storage.make_report(route, s)
-            figure = self.traffic_plotter.plot_traffic_minmax(report.timestamps, report.durations,
-                                                    report.timezone, report.route.title)
-            with io.BytesIO() as buf:
-                figure.savefig(buf, format='png')
-                buf.seek(0)
-                keyboard = self._get_route_inline_markup(route_id)
-                if len(update.effective_message.photo) == 0:
-                    
-                    plot_file = InputFile(buf)
-                    update.effective_message.reply_photo(plot_file, reply_markup=InlineKeyboardMarkup(keyboard))
-                else:
-                    plot_file = InputMediaPhoto(buf)
-                    query.edit_message_media(plot_file)
-                    query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard))
-
-            plt.close(figure)
+        keyboard = self._get_route_inline_markup(route_id)
+        if len(update.effective_message.photo) == 0:
+            message = update.effective_message.reply_photo(plot.file_id or InputFile(io.BytesIO(plot.png)),
+                                                           reply_markup=InlineKeyboardMarkup(keyboard))
+        else:
+            message = query.edit_message_media(InputMediaPhoto(plot.file_id or plot.png))
+            query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard))
+        self._remember_file_id(key, message)
 
     def choose_route(self, update, context):
         query = update.callback_query
@@ -395,15 +520,9 @@ Commands:
                                                            s=s)
             if route is None:
                 return
+            self.access_tracker.record((user_id, route.route_id))
+            route_plot = self._read_route_plot(route, day_id, s)
+        key, plot = self._route_plot(*route_plot)
 
-            report = self.traffic_scanner.storage.make_report_day(route, s, day_id=day_id)
-            figure = self.traffic_plotter.plot_traffic_minmax(report.timestamps, report.durations, report.timezone, report.route.title + ': ' + self.DAYS[day_id])
-            with io.BytesIO() as buf:
-                figure.savefig(buf, format='png')
-                buf.seek(0)
-                plot_file = InputMediaPhoto(buf)
-
-            query.edit_message_media(plot_file)
-            plt.close(figure)
-
+        self._remember_file_id(key, query.edit_message_media(InputMediaPhoto(plot.file_id or plot.png)))
         query.edit_message_reply_markup(InlineKeyboardMarkup(self._get_show_by_day_inline_markup(route_id)))
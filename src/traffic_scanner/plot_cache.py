@@ -0,0 +1,58 @@
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Hashable, Optional
+
+logger = logging.getLogger('traffic_scanner/plot_cache.py')
+
+PLOT_CACHE_SIZE = 256
+
+
+@dataclass
+class CachedPlot:
+    png: bytes
+    # Set after the first upload, Telegram then sends the same photo by its id
+    file_id: Optional[str] = field(default=None)
+
+
+class PlotCache:
+    """
+    Thread-safe LRU cache of rendered plots. Keys include the timestamp of the route's latest sample,
+    so a plot is rendered again after a scan and the stale entry is evicted in time.
+    """
+
+    def __init__(self, max_size=PLOT_CACHE_SIZE):
+        assert max_size > 0
+        self.max_size: int = max_size
+        self.plots = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.plots)
+
+    def get(self, key: Hashable) -> Optional[CachedPlot]:
+        with self.lock:
+            plot = self.plots.get(key)
+            if plot is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.plots.move_to_end(key)
+            return plot
+
+    def put(self, key: Hashable, png: bytes) -> CachedPlot:
+        with self.lock:
+            plot = self.plots[key] = CachedPlot(png)
+            self.plots.move_to_end(key)
+            while len(self.plots) > self.max_size:
+                self.plots.popitem(last=False)
+            return plot
+
+    def set_file_id(self, key: Hashable, file_id: str) -> None:
+        with self.lock:
+            plot = self.plots.get(key)
+            if plot is not None:
+                plot.file_id = file_id
@@ -0,0 +1,88 @@
+import dataclasses
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from traffic_scanner.storage import RouteTrafficRollup
+from traffic_scanner.traffic_view import TrafficView, figure_png
+
+logger = logging.getLogger('traffic_scanner/plot_renderer.py')
+
+RENDER_PROCESSES = 2
+
+
+# The view of a render process, it is sent once so its figure templates are kept between renders
+worker_view = None
+
+
+def init_worker(traffic_view: TrafficView):
+    global worker_view
+    worker_view = traffic_view
+
+
+def render_png(traffic_view: TrafficView, method, args) -> bytes:
+    return figure_png(getattr(traffic_view, method)(*args), traffic_view.png_colors)
+
+
+def render_in_worker(method, args) -> bytes:
+    return render_png(worker_view, method, args)
+
+
+class PlotRenderer:
+    """
+    Renders plots of a TrafficView to PNG bytes in a pool of processes, so renders run in parallel and do not hold
+    the GIL of the bot's threads. With num_processes=0 plots are rendered in the calling thread.
+    """
+
+    def __init__(self, traffic_view: TrafficView, num_processes=RENDER_PROCESSES):
+        self.traffic_view: TrafficView = traffic_view
+        self.num_processes: int = num_processes
+        self.executor = None
+        self.executor_lock = threading.Lock()
+        if num_processes > 0:
+            self.executor = self._start_executor()
+
+    def _start_executor(self) -> ProcessPoolExecutor:
+        # Forked workers do not import the __main__ module again, which starts the bot.
+        # All of them are started by the first task, before the bot's threads are
+        executor = ProcessPoolExecutor(self.num_processes, mp_context=multiprocessing.get_context('fork'),
+                                       initializer=init_worker, initargs=(self.traffic_view,))
+        executor.submit(int).result()
+        return executor
+
+    def _restart_executor(self, broken_executor) -> None:
+        with self.executor_lock:
+            # Another thread may have restarted it already
+            if self.executor is broken_executor:
+                # Unlike the first pool, this one is forked while the bot's threads run
+                logger.error('A render process died, restarting the pool.')
+                broken_executor.shutdown(wait=False)
+                self.executor = self._start_executor()
+
+    def render(self, method, *args) -> bytes:
+        """
+        PNG of the figure returned by the TrafficView's method. Arguments are pickled to the worker process.
+        If a render process dies, the pool is restarted and the plot is rendered in the calling thread.
+        """
+        executor = self.executor
+        if executor is None:
+            return render_png(self.traffic_view, method, args)
+        try:
+            return executor.submit(render_in_worker, method, args).result()
+        except BrokenProcessPool:
+            self._restart_executor(executor)
+            return render_png(self.traffic_view, method, args)
+
+    def render_rollup_minmax(self, rollup: RouteTrafficRollup, route_name, quantiles=None) -> bytes:
+        # The route is mapped to the database and is not needed for the plot, only the arrays are sent
+        return self.render('plot_rollup_minmax', dataclasses.replace(rollup, route=None), route_name, quantiles)
+
+    def render_rollups_comparison(self, rollups: [RouteTrafficRollup], route_names) -> bytes:
+        return self.render('plot_rollups_comparison', [dataclasses.replace(rollup, route=None) for rollup in rollups],
+                           route_names)
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -0,0 +1,91 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Every acquire() takes one token, tokens are refilled with `rate` per second
+    and at most `capacity` of them can be accumulated for a burst.
+    """
+
+    def __init__(self, rate, capacity=1):
+        assert rate > 0
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self.t_last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.t_last) * self.rate)
+        self.t_last = now
+
+    def try_acquire(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def on_success(self):
+        pass
+
+    def on_throttled(self):
+        pass
+
+    def on_error(self):
+        pass
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """
+    Token bucket with additive increase / multiplicative decrease of the rate.
+    Healthy responses raise the rate by about `increase` requests per second every second,
+    throttling cuts it by `decrease_factor` and drains the bucket, other upstream errors cut it
+    by `error_decrease_factor`. Failures of the requests that were already in flight are not counted
+    again during `cooldown` seconds after a decrease.
+    """
+
+    def __init__(self, rate, min_rate, max_rate, increase=1.0, decrease_factor=0.5, error_decrease_factor=0.9,
+                 cooldown=1.0):
+        assert 0 < min_rate <= rate <= max_rate
+        super().__init__(rate)
+        self.min_rate: float = min_rate
+        self.max_rate: float = max_rate
+        self.increase: float = increase
+        self.decrease_factor: float = decrease_factor
+        self.error_decrease_factor: float = error_decrease_factor
+        self.cooldown: float = cooldown
+        self.t_decreased = -cooldown
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def _decrease(self, factor, drain):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.t_decreased < self.cooldown:
+                return
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate * factor)
+            if drain:
+                self.tokens = 0
+            self.t_decreased = now
+
+    def on_throttled(self):
+        self._decrease(self.decrease_factor, drain=True)
+
+    def on_error(self):
+        self._decrease(self.error_decrease_factor, drain=False)
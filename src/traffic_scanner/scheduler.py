@@ -0,0 +1,94 @@
+import heapq
+import math
+import random
+from dataclasses import dataclass, field
+from typing import Dict, Hashable, List, Optional
+
+
+MIN_RETRY_DELAY = 10
+RETRY_JITTER = 0.5
+
+
+@dataclass(order=True)
+class ScheduledScan:
+    t_due: float
+    key: Hashable = field(compare=False)
+    period: int = field(compare=False)
+    failures: int = field(default=0, compare=False)
+
+
+class RouteScheduler:
+    """
+    Keeps a heap of next due scan times, one entry per scan key (a route or a group of identical routes).
+    Entries of removed keys and entries replaced by a newer schedule stay in the heap and are skipped when popped.
+    """
+
+    def __init__(self, period):
+        self.period: int = period
+        self.heap: List[ScheduledScan] = []
+        self.entries: Dict[Hashable, ScheduledScan] = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _push(self, entry: ScheduledScan):
+        self.entries[entry.key] = entry
+        heapq.heappush(self.heap, entry)
+
+    def new_keys(self, periods: Dict[Hashable, Optional[int]]):
+        return [key for key in periods if key not in self.entries]
+
+    def sync(self, periods: Dict[Hashable, Optional[int]], last_scans: Dict[Hashable, int], now):
+        """
+        Brings the schedule in line with the current set of keys. Keys that were scanned before
+        are due one period after their last scan, so overdue ones are caught up first and the others
+        keep their phase. Keys without history are spread evenly across their period.
+        """
+        for key in set(self.entries) - set(periods):
+            del self.entries[key]
+
+        for key, entry in list(self.entries.items()):
+            period = periods[key] or self.period
+            if entry.period != period:
+                self._push(ScheduledScan(t_due=entry.t_due - entry.period + period, key=key, period=period))
+
+        never_scanned = []
+        for key in sorted(self.new_keys(periods)):
+            period = periods[key] or self.period
+            last_scan = last_scans.get(key)
+            if last_scan is None:
+                never_scanned.append((key, period))
+            else:
+                self._push(ScheduledScan(t_due=last_scan + period, key=key, period=period))
+
+        for i, (key, period) in enumerate(never_scanned):
+            self._push(ScheduledScan(t_due=now + period * i / len(never_scanned), key=key, period=period))
+
+    def pop_due(self, now) -> List[ScheduledScan]:
+        due = []
+        while len(self.heap) > 0 and self.heap[0].t_due <= now:
+            entry = heapq.heappop(self.heap)
+            if self.entries.get(entry.key) is entry:
+                due.append(entry)
+        return due
+
+    def reschedule(self, entry: ScheduledScan, now):
+        t_due = entry.t_due + entry.period
+        if t_due <= now:
+            # We fell behind for more than a period, skip the missed scans but keep the phase
+            t_due += math.ceil((now - t_due) / entry.period) * entry.period
+        self._push(ScheduledScan(t_due=t_due, key=entry.key, period=entry.period))
+
+    def retry(self, entry: ScheduledScan, now):
+        delay = min(MIN_RETRY_DELAY * 2 ** entry.failures, entry.period)
+        # Jitter keeps the routes that failed together from hitting the upstream together again
+        delay *= 1 + random.uniform(0, RETRY_JITTER)
+        self._push(ScheduledScan(t_due=now + delay, key=entry.key, period=entry.period,
+                                 failures=entry.failures + 1))
+
+    def time_until_next(self, now) -> Optional[float]:
+        while len(self.heap) > 0 and self.entries.get(self.heap[0].key) is not self.heap[0]:
+            heapq.heappop(self.heap)
+        if len(self.heap) == 0:
+            return None
+        return max(self.heap[0].t_due - now, 0)
@@ -0,0 +1,84 @@
+import math
+
+import numpy as np
+
+# Quantiles of a sketch are within this relative error of the true quantiles of its samples
+SKETCH_ACCURACY = 0.02
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+
+BIN_DTYPE = np.dtype('<i2')
+COUNT_DTYPE = np.dtype('<i4')
+
+
+def sketch_bins(durations) -> np.ndarray:
+    """
+    Logarithmic bin of every duration: bin i holds durations in (gamma^(i-1), gamma^i].
+    """
+    durations = np.maximum(np.asarray(durations, dtype=np.float64), 1)
+    return np.ceil(np.log(durations) / math.log(SKETCH_GAMMA)).astype(np.int64)
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch of durations in the style of DDSketch: counts of samples in logarithmic bins.
+    A sketch of durations up to a day has less than 300 bins, however many samples it was built from,
+    and merging sketches is adding their counts.
+    """
+
+    def __init__(self, bins=None, counts=None):
+        # Sorted distinct bins and the number of samples in each of them
+        self.bins: np.ndarray = np.empty(0, dtype=np.int64) if bins is None else np.asarray(bins, dtype=np.int64)
+        self.counts: np.ndarray = np.empty(0, dtype=np.int64) if counts is None \
+            else np.asarray(counts, dtype=np.int64)
+
+    @staticmethod
+    def from_durations(durations) -> 'QuantileSketch':
+        bins, counts = np.unique(sketch_bins(durations), return_counts=True)
+        return QuantileSketch(bins, counts)
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def __eq__(self, other):
+        return np.array_equal(self.bins, other.bins) and np.array_equal(self.counts, other.counts)
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        bins, bin_ids = np.unique(np.concatenate([self.bins, other.bins]), return_inverse=True)
+        counts = np.bincount(bin_ids, weights=np.concatenate([self.counts, other.counts]), minlength=len(bins))
+        return QuantileSketch(bins, counts.astype(np.int64))
+
+    def quantiles(self, qs) -> np.ndarray:
+        """
+        Estimates of the quantiles qs, NaN for an empty sketch.
+        """
+        qs = np.asarray(qs, dtype=np.float64)
+        if len(self.bins) == 0:
+            return np.full(qs.shape, np.nan)
+        ranks = qs * (self.counts.sum() - 1)
+        bins = self.bins[np.searchsorted(np.cumsum(self.counts), ranks, side='right')]
+        # The middle of the bin in terms of the relative error
+        return 2 * SKETCH_GAMMA ** bins / (SKETCH_GAMMA + 1)
+
+    def to_bytes(self) -> bytes:
+        return self.bins.astype(BIN_DTYPE).tobytes() + self.counts.astype(COUNT_DTYPE).tobytes()
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'QuantileSketch':
+        num_bins = len(data) // (BIN_DTYPE.itemsize + COUNT_DTYPE.itemsize)
+        bins = np.frombuffer(data, dtype=BIN_DTYPE, count=num_bins)
+        counts = np.frombuffer(data, dtype=COUNT_DTYPE, offset=num_bins * BIN_DTYPE.itemsize)
+        return QuantileSketch(bins, counts)
+
+
+def group_sketches(keys, durations) -> {int: QuantileSketch}:
+    """
+    Sketches of durations grouped by integer keys.
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    if len(keys) == 0:
+        return {}
+    pairs, counts = np.unique(np.stack([keys, sketch_bins(durations)]), axis=1, return_counts=True)
+    starts = np.flatnonzero(np.diff(pairs[0], prepend=pairs[0, 0] - 1))
+    ends = np.append(starts[1:], len(counts))
+    return {int(pairs[0, start]): QuantileSketch(pairs[1, start:end], counts[start:end])
+            for start, end in zip(starts, ends)}
@@ -1,15 +1,25 @@
+import itertools
 import os
 from abc import ABC, abstractmethod
+from array import array
 from dataclasses import dataclass, field
-from typing import Tuple, Optional
+from typing import Optional
 import time
 import logging
-from contextlib import contextmanager
-from datetime import datetime
+import threading
+from contextlib import contextmanager, nullcontext
 
-from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey, Float
-from sqlalchemy import create_engine
-from sqlalchemy.orm import mapper, relationship, sessionmaker, backref
+import numpy as np
+from sqlalchemy import Table, Column, Integer, BigInteger, String, MetaData, ForeignKey, Float, Index, LargeBinary
+from sqlalchemy import create_engine, inspect, func, select, false, and_, or_, cast, bindparam
+from sqlalchemy import event, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.sql import ColumnElement
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.orm import mapper, relationship, sessionmaker, scoped_session, backref, joinedload
+
+from traffic_scanner.sketch import QuantileSketch, group_sketches
 
 
 @dataclass
@@ -26,6 +36,28 @@ class Route:
     end_l1: float
     title: str
     user: User
+    scan_period: Optional[int] = field(default=None)
+
+    @property
+    def start_coords(self) -> (float, float):
+        return self.start_l0, self.start_l1
+
+    @property
+    def end_coords(self) -> (float, float):
+        return self.end_l0, self.end_l1
+
+
+@dataclass(frozen=True)
+class ScanTarget:
+    """
+    The columns of a route the scanner needs.
+    """
+    route_id: int
+    start_l0: float
+    start_l1: float
+    end_l0: float
+    end_l1: float
+    scan_period: Optional[int] = field(default=None)
 
     @property
     def start_coords(self) -> (float, float):
@@ -43,22 +75,265 @@ class Traffic:
     duration_sec: int
 
 
+def route_timezone(route: Route) -> int:
+    return int(route.user.timezone or os.environ.get('TIMEZONE', 0))
+
+
+def local_weekday(timestamp, timezone: int):
+    """
+    Day of week of UTC timestamps in the timezone, Monday is 0. Works for integers, arrays and integer SQL columns.
+    """
+    local_timestamp = timestamp + timezone * HOUR
+    if isinstance(local_timestamp, ColumnElement):
+        # Both operands are integers, so it is an integer division in SQLite and PostgreSQL
+        return (local_timestamp / DAY + EPOCH_WEEKDAY) % 7
+    return (local_timestamp // DAY + EPOCH_WEEKDAY) % 7
+
+
 @dataclass
 class RouteTrafficReport:
+    """
+    Traffic samples of the route. Traffic folded by compaction is represented by its mean, weighted by the number
+    of folded samples, and by its min and max with zero weights. Without weights every sample counts once.
+    """
     route: Route
-    timestamps: Tuple
-    durations: Tuple
+    timestamps: np.ndarray
+    durations: np.ndarray
+    weights: Optional[np.ndarray] = field(default=None)
 
     @property
     def timezone(self) -> int:
-        return int(self.route.user.timezone or os.environ.get('TIMEZONE', 0))
+        return route_timezone(self.route)
+
+
+@dataclass
+class RouteTrafficRollup:
+    """
+    Statistics of the route's traffic per day of week (rows) and time of day bucket (columns)
+    in the route's timezone.
+    """
+    route: Route
+    bucket_sec: int
+    num_samples: np.ndarray
+    sum_duration: np.ndarray
+    sum_sq_duration: np.ndarray
+    min_duration: np.ndarray
+    max_duration: np.ndarray
+
+    def day(self, day_id) -> 'RouteTrafficRollup':
+        return RouteTrafficRollup(self.route, self.bucket_sec,
+                                  *(stat[day_id:day_id + 1] for stat in self._stats()))
+
+    def merge_days(self) -> 'RouteTrafficRollup':
+        nonempty = self.num_samples > 0
+        min_duration = np.where(nonempty, self.min_duration, np.iinfo(np.int64).max).min(axis=0, keepdims=True)
+        max_duration = np.where(nonempty, self.max_duration, 0).max(axis=0, keepdims=True)
+        return RouteTrafficRollup(self.route, self.bucket_sec,
+                                  self.num_samples.sum(axis=0, keepdims=True),
+                                  self.sum_duration.sum(axis=0, keepdims=True),
+                                  self.sum_sq_duration.sum(axis=0, keepdims=True),
+                                  np.where(max_duration > 0, min_duration, 0),
+                                  max_duration)
+
+    @property
+    def mean_duration(self) -> np.ndarray:
+        return self.sum_duration / np.maximum(self.num_samples, 1)
+
+    def _stats(self):
+        return self.num_samples, self.sum_duration, self.sum_sq_duration, self.min_duration, self.max_duration
+
+
+@dataclass
+class RouteTrafficSketches:
+    """
+    Quantile sketches of the route's traffic per time of week bucket in the route's timezone,
+    keyed by day of week * buckets per day + time of day bucket. Keys of a day or of merged days are buckets.
+    """
+    route: Route
+    bucket_sec: int
+    sketches: {int: QuantileSketch}
+
+    def day(self, day_id) -> 'RouteTrafficSketches':
+        num_buckets = DAY // self.bucket_sec
+        return RouteTrafficSketches(self.route, self.bucket_sec,
+                                    {key % num_buckets: sketch for key, sketch in self.sketches.items()
+                                     if key // num_buckets == day_id})
+
+    def merge_days(self) -> 'RouteTrafficSketches':
+        num_buckets = DAY // self.bucket_sec
+        sketches = {}
+        for key, sketch in self.sketches.items():
+            bucket = key % num_buckets
+            sketches[bucket] = sketches[bucket].merge(sketch) if bucket in sketches else sketch
+        return RouteTrafficSketches(self.route, self.bucket_sec, sketches)
+
+    def quantiles(self, qs) -> (np.ndarray, np.ndarray):
+        """
+        Sorted keys of the sketches and their quantiles, one row per quantile.
+        """
+        keys = np.array(sorted(self.sketches), dtype=np.int64)
+        values = np.array([self.sketches[key].quantiles(qs) for key in keys.tolist()]).reshape(len(keys), len(qs))
+        return keys, values.T
+
+
+def rollup_keys(timestamps, bucket_sec: int) -> np.ndarray:
+    """
+    Time of week bucket in UTC of every timestamp: day of week * buckets per day + time of day bucket.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    return ((timestamps // DAY + EPOCH_WEEKDAY) % 7) * (DAY // bucket_sec) + timestamps % DAY // bucket_sec
+
+
+def rollup_stats(timestamps: np.ndarray, durations: np.ndarray, bucket_sec: int) -> np.ndarray:
+    """
+    Rollup statistics of traffic samples, one column per time of week bucket in UTC, see ROLLUP_COLUMNS.
+    """
+    num_keys = 7 * (DAY // bucket_sec)
+    durations = np.asarray(durations, dtype=np.int64)
+    keys = rollup_keys(timestamps, bucket_sec)
+    stats = np.zeros((5, num_keys), dtype=np.int64)
+    stats[0] = np.bincount(keys, minlength=num_keys)
+    stats[1] = np.bincount(keys, weights=durations, minlength=num_keys)
+    stats[2] = np.bincount(keys, weights=durations * durations, minlength=num_keys)
+    stats[3] = np.iinfo(np.int64).max
+    np.minimum.at(stats[3], keys, durations)
+    stats[3, stats[0] == 0] = 0
+    np.maximum.at(stats[4], keys, durations)
+    return stats
+
+
+def make_rollup(route: Route, bucket_sec: int, stats: np.ndarray) -> RouteTrafficRollup:
+    # Move from UTC to the route's timezone, the week wraps around
+    stats = np.roll(stats, route_timezone(route) * HOUR // bucket_sec, axis=1)
+    return RouteTrafficRollup(route, bucket_sec, *stats.reshape(5, 7, DAY // bucket_sec))
+
+
+def make_sketches(route: Route, bucket_sec: int, sketches: {int: QuantileSketch}) -> RouteTrafficSketches:
+    # Same shift as in make_rollup
+    shift = route_timezone(route) * HOUR // bucket_sec
+    num_keys = 7 * (DAY // bucket_sec)
+    return RouteTrafficSketches(route, bucket_sec,
+                                {(key + shift) % num_keys: sketch for key, sketch in sketches.items()})
+
+
+def weekly_timestamp(weekday, hour) -> int:
+    """
+    Timestamp representing an hour of the week in UTC: its middle in the first week after epoch that starts on Monday.
+    """
+    return ((weekday - EPOCH_WEEKDAY) % 7 + 7) * DAY + hour * HOUR + HOUR // 2
+
+
+def tiered_report(route: Route, tier_rows, timestamps, durations) -> RouteTrafficReport:
+    """
+    Prepends rows of compacted traffic (timestamp, num_samples, sum_duration, min_duration, max_duration),
+    ordered by time, to the raw traffic of the route, see RouteTrafficReport.
+    """
+    if len(tier_rows) == 0:
+        return RouteTrafficReport(route=route, timestamps=timestamps, durations=durations)
+    tier_timestamps, tier_durations, tier_weights = [], [], []
+    for timestamp, num_samples, sum_duration, min_duration, max_duration in tier_rows:
+        tier_timestamps += [timestamp] * 3
+        tier_durations += [round(sum_duration / num_samples), min_duration, max_duration]
+        tier_weights += [num_samples, 0, 0]
+    return RouteTrafficReport(route=route,
+                              timestamps=np.concatenate([tier_timestamps, timestamps]).astype(np.int64),
+                              durations=np.concatenate([tier_durations, durations]).astype(np.int32),
+                              weights=np.concatenate([tier_weights, np.ones(len(timestamps))]).astype(np.int64))
+
+
+def weekday_ranges(day_id: int, timezone: int, t_min: int, t_max: int) -> [(int, int)]:
+    """
+    UTC ranges [start, end) of the days of week day_id in the timezone that overlap [t_min, t_max].
+    """
+    offset = timezone * HOUR
+    # Start of the local week of t_min, the epoch is a Thursday
+    week_start = (t_min + offset) // DAY * DAY - local_weekday(t_min, timezone) * DAY - offset
+    return [(day_start, day_start + DAY)
+            for day_start in range(week_start + day_id * DAY, t_max + 1, 7 * DAY)
+            if day_start + DAY > t_min]
+
+
+def day_ranges_filter(s, timestamp, bounds, day_id: int, timezone: int):
+    """
+    Condition on the timestamp column to be on the day of week day_id in the timezone, for rows matching bounds.
+    The days are ranges of timestamps found from the first and the last matching timestamp, so an index on
+    (..., timestamp) reads only their rows.
+    """
+    # Each of them is a single lookup in the index
+    t_min = s.query(func.min(timestamp)).filter(*bounds).scalar()
+    t_max = s.query(func.max(timestamp)).filter(*bounds).scalar()
+    days = [] if t_min is None else weekday_ranges(day_id, timezone, t_min, t_max)
+    if len(days) > MAX_REPORT_DAY_RANGES:
+        # Too many ranges for one statement, all matching rows are read
+        return local_weekday(timestamp, timezone) == day_id
+    return or_(false(), *(and_(timestamp >= start, timestamp < end) for start, end in days))
+
+
+def time_bounds(timestamp, t_from=None, t_to=None) -> list:
+    """
+    Conditions on a timestamp column or array to be in [t_from, t_to), bounds that are None are left out.
+    """
+    bounds = []
+    if t_from is not None:
+        bounds.append(timestamp >= t_from)
+    if t_to is not None:
+        bounds.append(timestamp < t_to)
+    return bounds
+
+
+def fetch_traffic_columns(s, traffic_query) -> (np.ndarray, np.ndarray):
+    """
+    Runs a query selecting timestamps and durations and reads the rows of the database cursor straight into
+    contiguous int64 timestamps and int32 durations, without building a row object per sample.
+    """
+    result = s.execute(traffic_query)
+    values = np.fromiter(itertools.chain.from_iterable(result.cursor), dtype=np.int64).reshape(-1, 2)
+    result.close()
+    return np.ascontiguousarray(values[:, 0]), values[:, 1].astype(np.int32)
+
+
+@dataclass
+class RetentionReport:
+    rows_deleted: int
+    seconds: float
+
+
+@dataclass
+class CompactionReport:
+    raw_rows_folded: int
+    hourly_rows_folded: int
+    seconds: float
 
 
 logger = logging.getLogger('traffic_scanner/storage.py')
 
 MAX_SYMBOLS_IN_STRING = 50
 
-DAY = 24 * 60 * 60
+TRAFFIC_BUFFER_SIZE = 1000
+TRAFFIC_BUFFER_MAX_AGE = 30
+
+RETENTION_CHUNK_SIZE = 5000
+# Days of week reports are read by at most this number of timestamp ranges, one per week
+MAX_REPORT_DAY_RANGES = 100
+
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+DB_POOL_RECYCLE = 30 * 60
+SQLITE_BUSY_TIMEOUT = 30
+
+ROLLUP_BUCKET = 10 * 60
+
+KEEP_HOURLY_DAYS = 90
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+# 1970-01-01 was a Thursday
+EPOCH_WEEKDAY = 3
+
+EXPORT_CHUNK_SIZE = 50000
+
+# Routes added by other processes are seen by the scanner after this number of seconds
+SCAN_TARGETS_TTL = 60
 
 metadata = MetaData()
 
@@ -76,7 +351,8 @@ routes_table = Table(
     Column('start_l1', Float),
     Column('end_l0', Float),
     Column('end_l1', Float),
-    Column('user_id', Integer, ForeignKey('users.user_id'))
+    Column('user_id', Integer, ForeignKey('users.user_id')),
+    Column('scan_period', Integer, nullable=True),
 )
 
 traffic_table = Table(
@@ -84,7 +360,73 @@ traffic_table = Table(
     Column('traffic_id', Integer, primary_key=True),
     Column('route_id', Integer, ForeignKey('routes.route_id')),
     Column('timestamp', Integer),
-    Column('duration_sec', Integer)
+    Column('duration_sec', Integer),
+    Index('ix_traffic_timestamp', 'timestamp'),
+    Index('ix_traffic_route_id_timestamp', 'route_id', 'timestamp'),
+)
+
+# Weekday and bucket are in UTC, so a change of the user's timezone does not invalidate the rollup
+traffic_rollup_table = Table(
+    'traffic_rollup', metadata,
+    Column('route_id', Integer, ForeignKey('routes.route_id'), primary_key=True),
+    Column('weekday', Integer, primary_key=True),
+    Column('bucket', Integer, primary_key=True),
+    Column('num_samples', Integer, nullable=False),
+    Column('sum_duration', BigInteger, nullable=False),
+    Column('sum_sq_duration', BigInteger, nullable=False),
+    Column('min_duration', Integer, nullable=False),
+    Column('max_duration', Integer, nullable=False),
+)
+
+ROLLUP_COLUMNS = ('route_id', 'weekday', 'bucket',
+                  'num_samples', 'sum_duration', 'sum_sq_duration', 'min_duration', 'max_duration')
+
+# Sketches of durations per rollup bucket, see QuantileSketch.to_bytes. Like the rollup they are only appended to
+traffic_sketch_table = Table(
+    'traffic_sketch', metadata,
+    Column('route_id', Integer, ForeignKey('routes.route_id'), primary_key=True),
+    Column('weekday', Integer, primary_key=True),
+    Column('bucket', Integer, primary_key=True),
+    Column('sketch', LargeBinary, nullable=False),
+)
+
+# Traffic older than the raw window is folded by compact_traffic into hours, hours older than the hourly window
+# are folded into hours of the week in UTC, which are kept forever
+traffic_hourly_table = Table(
+    'traffic_hourly', metadata,
+    Column('route_id', Integer, ForeignKey('routes.route_id'), primary_key=True),
+    Column('timestamp', Integer, primary_key=True),
+    Column('num_samples', Integer, nullable=False),
+    Column('sum_duration', BigInteger, nullable=False),
+    Column('min_duration', Integer, nullable=False),
+    Column('max_duration', Integer, nullable=False),
+)
+
+traffic_weekly_table = Table(
+    'traffic_weekly', metadata,
+    Column('route_id', Integer, ForeignKey('routes.route_id'), primary_key=True),
+    Column('weekday', Integer, primary_key=True),
+    Column('hour', Integer, primary_key=True),
+    Column('num_samples', Integer, nullable=False),
+    Column('sum_duration', BigInteger, nullable=False),
+    Column('min_duration', Integer, nullable=False),
+    Column('max_duration', Integer, nullable=False),
+)
+
+TIER_STATS = ('num_samples', 'sum_duration', 'min_duration', 'max_duration')
+
+route_leases_table = Table(
+    'route_leases', metadata,
+    Column('route_id', Integer, ForeignKey('routes.route_id'), primary_key=True),
+    Column('worker_id', String(MAX_SYMBOLS_IN_STRING), nullable=True),
+    Column('expires_at', Integer, nullable=False, default=0),
+)
+
+# Scanner processes alive until expires_at, leases are shared evenly between them
+scanner_workers_table = Table(
+    'scanner_workers', metadata,
+    Column('worker_id', String(MAX_SYMBOLS_IN_STRING), primary_key=True),
+    Column('expires_at', Integer, nullable=False),
 )
 
 mapper(User, users_table)
@@ -92,41 +434,508 @@ mapper(Route, routes_table, properties={'user': relationship(User, backref=backr
 mapper(Traffic, traffic_table,
        properties={'route': relationship(Route, backref=backref('traffic', cascade='all,delete'))})
 
-Session = sessionmaker()
 
+class TrafficBuffer:
+    """
+    Traffic samples waiting to be written by one multi-row insert.
+    """
+
+    def __init__(self):
+        self.route_ids = array('q')
+        self.timestamps = array('q')
+        self.durations = array('q')
+        self.t_first_append = None
+
+    def __len__(self):
+        return len(self.route_ids)
 
-class TrafficStorageSQL:
+    def append(self, route_id, timestamp, duration_sec):
+        if self.t_first_append is None:
+            self.t_first_append = time.monotonic()
+        self.route_ids.append(route_id)
+        self.timestamps.append(timestamp)
+        self.durations.append(duration_sec)
 
-    def __init__(self, db_url):
+    def age(self):
+        return 0 if self.t_first_append is None else time.monotonic() - self.t_first_append
+
+    def rows(self):
+        return [{'route_id': route_id, 'timestamp': timestamp, 'duration_sec': duration_sec}
+                for route_id, timestamp, duration_sec in zip(self.route_ids, self.timestamps, self.durations)]
+
+    def clear(self):
+        self.__init__()
+
+    @staticmethod
+    def from_columns(route_ids, timestamps, durations) -> 'TrafficBuffer':
+        buffer = TrafficBuffer()
+        for column, values in (buffer.route_ids, route_ids), (buffer.timestamps, timestamps), \
+                              (buffer.durations, durations):
+            column.frombytes(np.asarray(values, dtype=np.int64).tobytes())
+        return buffer
+
+
+def upsert(table, merged_values: {str: str}) -> TextClause:
+    """
+    Insert of rows of the table that updates the existing row on a conflict of the primary key instead, or keeps it
+    if merged_values is empty. merged_values are SQL expressions of the columns of the existing row, prefixed by
+    the table's name, and of the inserted row, prefixed by excluded. Supported by SQLite 3.24+ and PostgreSQL.
+    """
+    columns = [column.name for column in table.columns]
+    key_columns = [column.name for column in table.primary_key.columns]
+    if len(merged_values) == 0:
+        on_conflict = 'DO NOTHING'
+    else:
+        on_conflict = 'DO UPDATE SET ' + ', '.join(f'{column} = {value}' for column, value in merged_values.items())
+    return text(f'INSERT INTO {table.name} ({", ".join(columns)}) '
+                f'VALUES ({", ".join(f":{column}" for column in columns)}) '
+                f'ON CONFLICT ({", ".join(key_columns)}) {on_conflict}')
+
+
+def make_engine(db_url, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_recycle=DB_POOL_RECYCLE,
+                sqlite_busy_timeout=SQLITE_BUSY_TIMEOUT):
+    """
+    Server databases get a pool of pool_size connections plus max_overflow more under load.
+    SQLite runs in WAL mode, so readers do not wait for the writer, and writers wait for each other up to
+    sqlite_busy_timeout seconds instead of failing. An in-memory SQLite database is one connection shared by threads,
+    so TrafficStorageSQL runs their sessions one at a time.
+    """
+    url = make_url(db_url)
+    if url.get_backend_name() != 'sqlite':
+        return create_engine(url, echo=False, pool_size=pool_size, max_overflow=max_overflow,
+                             pool_recycle=pool_recycle, pool_pre_ping=True)
+
+    if url.database in (None, '', ':memory:'):
+        engine = create_engine(url, echo=False, poolclass=StaticPool, connect_args={'check_same_thread': False})
+    else:
+        engine = create_engine(url, echo=False, connect_args={'timeout': sqlite_busy_timeout})
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA busy_timeout={int(sqlite_busy_timeout * 1000)}')
+        cursor.close()
+
+    return engine
+
+
+def migrate(engine) -> {str}:
+    """
+    Creates missing tables, columns and indexes. Returns names of the created tables.
+    """
+    existing_tables = set(inspect(engine).get_table_names())
+    metadata.create_all(engine)
+    inspector = inspect(engine)
+    for table in metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(dialect=engine.dialect)
+                logger.info(f'Adding column {table.name}.{column.name}')
+                engine.execute(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                logger.info(f'Creating index {index.name}')
+                index.create(engine)
+    return {table.name for table in metadata.sorted_tables} - existing_tables
+
+
+class TrafficStorage(ABC):
+    """
+    Storage of users, routes and their traffic used by the scanner and the bot.
+    Every call takes the session `s` yielded by session_scope, the transaction it runs in.
+    """
+
+    # Incremented when rollups and sketches are rebuilt or imported rather than appended to, plots of them are stale
+    rollups_version = 0
+
+    def invalidate_rollups(self) -> None:
+        self.rollups_version += 1
+
+    @abstractmethod
+    def session_scope(self):
+        pass
+
+    @abstractmethod
+    def get_route(self, user_id, route_id, s) -> Route:
+        pass
+
+    @abstractmethod
+    def get_routes(self, user_id, s) -> [Route]:
+        pass
+
+    @abstractmethod
+    def get_scan_targets(self, s) -> [ScanTarget]:
+        pass
+
+    @abstractmethod
+    def get_last_scan_timestamps(self, s) -> {int: int}:
+        pass
+
+    @abstractmethod
+    def get_last_scan_timestamp(self, route_id, s) -> Optional[int]:
+        pass
+
+    @abstractmethod
+    def add_route(self, start_coords, end_coords, title, user_id, s) -> Route:
+        pass
+
+    @abstractmethod
+    def remove_route(self, user_id, route_id, s) -> None:
+        pass
+
+    @abstractmethod
+    def rename_route(self, user_id, route_id: str, new_name: str, s) -> None:
+        pass
+
+    @abstractmethod
+    def set_route_scan_period(self, user_id, route_id, scan_period: Optional[int], s) -> None:
+        pass
+
+    @abstractmethod
+    def append_traffic(self, route, duration_sec, s) -> None:
+        pass
+
+    @abstractmethod
+    def flush_traffic(self, s) -> None:
+        pass
+
+    @abstractmethod
+    def make_report(self, route, s, t_from=None, t_to=None) -> RouteTrafficReport:
+        pass
+
+    @abstractmethod
+    def make_report_day(self, route: Route, s, day_id: int, t_from=None, t_to=None) -> RouteTrafficReport:
+        pass
+
+    @abstractmethod
+    def get_rollup(self, route, s) -> RouteTrafficRollup:
+        pass
+
+    def get_rollups(self, routes, s) -> [RouteTrafficRollup]:
+        return [self.get_rollup(route, s) for route in routes]
+
+    @abstractmethod
+    def get_sketches(self, route, s) -> RouteTrafficSketches:
+        pass
+
+    @abstractmethod
+    def sync_leases(self, route_ids, s) -> None:
+        pass
+
+    @abstractmethod
+    def claim_routes(self, worker_id, max_routes, lease_ttl, s) -> [int]:
+        pass
+
+    @abstractmethod
+    def release_routes(self, worker_id, s) -> None:
+        pass
+
+    @abstractmethod
+    def delete_old_traffic_entries(self, keep_days: int) -> RetentionReport:
+        pass
+
+    @abstractmethod
+    def compact_traffic(self, keep_days: int, keep_hourly_days=KEEP_HOURLY_DAYS) -> CompactionReport:
+        pass
+
+
+class TrafficStorageSQL(TrafficStorage):
+
+    def __init__(self, db_url, buffer_size=TRAFFIC_BUFFER_SIZE, buffer_max_age=TRAFFIC_BUFFER_MAX_AGE,
+                 rollup_bucket=ROLLUP_BUCKET, scan_targets_ttl=SCAN_TARGETS_TTL, **engine_options):
+        assert HOUR % rollup_bucket == 0, 'Timezone shifts must be whole buckets'
         logger.info(f'Using database path: {db_url}')
-        engine = create_engine(db_url, echo=False)
-        metadata.create_all(engine)
-        Session.configure(bind=engine)
+        self.engine = make_engine(db_url, **engine_options)
+        created_tables = migrate(self.engine)
+        # Every thread gets its own session. Objects stay readable after their session is closed,
+        # so the scanner can keep its routes across the transactions of one cycle
+        self.Session = scoped_session(sessionmaker(bind=self.engine, expire_on_commit=False))
+        # A commit or rollback on the shared connection of an in-memory database would end the transactions
+        # of all threads, so their sessions do not interleave
+        self.session_lock = threading.RLock() if isinstance(self.engine.pool, StaticPool) else None
+        self.buffer_size: int = buffer_size
+        self.buffer_max_age: float = buffer_max_age
+        self.rollup_bucket: int = rollup_bucket
+        self.scan_targets_ttl: float = scan_targets_ttl
+        self.scan_targets = None
+        self.t_scan_targets = -1
+        # Incremented on every change of routes, a list loaded before a change is not cached
+        self.routes_version = 0
+        # The rollup keeps statistics of traffic that was compacted or deleted, it is only built with its table
+        if traffic_rollup_table.name in created_tables:
+            with self.session_scope() as s:
+                self.rebuild_rollups(s)
+        elif traffic_sketch_table.name in created_tables:
+            with self.session_scope() as s:
+                self.rebuild_sketches(s)
 
     @contextmanager
     def session_scope(self):
-        session = Session()
-        try:
-            yield session
-            session.commit()
-        except Exception as e:
-            session.rollback()
-            raise e
-        finally:
-            session.close()
+        """
+        A transaction of the calling thread's session. Must not be nested within one thread.
+        """
+        with self.session_lock or nullcontext():
+            session = self.Session()
+            try:
+                yield session
+                self.flush_traffic(session)
+                session.commit()
+                if session.info.get('routes_changed'):
+                    self.invalidate_scan_targets()
+                if session.info.get('rollups_changed'):
+                    self.invalidate_rollups()
+            except Exception as e:
+                session.rollback()
+                raise e
+            finally:
+                self.Session.remove()
 
     def get_route(self, user_id, route_id, s) -> Route:
-        route_query = s.query(Route).filter_by(user_id=user_id, route_id=route_id)
+        route_query = s.query(Route).options(joinedload(Route.user)).filter_by(user_id=user_id, route_id=route_id)
         return route_query.first()
 
     def get_routes(self, user_id, s) -> [Route]:
-        routes_query = s.query(Route)
+        # Reports read the timezone of the user, which is loaded by the same query
+        routes_query = s.query(Route).options(joinedload(Route.user))
         if user_id is None:
             return routes_query.all()
         return routes_query.filter_by(user_id=user_id).all()
 
+    def get_scan_targets(self, s) -> [ScanTarget]:
+        """
+        Routes to scan, cached until routes are changed through this storage or for scan_targets_ttl seconds.
+        """
+        if self.scan_targets is None or time.monotonic() - self.t_scan_targets > self.scan_targets_ttl:
+            routes_version = self.routes_version
+            routes = routes_table.c
+            scan_targets = [ScanTarget(*row) for row in s.execute(select([routes.route_id,
+                                                                          routes.start_l0, routes.start_l1,
+                                                                          routes.end_l0, routes.end_l1,
+                                                                          routes.scan_period]))]
+            if routes_version != self.routes_version:
+                return scan_targets
+            self.scan_targets, self.t_scan_targets = scan_targets, time.monotonic()
+        return self.scan_targets
+
+    def invalidate_scan_targets(self) -> None:
+        self.routes_version += 1
+        self.scan_targets = None
+
+    @staticmethod
+    def _routes_changed(s) -> None:
+        # The cached scan targets are dropped when the session is committed
+        s.info['routes_changed'] = True
+
+    def get_last_scan_timestamps(self, s) -> {int: int}:
+        last_scans = s.query(traffic_table.c.route_id, func.max(traffic_table.c.timestamp)) \
+            .group_by(traffic_table.c.route_id)
+        return dict(last_scans.all())
+
+    def get_last_scan_timestamp(self, route_id, s) -> Optional[int]:
+        self.flush_traffic(s)
+        return s.query(func.max(traffic_table.c.timestamp)).filter(traffic_table.c.route_id == route_id).scalar()
+
+    @staticmethod
+    def _traffic_buffer(s) -> TrafficBuffer:
+        # Every session has its own buffer, so samples are written in the transaction of the session that made them
+        return s.info.setdefault('traffic_buffer', TrafficBuffer())
+
     def append_traffic(self, route, duration_sec, s) -> None:
-        s.add(Traffic(route=route, timestamp=int(time.time()), duration_sec=duration_sec))
+        if route.route_id is None:
+            s.flush()
+        buffer = self._traffic_buffer(s)
+        buffer.append(route.route_id, int(time.time()), duration_sec)
+        if len(buffer) >= self.buffer_size or buffer.age() >= self.buffer_max_age:
+            self.flush_traffic(s)
+
+    def flush_traffic(self, s) -> None:
+        buffer = self._traffic_buffer(s)
+        if len(buffer) == 0:
+            return
+        self._write_traffic(buffer, s)
+        self._update_rollups(buffer, s)
+        self._update_sketches(buffer, s)
+        buffer.clear()
+
+    def _write_traffic(self, buffer: TrafficBuffer, s) -> None:
+        s.execute(traffic_table.insert(), buffer.rows())
+
+    def iter_traffic(self, chunk_size=EXPORT_CHUNK_SIZE) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Yields the raw traffic of all routes as chunks of route ids, timestamps and durations, ordered by route
+        and time. Rows are streamed from a server side cursor, so the memory use does not depend on the table size.
+        """
+        traffic = traffic_table.c
+        with self.engine.connect() as connection:
+            result = connection.execution_options(stream_results=True) \
+                .execute(select([traffic.route_id, traffic.timestamp, traffic.duration_sec])
+                         .order_by(traffic.route_id, traffic.timestamp))
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if len(rows) == 0:
+                    break
+                yield tuple(np.array(rows, dtype=np.int64).T)
+
+    def import_traffic(self, route_ids, timestamps, durations, s) -> None:
+        """
+        Writes a chunk of raw traffic by one multi-row insert. Rollups are not updated, see rebuild_rollups.
+        """
+        self._write_traffic(TrafficBuffer.from_columns(route_ids, timestamps, durations), s)
+
+    def _update_rollups(self, buffer: TrafficBuffer, s) -> None:
+        stats = {}
+        for route_id, timestamp, duration in zip(buffer.route_ids, buffer.timestamps, buffer.durations):
+            key = route_id, (timestamp // DAY + EPOCH_WEEKDAY) % 7, timestamp % DAY // self.rollup_bucket
+            num_samples, sum_duration, sum_sq_duration, min_duration, max_duration = \
+                stats.get(key, (0, 0, 0, duration, duration))
+            stats[key] = (num_samples + 1, sum_duration + duration, sum_sq_duration + duration * duration,
+                          min(min_duration, duration), max(max_duration, duration))
+
+        self._merge_stats(traffic_rollup_table, [key + key_stats for key, key_stats in stats.items()], s)
+
+    @staticmethod
+    def _merge_stats(table, rows, s) -> None:
+        """
+        Adds rows of statistics with distinct primary keys to the table, merging them into the existing rows
+        with the same keys. Columns named min_* and max_* are merged by min and max, others are summed.
+        Every row is merged by one upsert, so concurrent writers of the same keys do not conflict.
+        """
+        if len(rows) == 0:
+            return
+        merged_values = {}
+        for column in table.columns:
+            if column.primary_key:
+                continue
+            current, new = f'{table.name}.{column.name}', f'excluded.{column.name}'
+            if column.name.startswith('min_'):
+                merged_values[column.name] = f'CASE WHEN {current} < {new} THEN {current} ELSE {new} END'
+            elif column.name.startswith('max_'):
+                merged_values[column.name] = f'CASE WHEN {current} > {new} THEN {current} ELSE {new} END'
+            else:
+                merged_values[column.name] = f'{current} + {new}'
+        columns = [column.name for column in table.columns]
+        s.execute(upsert(table, merged_values), [dict(zip(columns, row)) for row in rows])
+
+    def _update_sketches(self, buffer: TrafficBuffer, s) -> None:
+        num_keys = 7 * (DAY // self.rollup_bucket)
+        route_ids = np.frombuffer(buffer.route_ids, dtype=np.int64)
+        keys = route_ids * num_keys + rollup_keys(np.frombuffer(buffer.timestamps, dtype=np.int64), self.rollup_bucket)
+        self._merge_sketches(group_sketches(keys, np.frombuffer(buffer.durations, dtype=np.int64)), s)
+
+    def _merge_sketches(self, sketches: {int: QuantileSketch}, s) -> None:
+        """
+        Merges sketches keyed by route_id * time of week buckets + time of week bucket into the stored ones.
+        Missing rows are inserted empty first, so concurrent writers of the same keys update them one after another.
+        """
+        if len(sketches) == 0:
+            return
+        num_buckets = DAY // self.rollup_bucket
+        rows = {(key // (7 * num_buckets), key // num_buckets % 7, key % num_buckets): sketch
+                for key, sketch in sketches.items()}
+        s.execute(upsert(traffic_sketch_table, {}), [{'route_id': route_id, 'weekday': weekday, 'bucket': bucket,
+                                                      'sketch': b''} for route_id, weekday, bucket in rows])
+        sketch_table = traffic_sketch_table.c
+        # Locked until the commit, SQLite locks the whole database by the insert
+        existing_rows = s.query(sketch_table.route_id, sketch_table.weekday, sketch_table.bucket, sketch_table.sketch) \
+            .filter(sketch_table.route_id.in_({key[0] for key in rows}),
+                    sketch_table.weekday.in_({key[1] for key in rows}),
+                    sketch_table.bucket.in_({key[2] for key in rows})) \
+            .with_for_update()
+        updates = []
+        for route_id, weekday, bucket, data in existing_rows:
+            sketch = rows.get((route_id, weekday, bucket))
+            if sketch is not None:
+                updates.append({'b_route_id': route_id, 'b_weekday': weekday, 'b_bucket': bucket,
+                                'sketch': QuantileSketch.from_bytes(data).merge(sketch).to_bytes()})
+        s.execute(traffic_sketch_table.update()
+                  .where(and_(sketch_table.route_id == bindparam('b_route_id'),
+                              sketch_table.weekday == bindparam('b_weekday'),
+                              sketch_table.bucket == bindparam('b_bucket'))),
+                  updates)
+
+    def _route_traffic_columns(self, route_id, s) -> (np.ndarray, np.ndarray):
+        traffic = traffic_table.c
+        return fetch_traffic_columns(s, select([traffic.timestamp, traffic.duration_sec])
+                                     .where(traffic.route_id == route_id))
+
+    def _route_ids_with_traffic(self, s) -> [int]:
+        return [route_id for route_id, in s.execute(select([traffic_table.c.route_id]).distinct())]
+
+    def rebuild_sketches(self, s, route_id=None) -> None:
+        """
+        Recomputes the sketches from the raw traffic of one or all routes.
+        """
+        self.flush_traffic(s)
+        # Cached plots are dropped when the session is committed
+        s.info['rollups_changed'] = True
+        delete_query = traffic_sketch_table.delete()
+        if route_id is not None:
+            delete_query = delete_query.where(traffic_sketch_table.c.route_id == route_id)
+        s.execute(delete_query)
+        num_keys = 7 * (DAY // self.rollup_bucket)
+        for rebuilt_route_id in ([route_id] if route_id is not None else self._route_ids_with_traffic(s)):
+            timestamps, durations = self._route_traffic_columns(rebuilt_route_id, s)
+            keys = rebuilt_route_id * num_keys + rollup_keys(timestamps, self.rollup_bucket)
+            self._merge_sketches(group_sketches(keys, durations), s)
+
+    def get_sketches(self, route, s) -> RouteTrafficSketches:
+        self.flush_traffic(s)
+        num_buckets = DAY // self.rollup_bucket
+        sketch_table = traffic_sketch_table.c
+        rows = s.query(sketch_table.weekday, sketch_table.bucket, sketch_table.sketch) \
+            .filter(sketch_table.route_id == route.route_id)
+        return make_sketches(route, self.rollup_bucket, {weekday * num_buckets + bucket: QuantileSketch.from_bytes(data)
+                                                         for weekday, bucket, data in rows})
+
+    def rebuild_rollups(self, s, route_id=None) -> None:
+        """
+        Recomputes the rollup and the sketches from the raw traffic of one or all routes.
+        The rollup is only appended to, so it keeps statistics of samples that were removed by retention
+        or folded by compaction until rebuilt.
+        """
+        self.flush_traffic(s)
+        traffic = traffic_table.c
+        duration = cast(traffic.duration_sec, BigInteger)
+        weekday = (traffic.timestamp / DAY + EPOCH_WEEKDAY) % 7
+        bucket = traffic.timestamp % DAY / self.rollup_bucket
+        rollup_query = select([traffic.route_id, weekday, bucket,
+                               func.count(), func.sum(duration), func.sum(duration * duration),
+                               func.min(traffic.duration_sec), func.max(traffic.duration_sec)]) \
+            .group_by(traffic.route_id, weekday, bucket)
+        delete_query = traffic_rollup_table.delete()
+        if route_id is not None:
+            rollup_query = rollup_query.where(traffic.route_id == route_id)
+            delete_query = delete_query.where(traffic_rollup_table.c.route_id == route_id)
+        s.execute(delete_query)
+        s.execute(traffic_rollup_table.insert().from_select(ROLLUP_COLUMNS, rollup_query))
+        self.rebuild_sketches(s, route_id)
+
+    def get_rollup(self, route, s) -> RouteTrafficRollup:
+        return self.get_rollups([route], s)[0]
+
+    def get_rollups(self, routes, s) -> [RouteTrafficRollup]:
+        """
+        Rollups of several routes, read by one query.
+        """
+        self.flush_traffic(s)
+        rollup = traffic_rollup_table.c
+        num_buckets = DAY // self.rollup_bucket
+        route_ids = np.array([route.route_id for route in routes], dtype=np.int64)
+        stats = np.zeros((len(routes), 5, 7 * num_buckets), dtype=np.int64)
+        rows = s.query(rollup.route_id, rollup.weekday, rollup.bucket, rollup.num_samples, rollup.sum_duration,
+                       rollup.sum_sq_duration, rollup.min_duration, rollup.max_duration) \
+            .filter(rollup.route_id.in_(route_ids.tolist())).all()
+        if len(rows) > 0:
+            rows = np.array(rows, dtype=np.int64)
+            # Scatter the rows of all routes into their arrays at once
+            order = np.argsort(route_ids)
+            route_indices = order[np.searchsorted(route_ids[order], rows[:, 0])]
+            stats[route_indices, :, rows[:, 1] * num_buckets + rows[:, 2]] = rows[:, 3:]
+        return [make_rollup(route, self.rollup_bucket, route_stats) for route, route_stats in zip(routes, stats)]
 
     def add_route(self, start_coords, end_coords, title, user_id, s) -> Route:
         user = s.query(User).filter_by(user_id=user_id).first()
@@ -139,33 +948,218 @@ class TrafficStorageSQL:
                       title=title,
                       user=user)
         s.add(route)
+        self._routes_changed(s)
         return route
 
     def remove_route(self, user_id, route_id, s) -> None:
         route = self.get_route(user_id=user_id, route_id=route_id, s=s)
         if route is not None:
+            self.flush_traffic(s)
+            s.execute(route_leases_table.delete().where(route_leases_table.c.route_id == route.route_id))
+            for table in traffic_rollup_table, traffic_sketch_table, traffic_hourly_table, traffic_weekly_table:
+                s.execute(table.delete().where(table.c.route_id == route.route_id))
             s.delete(route)
+            self._routes_changed(s)
+
+    def sync_leases(self, route_ids, s) -> None:
+        """
+        Makes the leasable routes exactly route_ids, creating free leases of the new ones.
+        """
+        leases = route_leases_table.c
+        route_ids = set(route_ids)
+        existing = {route_id for route_id, in s.query(leases.route_id)}
+        if len(existing - route_ids) > 0:
+            s.execute(route_leases_table.delete().where(leases.route_id.in_(existing - route_ids)))
+        if len(route_ids - existing) > 0:
+            s.execute(route_leases_table.insert(), [{'route_id': route_id, 'worker_id': None, 'expires_at': 0}
+                                                    for route_id in sorted(route_ids - existing)])
+
+    def claim_routes(self, worker_id, max_routes, lease_ttl, s) -> [int]:
+        """
+        Extends the leases held by the worker and claims free or expired leases until the worker holds its share:
+        all leases divided by the number of live workers, at most max_routes. Leases over the share are freed,
+        so a new worker gets routes once the others renew their leases.
+        Claiming is a conditional update, so concurrent workers never hold the same route.
+        Returns the ids of all routes leased by the worker.
+        """
+        now = int(time.time())
+        workers = scanner_workers_table.c
+        # Only this worker writes its row
+        if s.execute(scanner_workers_table.update().where(workers.worker_id == worker_id)
+                     .values(expires_at=now + lease_ttl)).rowcount == 0:
+            s.execute(scanner_workers_table.insert(), {'worker_id': worker_id, 'expires_at': now + lease_ttl})
+        num_workers = s.query(workers.worker_id).filter(workers.expires_at >= now).count()
+        leases = route_leases_table.c
+        max_routes = min(max_routes, -(-s.query(leases.route_id).count() // num_workers))
+
+        s.execute(route_leases_table.update().where(leases.worker_id == worker_id).values(expires_at=now + lease_ttl))
+        owned = [route_id for route_id, in s.query(leases.route_id).filter(leases.worker_id == worker_id)
+                 .order_by(leases.route_id)]
+        if len(owned) > max_routes:
+            s.execute(route_leases_table.update()
+                      .where(leases.route_id.in_(owned[max_routes:]))
+                      .values(worker_id=None, expires_at=0))
+        elif len(owned) < max_routes:
+            candidates = [route_id for route_id, in s.query(leases.route_id)
+                          .filter(leases.expires_at < now)
+                          .order_by(leases.expires_at)
+                          .limit(max_routes - len(owned))]
+            if len(candidates) > 0:
+                s.execute(route_leases_table.update()
+                          .where(leases.route_id.in_(candidates))
+                          .where(leases.expires_at < now)
+                          .values(worker_id=worker_id, expires_at=now + lease_ttl))
+        return [route_id for route_id, in s.query(leases.route_id).filter(leases.worker_id == worker_id)]
 
-    def make_report(self, route, s) -> RouteTrafficReport:
-        traffic_report = s.query(Traffic).filter_by(route=route)
-        traffic_entities: [Traffic] = traffic_report.all()
-        return RouteTrafficReport(route=route,
-                                  timestamps=tuple(map(lambda x: x.timestamp, traffic_entities)),
-                                  durations=tuple(map(lambda x: x.duration_sec, traffic_entities)))
+    def release_routes(self, worker_id, s) -> None:
+        s.execute(route_leases_table.update()
+                  .where(route_leases_table.c.worker_id == worker_id)
+                  .values(worker_id=None, expires_at=0))
+        s.execute(scanner_workers_table.delete().where(scanner_workers_table.c.worker_id == worker_id))
+
+    def make_report(self, route, s, t_from=None, t_to=None) -> RouteTrafficReport:
+        """
+        Traffic of the route with timestamps in [t_from, t_to) if given.
+        """
+        self.flush_traffic(s)
+        traffic = traffic_table.c
+        traffic_query = select([traffic.timestamp, traffic.duration_sec]) \
+            .where(and_(traffic.route_id == route.route_id, *time_bounds(traffic.timestamp, t_from, t_to))) \
+            .order_by(traffic.timestamp)
+        timestamps, durations = fetch_traffic_columns(s, traffic_query)
+        return self._merge_tiers(route, s, timestamps=timestamps, durations=durations, t_from=t_from, t_to=t_to)
+
+    def _merge_tiers(self, route, s, timestamps, durations, day_id=None, t_from=None, t_to=None) \
+            -> RouteTrafficReport:
+        """
+        Prepends the compacted traffic of the route, on the day of week day_id in the route's timezone if given,
+        to its raw traffic. Hours of the week have no date, reports bounded by t_from leave them out.
+        """
+        timezone = route_timezone(route)
+        hourly = traffic_hourly_table.c
+        hourly_bounds = [hourly.route_id == route.route_id, *time_bounds(hourly.timestamp, t_from, t_to)]
+        hourly_query = s.query(hourly.timestamp + HOUR // 2, *(hourly[column] for column in TIER_STATS)) \
+            .filter(*hourly_bounds) \
+            .order_by(hourly.timestamp)
+        if day_id is not None:
+            hourly_query = hourly_query.filter(day_ranges_filter(s, hourly.timestamp, hourly_bounds, day_id, timezone))
+        if t_from is not None:
+            return tiered_report(route, hourly_query.all(), timestamps, durations)
+        weekly = traffic_weekly_table.c
+        weekly_rows = [(weekly_timestamp(weekday, hour),) + tuple(stats)
+                       for weekday, hour, *stats in s.query(weekly.weekday, weekly.hour,
+                                                             *(weekly[column] for column in TIER_STATS))
+                       .filter(weekly.route_id == route.route_id)]
+        if day_id is not None:
+            weekly_rows = [row for row in weekly_rows if local_weekday(row[0], timezone) == day_id]
+        return tiered_report(route, sorted(weekly_rows) + hourly_query.all(), timestamps, durations)
 
     def rename_route(self, user_id, route_id: str, new_name: str, s) -> None:
         route = self.get_route(user_id=user_id, route_id=route_id, s=s)
         if route is not None:
             route.title = new_name
+            self._routes_changed(s)
+
+    def set_route_scan_period(self, user_id, route_id, scan_period: Optional[int], s) -> None:
+        route = self.get_route(user_id=user_id, route_id=route_id, s=s)
+        if route is not None:
+            route.scan_period = scan_period
+            self._routes_changed(s)
+
+    def delete_old_traffic_entries(self, keep_days: int, chunk_size=RETENTION_CHUNK_SIZE,
+                                   vacuum=False) -> RetentionReport:
+        """
+        Deletes traffic older than keep_days of every route. Rows are deleted in chunks of chunk_size,
+        each in its own transaction, so the table is never locked for long.
+        With vacuum SQLite returns the freed pages to the file system afterwards.
+        """
+        t0 = time.time()
+        min_timestamp = int(t0) - keep_days * DAY
+        old_traffic = select([traffic_table.c.traffic_id]) \
+            .where(traffic_table.c.timestamp < min_timestamp) \
+            .limit(chunk_size)
+        rows_deleted = 0
+        while True:
+            with self.session_scope() as s:
+                result = s.execute(traffic_table.delete().where(traffic_table.c.traffic_id.in_(old_traffic)))
+            rows_deleted += result.rowcount
+            if result.rowcount < chunk_size:
+                break
+        if vacuum and self.engine.dialect.name == 'sqlite':
+            self.vacuum_sqlite()
+        report = RetentionReport(rows_deleted=rows_deleted, seconds=time.time() - t0)
+        logger.info(f'Deleted {report.rows_deleted} traffic entries in {report.seconds:.2f} seconds.')
+        return report
+
+    def compact_traffic(self, keep_days: int, keep_hourly_days=KEEP_HOURLY_DAYS) -> CompactionReport:
+        """
+        Folds raw traffic older than keep_days into hours and hours older than keep_hourly_days into hours
+        of the week. Only whole hours are folded. Raw traffic that arrives later for a folded hour, imported or scanned
+        by a worker with a skewed clock, is merged into it by the next compaction.
+        """
+        t0 = time.time()
+        now = int(t0)
+        raw_rows_folded = self._fold_raw_traffic(now - now % HOUR - keep_days * DAY)
+        hourly_rows_folded = self._fold_hourly_traffic(now - now % HOUR - keep_hourly_days * DAY)
+        report = CompactionReport(raw_rows_folded=raw_rows_folded, hourly_rows_folded=hourly_rows_folded,
+                                  seconds=time.time() - t0)
+        logger.info(f'Folded {report.raw_rows_folded} traffic entries and {report.hourly_rows_folded} hours '
+                    f'in {report.seconds:.2f} seconds.')
+        return report
+
+    def _fold_raw_traffic(self, min_timestamp) -> int:
+        """
+        Folds raw traffic older than min_timestamp into traffic_hourly a day at a time, each in its own transaction.
+        """
+        traffic = traffic_table.c
+        with self.session_scope() as s:
+            t_first = s.query(func.min(traffic.timestamp)).scalar()
+        if t_first is None:
+            return 0
+        duration = cast(traffic.duration_sec, BigInteger)
+        hour = traffic.timestamp - traffic.timestamp % HOUR
+        rows_folded = 0
+        for t_start in range(t_first - t_first % HOUR, min_timestamp, DAY):
+            window = and_(traffic.timestamp >= t_start, traffic.timestamp < min(t_start + DAY, min_timestamp))
+            hourly_query = select([traffic.route_id, hour, func.count(), func.sum(duration),
+                                   func.min(traffic.duration_sec), func.max(traffic.duration_sec)]) \
+                .where(window) \
+                .group_by(traffic.route_id, hour)
+            with self.session_scope() as s:
+                self._merge_stats(traffic_hourly_table, [tuple(map(int, row)) for row in s.execute(hourly_query)], s)
+                rows_folded += s.execute(traffic_table.delete().where(window)).rowcount
+        return rows_folded
+
+    def _fold_hourly_traffic(self, min_timestamp) -> int:
+        hourly = traffic_hourly_table.c
+        weekday = (hourly.timestamp / DAY + EPOCH_WEEKDAY) % 7
+        hour = hourly.timestamp % DAY / HOUR
+        with self.session_scope() as s:
+            weekly_rows = s.query(hourly.route_id, weekday, hour,
+                                  func.sum(hourly.num_samples), func.sum(hourly.sum_duration),
+                                  func.min(hourly.min_duration), func.max(hourly.max_duration)) \
+                .filter(hourly.timestamp < min_timestamp) \
+                .group_by(hourly.route_id, weekday, hour) \
+                .all()
+            self._merge_stats(traffic_weekly_table, [tuple(map(int, row)) for row in weekly_rows], s)
+            return s.execute(traffic_hourly_table.delete().where(hourly.timestamp < min_timestamp)).rowcount
+
+    def vacuum_sqlite(self) -> None:
+        incremental = self.engine.execute('PRAGMA auto_vacuum').scalar() == 2
+        self.engine.execute('PRAGMA incremental_vacuum' if incremental else 'VACUUM')
 
-    def delete_old_traffic_entries(self, s, route: Route, keep_days: int) -> None:
-        traffic_to_delete = s.query(Traffic).filter(Traffic.route == route, Traffic.timestamp == keep_days * DAY)
-        traffic_to_delete.delete()
-
-    def make_report_day(self, route: Route, s, day_id: int) -> RouteTrafficReport:
-        traffic_report = s.query(Traffic).filter_by(route=route)
-        traffic_entities: [Traffic] = traffic_report.all()
-        traffic_entities = [traffic for traffic in traffic_entities if datetime.fromtimestamp(traffic.timestamp + route.user.timezone).weekday() == day_id]
-        return RouteTrafficReport(route=route,
-                                  timestamps=tuple(map(lambda x: x.timestamp, traffic_entities)),
-                                  durations=tuple(map(lambda x: x.duration_sec, traffic_entities)))
+    def make_report_day(self, route: Route, s, day_id: int, t_from=None, t_to=None) -> RouteTrafficReport:
+        """
+        Traffic of the route on one day of week in the route's timezone, with timestamps in [t_from, t_to) if given.
+        The days are selected by ranges of timestamps, so only their rows are read by the index.
+        """
+        self.flush_traffic(s)
+        traffic = traffic_table.c
+        route_bounds = [traffic.route_id == route.route_id, *time_bounds(traffic.timestamp, t_from, t_to)]
+        day_filter = day_ranges_filter(s, traffic.timestamp, route_bounds, day_id, route_timezone(route))
+        traffic_query = select([traffic.timestamp, traffic.duration_sec]) \
+            .where(and_(*route_bounds, day_filter)) \
+            .order_by(traffic.timestamp)
+        timestamps, durations = fetch_traffic_columns(s, traffic_query)
+        return self._merge_tiers(route, s, timestamps=timestamps, durations=durations, day_id=day_id,
+                                 t_from=t_from, t_to=t_to)
@@ -0,0 +1,200 @@
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from traffic_scanner.storage import TrafficStorageSQL, TrafficBuffer, RouteTrafficReport, RetentionReport, Route, \
+    traffic_rollup_table, traffic_hourly_table, route_timezone, local_weekday, rollup_stats, ROLLUP_COLUMNS, \
+    DAY, HOUR, RETENTION_CHUNK_SIZE, EXPORT_CHUNK_SIZE
+
+logger = logging.getLogger('traffic_scanner/storage_columnar.py')
+
+TIMESTAMP_DTYPE = np.dtype('<i8')
+DURATION_DTYPE = np.dtype('<i4')
+
+
+class TrafficStorageColumnar(TrafficStorageSQL):
+    """
+    Keeps users, routes and rollups in the SQL database and the traffic of every route in two append-only
+    binary column files in data_dir: `<route_id>.ts` with int64 timestamps and `<route_id>.dur` with int32
+    durations. Reports memory-map the files, so they are read into NumPy without copying.
+
+    Samples are written to the files when the traffic buffer is flushed and are not rolled back with the session.
+    """
+
+    def __init__(self, db_url, data_dir, **kwargs):
+        self.data_dir = data_dir
+        self.files_lock = threading.Lock()
+        os.makedirs(data_dir, exist_ok=True)
+        super().__init__(db_url, **kwargs)
+
+    def _column_paths(self, route_id):
+        prefix = os.path.join(self.data_dir, str(route_id))
+        return prefix + '.ts', prefix + '.dur'
+
+    def _route_ids_with_traffic(self, s=None) -> [int]:
+        return [int(name[:-len('.ts')]) for name in os.listdir(self.data_dir) if name.endswith('.ts')]
+
+    def _route_traffic_columns(self, route_id, s) -> (np.ndarray, np.ndarray):
+        return self.read_columns(route_id)
+
+    def read_columns(self, route_id, t_from=None, t_to=None) -> (np.ndarray, np.ndarray):
+        """
+        Memory-mapped timestamps and durations of the route, in [t_from, t_to) if given.
+        """
+        timestamps_path, durations_path = self._column_paths(route_id)
+        columns = []
+        for path, dtype in (timestamps_path, TIMESTAMP_DTYPE), (durations_path, DURATION_DTYPE):
+            # An append in progress or cut by a crash leaves a part of the last value, it is not mapped
+            num_values = os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0
+            if num_values == 0:
+                return np.empty(0, TIMESTAMP_DTYPE), np.empty(0, DURATION_DTYPE)
+            columns.append(np.memmap(path, dtype=dtype, mode='r', shape=(num_values,)))
+        # A crash between the two appends leaves one column longer
+        length = min(map(len, columns))
+        timestamps = columns[0][:length]
+        start = 0 if t_from is None else int(np.searchsorted(timestamps, t_from))
+        end = length if t_to is None else int(np.searchsorted(timestamps, t_to))
+        return columns[0][start:end], columns[1][start:end]
+
+    def _truncate_columns(self, route_id) -> None:
+        """
+        Cuts both files of the route to the samples they both hold whole, so the next append starts aligned after
+        a crash in the middle of an append or between the appends of the two files. Called under files_lock.
+        """
+        paths = self._column_paths(route_id)
+        dtypes = TIMESTAMP_DTYPE, DURATION_DTYPE
+        sizes = [os.path.getsize(path) if os.path.exists(path) else 0 for path in paths]
+        length = min(size // dtype.itemsize for size, dtype in zip(sizes, dtypes))
+        for path, size, dtype in zip(paths, sizes, dtypes):
+            if size > length * dtype.itemsize:
+                logger.warning(f'Truncating {path} from {size} to {length * dtype.itemsize} bytes.')
+                os.truncate(path, length * dtype.itemsize)
+
+    def _write_traffic(self, buffer: TrafficBuffer, s) -> None:
+        route_ids = np.frombuffer(buffer.route_ids, dtype=np.int64)
+        timestamps = np.frombuffer(buffer.timestamps, dtype=np.int64)
+        durations = np.frombuffer(buffer.durations, dtype=np.int64)
+        with self.files_lock:
+            for route_id in np.unique(route_ids):
+                route_samples = route_ids == route_id
+                timestamps_path, durations_path = self._column_paths(route_id)
+                self._truncate_columns(route_id)
+                with open(timestamps_path, 'ab') as f:
+                    f.write(timestamps[route_samples].astype(TIMESTAMP_DTYPE).tobytes())
+                with open(durations_path, 'ab') as f:
+                    f.write(durations[route_samples].astype(DURATION_DTYPE).tobytes())
+
+    def iter_traffic(self, chunk_size=EXPORT_CHUNK_SIZE) -> (np.ndarray, np.ndarray, np.ndarray):
+        for route_id in sorted(self._route_ids_with_traffic()):
+            timestamps, durations = self.read_columns(route_id)
+            for chunk_start in range(0, len(timestamps), chunk_size):
+                chunk = slice(chunk_start, chunk_start + chunk_size)
+                yield np.full(len(timestamps[chunk]), route_id, dtype=np.int64), timestamps[chunk], durations[chunk]
+
+    def get_last_scan_timestamps(self, s) -> {int: int}:
+        last_scans = {}
+        for route_id in self._route_ids_with_traffic():
+            timestamps, _ = self.read_columns(route_id)
+            if len(timestamps) > 0:
+                last_scans[route_id] = int(timestamps[-1])
+        return last_scans
+
+    def get_last_scan_timestamp(self, route_id, s) -> Optional[int]:
+        self.flush_traffic(s)
+        timestamps, _ = self.read_columns(route_id)
+        return int(timestamps[-1]) if len(timestamps) > 0 else None
+
+    def make_report(self, route, s, t_from=None, t_to=None) -> RouteTrafficReport:
+        self.flush_traffic(s)
+        timestamps, durations = self.read_columns(route.route_id, t_from, t_to)
+        return self._merge_tiers(route, s, timestamps=timestamps, durations=durations, t_from=t_from, t_to=t_to)
+
+    def make_report_day(self, route: Route, s, day_id: int, t_from=None, t_to=None) -> RouteTrafficReport:
+        self.flush_traffic(s)
+        timestamps, durations = self.read_columns(route.route_id, t_from, t_to)
+        day_samples = local_weekday(timestamps, route_timezone(route)) == day_id
+        return self._merge_tiers(route, s, day_id=day_id, t_from=t_from, t_to=t_to,
+                                 timestamps=timestamps[day_samples], durations=durations[day_samples])
+
+    def remove_route(self, user_id, route_id, s) -> None:
+        route = self.get_route(user_id=user_id, route_id=route_id, s=s)
+        if route is None:
+            return
+        super().remove_route(user_id, route_id, s)
+        with self.files_lock:
+            for path in self._column_paths(route.route_id):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _drop_first_samples(self, route_id, num_samples, columns) -> None:
+        for path, column in zip(self._column_paths(route_id), columns):
+            with open(path + '.tmp', 'wb') as f:
+                f.write(column[num_samples:].tobytes())
+            os.replace(path + '.tmp', path)
+
+    def delete_old_traffic_entries(self, keep_days: int, chunk_size=RETENTION_CHUNK_SIZE,
+                                   vacuum=False) -> RetentionReport:
+        """
+        Rewrites the files of every route without the samples older than keep_days.
+        Samples are appended in time order, so the old ones are a prefix of the files.
+        """
+        t0 = time.time()
+        min_timestamp = int(t0) - keep_days * DAY
+        rows_deleted = 0
+        for route_id in self._route_ids_with_traffic():
+            with self.files_lock:
+                timestamps, durations = self.read_columns(route_id)
+                num_old = int(np.searchsorted(timestamps, min_timestamp))
+                if num_old == 0:
+                    continue
+                self._drop_first_samples(route_id, num_old, (timestamps, durations))
+            rows_deleted += num_old
+        report = RetentionReport(rows_deleted=rows_deleted, seconds=time.time() - t0)
+        logger.info(f'Deleted {report.rows_deleted} traffic entries in {report.seconds:.2f} seconds.')
+        return report
+
+    def _fold_raw_traffic(self, min_timestamp) -> int:
+        rows_folded = 0
+        for route_id in self._route_ids_with_traffic():
+            with self.files_lock:
+                timestamps, durations = self.read_columns(route_id)
+                num_old = int(np.searchsorted(timestamps, min_timestamp))
+                if num_old == 0:
+                    continue
+                hours, hour_ids = np.unique(timestamps[:num_old] // HOUR * HOUR, return_inverse=True)
+                old_durations = durations[:num_old].astype(np.int64)
+                num_samples = np.bincount(hour_ids)
+                sum_duration = np.bincount(hour_ids, weights=old_durations)
+                min_duration = np.full(len(hours), np.iinfo(np.int64).max)
+                np.minimum.at(min_duration, hour_ids, old_durations)
+                max_duration = np.zeros(len(hours), dtype=np.int64)
+                np.maximum.at(max_duration, hour_ids, old_durations)
+                with self.session_scope() as s:
+                    self._merge_stats(traffic_hourly_table,
+                                      [(route_id,) + tuple(map(int, row)) for row in
+                                       zip(hours, num_samples, sum_duration, min_duration, max_duration)], s)
+                self._drop_first_samples(route_id, num_old, (timestamps, durations))
+            rows_folded += num_old
+        return rows_folded
+
+    def rebuild_rollups(self, s, route_id=None) -> None:
+        self.flush_traffic(s)
+        delete_query = traffic_rollup_table.delete()
+        if route_id is not None:
+            delete_query = delete_query.where(traffic_rollup_table.c.route_id == route_id)
+        s.execute(delete_query)
+        num_buckets = DAY // self.rollup_bucket
+        for rebuilt_route_id in ([route_id] if route_id is not None else self._route_ids_with_traffic()):
+            timestamps, durations = self.read_columns(rebuilt_route_id)
+            if len(timestamps) == 0:
+                continue
+            stats = rollup_stats(timestamps, durations, self.rollup_bucket)
+            s.execute(traffic_rollup_table.insert(), [
+                dict(zip(ROLLUP_COLUMNS, (rebuilt_route_id, int(key // num_buckets), int(key % num_buckets))
+                         + tuple(map(int, stats[:, key]))))
+                for key in np.flatnonzero(stats[0])])
+        self.rebuild_sketches(s, route_id)
@@ -0,0 +1,285 @@
+import logging
+import os
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from typing import Optional
+
+import numpy as np
+
+from traffic_scanner.sketch import QuantileSketch, group_sketches
+from traffic_scanner.storage import TrafficStorage, User, Route, ScanTarget, RouteTrafficReport, RouteTrafficRollup, \
+    RouteTrafficSketches, RetentionReport, CompactionReport, route_timezone, local_weekday, rollup_keys, rollup_stats, \
+    make_rollup, make_sketches, weekly_timestamp, tiered_report, time_bounds, ROLLUP_BUCKET, KEEP_HOURLY_DAYS, DAY, \
+    HOUR, EPOCH_WEEKDAY
+
+logger = logging.getLogger('traffic_scanner/storage_memory.py')
+
+
+class RouteTraffic:
+    """
+    Raw traffic of one route in append-only arrays, ordered by time.
+    """
+
+    def __init__(self):
+        self.timestamps = array('q')
+        self.durations = array('q')
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, timestamp, duration_sec):
+        self.timestamps.append(timestamp)
+        self.durations.append(duration_sec)
+
+    def drop_before(self, min_timestamp) -> (np.ndarray, np.ndarray):
+        """
+        Removes the samples older than min_timestamp and returns them.
+        """
+        num_old = int(np.searchsorted(np.frombuffer(self.timestamps, dtype=np.int64), min_timestamp))
+        old_samples = np.array(self.timestamps[:num_old]), np.array(self.durations[:num_old])
+        del self.timestamps[:num_old]
+        del self.durations[:num_old]
+        return old_samples
+
+
+class TrafficStorageMemory(TrafficStorage):
+    """
+    Keeps everything in process memory, without a database. Changes are applied immediately and are not rolled back,
+    sessions only exist to match the interface. Meant for tests and benchmarks.
+    """
+
+    def __init__(self, rollup_bucket=ROLLUP_BUCKET):
+        assert HOUR % rollup_bucket == 0, 'Timezone shifts must be whole buckets'
+        self.rollup_bucket: int = rollup_bucket
+        self.lock = threading.RLock()
+        self.users = {}
+        self.routes = {}
+        self.next_route_id = 1
+        self.traffic = {}
+        self.rollups = {}
+        self.sketches = {}
+        self.hourly = {}
+        self.weekly = {}
+        self.leases = {}
+        self.workers = {}
+
+    @contextmanager
+    def session_scope(self):
+        yield None
+
+    def get_route(self, user_id, route_id, s) -> Route:
+        route = self.routes.get(int(route_id))
+        if route is None or route.user.user_id != user_id:
+            return None
+        return route
+
+    def get_routes(self, user_id, s) -> [Route]:
+        with self.lock:
+            routes = list(self.routes.values())
+        if user_id is None:
+            return routes
+        return [route for route in routes if route.user.user_id == user_id]
+
+    def get_scan_targets(self, s) -> [ScanTarget]:
+        return [ScanTarget(route.route_id, route.start_l0, route.start_l1, route.end_l0, route.end_l1,
+                           route.scan_period)
+                for route in self.get_routes(user_id=None, s=s)]
+
+    def get_last_scan_timestamps(self, s) -> {int: int}:
+        with self.lock:
+            return {route_id: traffic.timestamps[-1] for route_id, traffic in self.traffic.items() if len(traffic) > 0}
+
+    def get_last_scan_timestamp(self, route_id, s) -> Optional[int]:
+        with self.lock:
+            traffic = self.traffic.get(route_id)
+            return traffic.timestamps[-1] if traffic is not None and len(traffic) > 0 else None
+
+    def add_route(self, start_coords, end_coords, title, user_id, s) -> Route:
+        with self.lock:
+            user = self.users.get(user_id)
+            if user is None:
+                user = self.users[user_id] = User(user_id=user_id, timezone=os.environ.get('TIMEZONE', 0))
+            route = Route(start_l0=start_coords[0],
+                          start_l1=start_coords[1],
+                          end_l0=end_coords[0],
+                          end_l1=end_coords[1],
+                          title=title,
+                          user=user)
+            route.route_id = self.next_route_id
+            self.next_route_id += 1
+            self.routes[route.route_id] = route
+            self.traffic[route.route_id] = RouteTraffic()
+            return route
+
+    def remove_route(self, user_id, route_id, s) -> None:
+        route = self.get_route(user_id=user_id, route_id=route_id, s=s)
+        if route is None:
+            return
+        with self.lock:
+            for routes_dict in self.routes, self.traffic, self.rollups, self.sketches, self.leases:
+                routes_dict.pop(route.route_id, None)
+            for tier in self.hourly, self.weekly:
+                for key in [key for key in tier if key[0] == route.route_id]:
+                    del tier[key]
+
+    def rename_route(self, user_id, route_id: str, new_name: str, s) -> None:
+        route = self.get_route(user_id=user_id, route_id=route_id, s=s)
+        if route is not None:
+            route.title = new_name
+
+    def set_route_scan_period(self, user_id, route_id, scan_period: Optional[int], s) -> None:
+        route = self.get_route(user_id=user_id, route_id=route_id, s=s)
+        if route is not None:
+            route.scan_period = scan_period
+
+    def append_traffic(self, route, duration_sec, s) -> None:
+        timestamp = int(time.time())
+        with self.lock:
+            if route.route_id not in self.traffic:
+                return  # Removed while it was scanned
+            self.traffic[route.route_id].append(timestamp, duration_sec)
+            stats = self.rollups.get(route.route_id)
+            if stats is None:
+                stats = self.rollups[route.route_id] = np.zeros((5, 7 * (DAY // self.rollup_bucket)), dtype=np.int64)
+            key = ((timestamp // DAY + EPOCH_WEEKDAY) % 7) * (DAY // self.rollup_bucket) \
+                + timestamp % DAY // self.rollup_bucket
+            num_samples, sum_duration, sum_sq_duration, min_duration, max_duration = stats[:, key]
+            stats[:, key] = (num_samples + 1, sum_duration + duration_sec, sum_sq_duration + duration_sec ** 2,
+                             duration_sec if num_samples == 0 else min(min_duration, duration_sec),
+                             max(max_duration, duration_sec))
+            sketches = self.sketches.setdefault(route.route_id, {})
+            sketch = QuantileSketch.from_durations([duration_sec])
+            sketches[key] = sketches[key].merge(sketch) if key in sketches else sketch
+
+    def flush_traffic(self, s) -> None:
+        pass
+
+    def _raw_traffic(self, route, t_from=None, t_to=None) -> (np.ndarray, np.ndarray):
+        with self.lock:
+            traffic = self.traffic.get(route.route_id, RouteTraffic())
+            # Only the selected range is copied out of the arrays, they may grow after the lock is released
+            timestamps = np.frombuffer(traffic.timestamps, dtype=np.int64) if len(traffic) > 0 \
+                else np.empty(0, dtype=np.int64)
+            start = 0 if t_from is None else int(np.searchsorted(timestamps, t_from))
+            end = len(timestamps) if t_to is None else int(np.searchsorted(timestamps, t_to))
+            durations = np.array(traffic.durations[start:end], dtype=np.int32)
+            timestamps = timestamps[start:end].copy()
+            return timestamps, durations
+
+    def _tier_rows(self, route, day_id=None, t_from=None, t_to=None) -> list:
+        with self.lock:
+            weekly_rows = sorted((weekly_timestamp(weekday, hour),) + tuple(stats)
+                                 for (route_id, weekday, hour), stats in self.weekly.items()
+                                 if route_id == route.route_id and t_from is None)
+            hourly_rows = sorted((hour + HOUR // 2,) + tuple(stats)
+                                 for (route_id, hour), stats in self.hourly.items()
+                                 if route_id == route.route_id and all(time_bounds(hour, t_from, t_to)))
+        tier_rows = weekly_rows + hourly_rows
+        if day_id is not None:
+            tier_rows = [row for row in tier_rows if local_weekday(row[0], route_timezone(route)) == day_id]
+        return tier_rows
+
+    def make_report(self, route, s, t_from=None, t_to=None) -> RouteTrafficReport:
+        timestamps, durations = self._raw_traffic(route, t_from, t_to)
+        return tiered_report(route, self._tier_rows(route, t_from=t_from, t_to=t_to), timestamps, durations)
+
+    def make_report_day(self, route: Route, s, day_id: int, t_from=None, t_to=None) -> RouteTrafficReport:
+        timestamps, durations = self._raw_traffic(route, t_from, t_to)
+        day_samples = local_weekday(timestamps, route_timezone(route)) == day_id
+        return tiered_report(route, self._tier_rows(route, day_id, t_from, t_to),
+                             timestamps[day_samples], durations[day_samples])
+
+    def get_rollup(self, route, s) -> RouteTrafficRollup:
+        with self.lock:
+            stats = self.rollups.get(route.route_id)
+            stats = np.zeros((5, 7 * (DAY // self.rollup_bucket)), dtype=np.int64) if stats is None else stats.copy()
+        return make_rollup(route, self.rollup_bucket, stats)
+
+    def get_sketches(self, route, s) -> RouteTrafficSketches:
+        with self.lock:
+            sketches = dict(self.sketches.get(route.route_id, {}))
+        return make_sketches(route, self.rollup_bucket, sketches)
+
+    def rebuild_rollups(self, s, route_id=None) -> None:
+        with self.lock:
+            for rebuilt_route_id, traffic in self.traffic.items():
+                if route_id is None or rebuilt_route_id == route_id:
+                    self.rollups[rebuilt_route_id] = rollup_stats(traffic.timestamps, traffic.durations,
+                                                                  self.rollup_bucket)
+                    self.sketches[rebuilt_route_id] = group_sketches(rollup_keys(traffic.timestamps,
+                                                                                 self.rollup_bucket),
+                                                                     traffic.durations)
+        self.invalidate_rollups()
+
+    def sync_leases(self, route_ids, s) -> None:
+        with self.lock:
+            route_ids = set(route_ids)
+            self.leases = {route_id: self.leases.get(route_id, [None, 0]) for route_id in sorted(route_ids)}
+
+    def claim_routes(self, worker_id, max_routes, lease_ttl, s) -> [int]:
+        now = int(time.time())
+        with self.lock:
+            self.workers[worker_id] = now + lease_ttl
+            num_workers = sum(expires_at >= now for expires_at in self.workers.values())
+            max_routes = min(max_routes, -(-len(self.leases) // num_workers))
+            owned = sorted(route_id for route_id, lease in self.leases.items() if lease[0] == worker_id)
+            for route_id in owned[max_routes:]:
+                self.leases[route_id] = [None, 0]
+            owned = owned[:max_routes]
+            expired = sorted((lease[1], route_id) for route_id, lease in self.leases.items()
+                             if lease[1] < now and lease[0] != worker_id)
+            for _, route_id in expired[:max(max_routes - len(owned), 0)]:
+                owned.append(route_id)
+            for route_id in owned:
+                self.leases[route_id] = [worker_id, now + lease_ttl]
+            return owned
+
+    def release_routes(self, worker_id, s) -> None:
+        with self.lock:
+            for lease in self.leases.values():
+                if lease[0] == worker_id:
+                    lease[:] = [None, 0]
+            self.workers.pop(worker_id, None)
+
+    def delete_old_traffic_entries(self, keep_days: int) -> RetentionReport:
+        t0 = time.time()
+        rows_deleted = 0
+        with self.lock:
+            for traffic in self.traffic.values():
+                timestamps, _ = traffic.drop_before(int(t0) - keep_days * DAY)
+                rows_deleted += len(timestamps)
+        report = RetentionReport(rows_deleted=rows_deleted, seconds=time.time() - t0)
+        logger.info(f'Deleted {report.rows_deleted} traffic entries in {report.seconds:.2f} seconds.')
+        return report
+
+    def compact_traffic(self, keep_days: int, keep_hourly_days=KEEP_HOURLY_DAYS) -> CompactionReport:
+        t0 = time.time()
+        now = int(t0)
+        raw_rows_folded = 0
+        with self.lock:
+            for route_id, traffic in self.traffic.items():
+                timestamps, durations = traffic.drop_before(now - now % HOUR - keep_days * DAY)
+                raw_rows_folded += len(timestamps)
+                for hour, duration in zip((timestamps // HOUR * HOUR).tolist(), durations.tolist()):
+                    merge_tier_stats(self.hourly, (route_id, hour), (1, duration, duration, duration))
+            min_hour = now - now % HOUR - keep_hourly_days * DAY
+            old_hours = [key for key in self.hourly if key[1] < min_hour]
+            for route_id, hour in old_hours:
+                weekly_key = route_id, (hour // DAY + EPOCH_WEEKDAY) % 7, hour % DAY // HOUR
+                merge_tier_stats(self.weekly, weekly_key, self.hourly.pop((route_id, hour)))
+        report = CompactionReport(raw_rows_folded=raw_rows_folded, hourly_rows_folded=len(old_hours),
+                                  seconds=time.time() - t0)
+        logger.info(f'Folded {report.raw_rows_folded} traffic entries and {report.hourly_rows_folded} hours '
+                    f'in {report.seconds:.2f} seconds.')
+        return report
+
+
+def merge_tier_stats(tier, key, stats):
+    """
+    Merges (num_samples, sum_duration, min_duration, max_duration) into the stats of the tier's key.
+    """
+    num_samples, sum_duration, min_duration, max_duration = tier.get(key, (0, 0, stats[2], stats[3]))
+    tier[key] = (num_samples + stats[0], sum_duration + stats[1], min(min_duration, stats[2]),
+                 max(max_duration, stats[3]))
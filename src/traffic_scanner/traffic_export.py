@@ -0,0 +1,212 @@
+import argparse
+import csv
+import gzip
+import itertools
+import logging
+import os
+import time
+
+import numpy as np
+from sqlalchemy import select, func, Float, String, LargeBinary
+
+from traffic_scanner.storage import TrafficStorageSQL, users_table, routes_table, traffic_hourly_table, \
+    traffic_weekly_table, traffic_rollup_table, traffic_sketch_table, EXPORT_CHUNK_SIZE
+from traffic_scanner.storage_columnar import TrafficStorageColumnar
+
+# Streams the traffic history of a database to a directory of gzip files and back:
+#   python -m traffic_scanner.traffic_export export --db-url sqlite:////data/traffic.db backup/
+#   python -m traffic_scanner.traffic_export import --db-url postgresql://... backup/
+# Users, routes, compacted traffic, rollups and sketches are written as CSV,
+# raw traffic as CSV or as NumPy column chunks.
+
+logger = logging.getLogger('traffic_scanner/traffic_export.py')
+
+TABLES = users_table, routes_table, traffic_hourly_table, traffic_weekly_table, traffic_rollup_table, \
+    traffic_sketch_table
+# Exports made before these tables are imported without them, they are rebuilt from the raw traffic
+REBUILT_TABLES = traffic_rollup_table, traffic_sketch_table
+TRAFFIC_COLUMNS = 'route_id', 'timestamp', 'duration_sec'
+TRAFFIC_CSV = 'traffic.csv.gz'
+TRAFFIC_NPY = 'traffic.npy.gz'
+
+
+def table_path(directory, table):
+    return os.path.join(directory, f'{table.name}.csv.gz')
+
+
+def parse_value(column, value):
+    if value == '':
+        return None
+    if isinstance(column.type, String):
+        return value
+    if isinstance(column.type, Float):
+        return float(value)
+    if isinstance(column.type, LargeBinary):
+        return bytes.fromhex(value)
+    return int(value)
+
+
+def chunks(iterable, chunk_size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def format_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bytes):
+        # Sketches
+        return value.hex()
+    return value
+
+
+def export_table(storage: TrafficStorageSQL, table, directory, chunk_size) -> int:
+    num_rows = 0
+    with storage.engine.connect() as connection, gzip.open(table_path(directory, table), 'wt', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(table.columns.keys())
+        result = connection.execution_options(stream_results=True).execute(select([table]))
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            writer.writerows(list(map(format_value, row)) for row in rows)
+            num_rows += len(rows)
+    return num_rows
+
+
+def import_table(storage: TrafficStorageSQL, table, directory, chunk_size) -> int:
+    num_rows = 0
+    with gzip.open(table_path(directory, table), 'rt', newline='') as f:
+        reader = csv.reader(f)
+        columns = [table.c[name] for name in next(reader)]
+        for rows in chunks(reader, chunk_size):
+            with storage.session_scope() as s:
+                s.execute(table.insert(), [{column.name: parse_value(column, value)
+                                            for column, value in zip(columns, row)} for row in rows])
+            num_rows += len(rows)
+    return num_rows
+
+
+def write_traffic_csv(traffic_chunks, path) -> int:
+    num_rows = 0
+    with gzip.open(path, 'wt', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(TRAFFIC_COLUMNS)
+        for columns in traffic_chunks:
+            writer.writerows(zip(*(column.tolist() for column in columns)))
+            num_rows += len(columns[0])
+    return num_rows
+
+
+def read_traffic_csv(path, chunk_size) -> (np.ndarray, np.ndarray, np.ndarray):
+    with gzip.open(path, 'rt', newline='') as f:
+        reader = csv.reader(f)
+        next(reader)
+        for rows in chunks(reader, chunk_size):
+            yield tuple(np.array(rows, dtype=np.int64).T)
+
+
+def write_traffic_npy(traffic_chunks, path) -> int:
+    """
+    Every chunk is three consecutive arrays in .npy format: route ids, timestamps and durations.
+    """
+    num_rows = 0
+    with gzip.open(path, 'wb') as f:
+        for route_ids, timestamps, durations in traffic_chunks:
+            np.save(f, np.asarray(route_ids, dtype=np.int64))
+            np.save(f, np.asarray(timestamps, dtype=np.int64))
+            np.save(f, np.asarray(durations, dtype=np.int32))
+            num_rows += len(route_ids)
+    return num_rows
+
+
+def read_traffic_npy(path) -> (np.ndarray, np.ndarray, np.ndarray):
+    with gzip.open(path, 'rb') as f:
+        while len(f.peek(1)) > 0:
+            yield np.load(f), np.load(f), np.load(f)
+
+
+def export_history(storage: TrafficStorageSQL, directory, traffic_format='csv',
+                   chunk_size=EXPORT_CHUNK_SIZE) -> {str: int}:
+    """
+    Writes all tables to the directory and returns the number of rows written per table.
+    """
+    os.makedirs(directory, exist_ok=True)
+    counts = {table.name: export_table(storage, table, directory, chunk_size) for table in TABLES}
+    if traffic_format == 'npy':
+        counts['traffic'] = write_traffic_npy(storage.iter_traffic(chunk_size), os.path.join(directory, TRAFFIC_NPY))
+    else:
+        counts['traffic'] = write_traffic_csv(storage.iter_traffic(chunk_size), os.path.join(directory, TRAFFIC_CSV))
+    return counts
+
+
+def import_history(storage: TrafficStorageSQL, directory, chunk_size=EXPORT_CHUNK_SIZE) -> {str: int}:
+    """
+    Loads an export into a storage without routes, keeping the ids. The rollups and sketches hold the history
+    of traffic that was compacted or deleted, they are only rebuilt if the export has none.
+    Every chunk is written by one multi-row insert in its own transaction.
+    """
+    with storage.session_scope() as s:
+        if len(storage.get_routes(user_id=None, s=s)) > 0:
+            raise ValueError('Traffic history can only be imported into a storage without routes')
+    missing_tables = {table for table in REBUILT_TABLES if not os.path.exists(table_path(directory, table))}
+    counts = {table.name: import_table(storage, table, directory, chunk_size)
+              for table in TABLES if table not in missing_tables}
+
+    if os.path.exists(os.path.join(directory, TRAFFIC_NPY)):
+        traffic_chunks = read_traffic_npy(os.path.join(directory, TRAFFIC_NPY))
+    else:
+        traffic_chunks = read_traffic_csv(os.path.join(directory, TRAFFIC_CSV), chunk_size)
+    counts['traffic'] = 0
+    for route_ids, timestamps, durations in traffic_chunks:
+        with storage.session_scope() as s:
+            storage.import_traffic(route_ids, timestamps, durations, s)
+        counts['traffic'] += len(route_ids)
+
+    if storage.engine.dialect.name == 'postgresql':
+        # Explicit ids do not advance the sequence of the routes' primary key
+        storage.engine.execute(select([func.setval(func.pg_get_serial_sequence('routes', 'route_id'),
+                                                   func.coalesce(func.max(routes_table.c.route_id), 0) + 1,
+                                                   False)]))
+    if traffic_rollup_table in missing_tables:
+        with storage.session_scope() as s:
+            storage.rebuild_rollups(s)
+    elif traffic_sketch_table in missing_tables:
+        with storage.session_scope() as s:
+            storage.rebuild_sketches(s)
+    storage.invalidate_scan_targets()
+    storage.invalidate_rollups()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export and import the traffic history')
+    parser.add_argument('command', choices=('export', 'import'))
+    parser.add_argument('directory')
+    parser.add_argument('--db-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--data-dir', default=os.environ.get('TRAFFIC_DATA_DIR'),
+                        help='Column files of TrafficStorageColumnar')
+    parser.add_argument('--format', choices=('csv', 'npy'), default='csv', help='Format of the exported raw traffic')
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    if args.data_dir:
+        storage = TrafficStorageColumnar(db_url=args.db_url, data_dir=args.data_dir)
+    else:
+        storage = TrafficStorageSQL(db_url=args.db_url)
+    t0 = time.time()
+    if args.command == 'export':
+        counts = export_history(storage, args.directory, traffic_format=args.format, chunk_size=args.chunk_size)
+    else:
+        counts = import_history(storage, args.directory, chunk_size=args.chunk_size)
+    logger.info(f'{args.command.capitalize()}ed {counts} rows in {time.time() - t0:.2f} seconds.')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,7 +1,11 @@
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from traffic_scanner.storage import TrafficStorageSQL, Route, User
+from sqlalchemy.exc import IntegrityError
+
+from traffic_scanner.scheduler import RouteScheduler, MIN_RETRY_DELAY
+from traffic_scanner.storage import TrafficStorage, ScanTarget, User, KEEP_HOURLY_DAYS
 from traffic_scanner.yandex_maps_client import YandexMapsClient
 
 
@@ -9,55 +13,232 @@ logger = logging.getLogger('traffic_scanner/traffic_scanner.py')
 
 
 HOUR = 60 * 60
+ROUTES_REFRESH_PERIOD = 60
+COORDS_PRECISION = 4
+LEASE_TTL = 5 * 60
+LEASE_MAX_ROUTES = 1000
+KEEP_DAYS = 14
+RETENTION_PERIOD = HOUR
+COMMIT_CHUNK_SIZE = 100
+
+
+def lease_route_id(routes) -> int:
+    # Route ids only grow, so the first route of a group changes only when it is removed
+    return min(route.route_id for route in routes)
 
 
 class TrafficScanner:
 
-    def __init__(self, period, yandex_maps_client: YandexMapsClient, storage: TrafficStorageSQL):
+    def __init__(self, period, yandex_maps_client: YandexMapsClient, storage: TrafficStorage, num_workers=1,
+                 coords_precision=COORDS_PRECISION, worker_id=None, lease_ttl=LEASE_TTL,
+                 lease_max_routes=LEASE_MAX_ROUTES, keep_days=KEEP_DAYS, keep_hourly_days=KEEP_HOURLY_DAYS,
+                 retention_period=RETENTION_PERIOD, commit_chunk_size=COMMIT_CHUNK_SIZE):
         self.period: int = period
-        self.storage: TrafficStorageSQL = storage
+        # Routes with coordinates equal up to this number of decimals are scanned once
+        self.coords_precision: int = coords_precision
+        self.storage: TrafficStorage = storage
         self.yandex_maps_client: YandexMapsClient = yandex_maps_client
+        # Workers only talk to yandex maps, all the database work stays in the calling thread
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='traffic_scanner')
+        self.scheduler = RouteScheduler(period)
+        # With a worker id routes are shared with other scanner processes through leases in the database.
+        # A group of identical routes is leased as a whole by the lease of its first route
+        self.worker_id = worker_id
+        self.lease_ttl: int = lease_ttl
+        self.lease_max_routes: int = lease_max_routes
+        self.leased_route_ids = set()
+        self.t_leases_renewed = -1
+        # Raw traffic older than keep_days is folded into hours, hours older than keep_hourly_days into hours of week
+        self.keep_days: int = keep_days
+        self.keep_hourly_days: int = keep_hourly_days
+        self.retention_period: int = retention_period
+        self.t_retention = -1
+        # Scheduled routes are scanned and committed by this number of groups, so a scan never holds a long transaction
+        self.commit_chunk_size: int = commit_chunk_size
+        # Called with the ids of the scanned routes after their traffic is committed
+        self.scan_listeners = []
+
+    def add_scan_listener(self, listener) -> None:
+        self.scan_listeners.append(listener)
+
+    def notify_scanned(self, route_ids) -> None:
+        if len(route_ids) == 0:
+            return
+        for listener in self.scan_listeners:
+            try:
+                listener(route_ids)
+            except Exception as e:
+                logger.exception(e)
 
     def add_route(self, start_coords, end_coords, user_idx, s, title=None):
         title = title or f'{start_coords} -> {end_coords}'
         route = self.storage.add_route(start_coords, end_coords, title, user_idx, s)
         self.scan_route(route, s)
 
-    def update_traffic(self, s):
-        routes = self.storage.get_routes(user_id=None, s=s)
+    def coords_key(self, route):
+        return tuple(round(coord, self.coords_precision) for coord in (*route.start_coords, *route.end_coords))
+
+    def group_routes(self, routes) -> {tuple: [ScanTarget]}:
+        groups = {}
         for route in routes:
-            self.scan_route(route, s)
-            self.storage.delete_old_traffic_entries(s=s, route=route, keep_days=14)
+            groups.setdefault(self.coords_key(route), []).append(route)
+        return groups
+
+    def scan_groups(self, groups: [[ScanTarget]], s):
+        """
+        Calls yandex maps once per group of identical routes and appends the duration to every route of the group.
+        Returns a list with an exception or None for every group.
+        """
+        futures = [self.executor.submit(self.fetch_duration, routes[0].start_coords, routes[0].end_coords)
+                   for routes in groups]
+        errors = []
+        for routes, future in zip(groups, futures):
+            try:
+                duration_sec = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            errors.append(None)
+            if duration_sec is not None:
+                for route in routes:
+                    self.storage.append_traffic(route, duration_sec=duration_sec, s=s)
+        return errors
+
+    def update_traffic(self, s):
+        routes = self.storage.get_scan_targets(s)
+        groups = list(self.group_routes(routes).values())
+        logger.info(f'Scanning {len(groups)} unique of {len(routes)} routes.')
+        errors = self.scan_groups(groups, s)
+        for routes, error in zip(groups, errors):
+            if error is not None:
+                logger.error(f'Failed to scan routes {[route.route_id for route in routes]}: {error!r}')
 
     def scan_route(self, route, s):
-        traffic_json = self.yandex_maps_client.build_route(route.start_coords, route.end_coords)
+        duration_sec = self.fetch_duration(route.start_coords, route.end_coords)
+        if duration_sec is not None:
+            self.storage.append_traffic(route, duration_sec=duration_sec, s=s)
+
+    def fetch_duration(self, start_coords, end_coords):
+        traffic_json = self.yandex_maps_client.build_route(start_coords, end_coords)
         try:
             routes = traffic_json['data']['routes']
             if len(routes) > 0:  # Is [0] the quickest?
                 duration_sec = routes[0]['durationInTraffic']
             else:
-                logger.error(f'On route {route.idx} 0 available ways were found.')
-                return
+                logger.error(f'On route {start_coords} -> {end_coords} 0 available ways were found.')
+                return None
         except KeyError as e:
             logger.error(f'Invalid json: {traffic_json}')
             raise e
         logger.info(f'Duration: {duration_sec}')
-        self.storage.append_traffic(route, duration_sec=duration_sec, s=s)
+        return duration_sec
+
+    def renew_leases(self):
+        if time.time() - self.t_leases_renewed < self.lease_ttl / 3:
+            return
+        try:
+            with self.storage.session_scope() as s:
+                groups = self.group_routes(self.storage.get_scan_targets(s)).values()
+                self.storage.sync_leases([lease_route_id(routes) for routes in groups], s)
+        except IntegrityError:
+            pass  # Another worker created them concurrently
+        with self.storage.session_scope() as s:
+            self.leased_route_ids = set(self.storage.claim_routes(worker_id=self.worker_id,
+                                                                  max_routes=self.lease_max_routes,
+                                                                  lease_ttl=self.lease_ttl,
+                                                                  s=s))
+        self.t_leases_renewed = time.time()
+        logger.info(f'Worker {self.worker_id} holds {len(self.leased_route_ids)} routes.')
+
+    def release_leases(self):
+        with self.storage.session_scope() as s:
+            self.storage.release_routes(self.worker_id, s)
+        self.leased_route_ids = set()
+        self.t_leases_renewed = -1
+
+    def run_retention(self):
+        if time.time() - self.t_retention < self.retention_period:
+            return
+        self.storage.compact_traffic(keep_days=self.keep_days, keep_hourly_days=self.keep_hourly_days)
+        self.t_retention = time.time()
+
+    def sync_schedule(self, s) -> {tuple: [ScanTarget]}:
+        groups = self.group_routes(self.storage.get_scan_targets(s))
+        if self.worker_id is not None:
+            groups = {key: routes for key, routes in groups.items() if lease_route_id(routes) in self.leased_route_ids}
+        periods = {key: min(route.scan_period or self.period for route in routes) for key, routes in groups.items()}
+        last_scans = {}
+        if len(self.scheduler.new_keys(periods)) > 0:
+            route_last_scans = self.storage.get_last_scan_timestamps(s)
+            for key, routes in groups.items():
+                timestamps = [route_last_scans[route.route_id] for route in routes
+                              if route.route_id in route_last_scans]
+                if len(timestamps) > 0:
+                    last_scans[key] = max(timestamps)
+        self.scheduler.sync(periods, last_scans, time.time())
+        return groups
+
+    def scan_scheduled(self):
+        with self.storage.session_scope() as s:
+            groups = self.sync_schedule(s)
+        due = self.scheduler.pop_due(time.time())
+        if len(due) == 0:
+            return
+        logger.info(f'Scanning {len(due)} of {len(groups)} unique routes.')
+        scanned_route_ids = []
+        try:
+            for chunk_start in range(0, len(due), self.commit_chunk_size):
+                if self.worker_id is not None:
+                    # Leases must not expire during a long scan, or other workers scan the same routes again
+                    self.renew_leases()
+                scanned_route_ids += self.scan_chunk(due[chunk_start:chunk_start + self.commit_chunk_size], groups)
+        finally:
+            self.notify_scanned(scanned_route_ids)
+
+    def scan_chunk(self, due, groups) -> [int]:
+        """
+        Scans and commits a chunk of due groups, returns the ids of the scanned routes.
+        """
+        try:
+            with self.storage.session_scope() as s:
+                errors = self.scan_groups([groups[entry.key] for entry in due], s)
+        except Exception:
+            # Nothing of the chunk is committed, it is retried as a whole
+            for entry in due:
+                self.scheduler.retry(entry, time.time())
+            raise
+        scanned_route_ids = []
+        for entry, error in zip(due, errors):
+            if error is None:
+                self.scheduler.reschedule(entry, time.time())
+                scanned_route_ids += [route.route_id for route in groups[entry.key]]
+            else:
+                logger.error(f'Failed to scan routes {[route.route_id for route in groups[entry.key]]}: {error!r}')
+                self.scheduler.retry(entry, time.time())
+        return scanned_route_ids
 
     def serve(self):
         logger.info('Start serving.')
         while True:
-            t0 = time.time()
-            with self.storage.session_scope() as s:
-                self.update_traffic(s)
-            sleep_time = max(self.period - (time.time() - t0), 0)
-            logger.info(f'Sleeping for {sleep_time} seconds.')
+            if self.worker_id is not None:
+                self.renew_leases()
+            self.scan_scheduled()
+            self.run_retention()
+            sleep_time = self.scheduler.time_until_next(time.time())
+            if sleep_time is None or sleep_time > ROUTES_REFRESH_PERIOD:
+                sleep_time = ROUTES_REFRESH_PERIOD
             time.sleep(sleep_time)
 
     def serve_restart(self):
+        retry_delay = MIN_RETRY_DELAY
         while True:
+            t0 = time.time()
             try:
                 self.serve()
             except Exception as e:
                 logger.exception(e)
-            time.sleep(HOUR)
+            if time.time() - t0 > self.period:
+                retry_delay = MIN_RETRY_DELAY
+            logger.info(f'Restarting in {retry_delay} seconds.')
+            time.sleep(retry_delay)
+            retry_delay = min(2 * retry_delay, HOUR)
@@ -1,44 +1,92 @@
 import datetime
+import io
 import logging
 import math
+import threading
+from dataclasses import dataclass
+from typing import Optional
 
+import matplotlib
 import numpy as np
-from matplotlib import pyplot as plt, dates as md
-
-plt.rcParams.update(plt.rcParamsDefault)
-plt.style.use([
+from PIL import Image
+from matplotlib import dates as md, style, ticker
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+# Figures are created without pyplot, which keeps global state and is not thread-safe
+matplotlib.rcParams.update(matplotlib.rcParamsDefault)
+style.use([
     'dark_background'
 ])
-plt.rcParams.update({'figure.figsize': [12, 4]})
+matplotlib.rcParams.update({'figure.figsize': [12, 4]})
 
 MINUTE = 60
 HOUR = 60 * MINUTE
 DAY = 24 * HOUR
+# 1970-01-01 was a Thursday
+EPOCH_WEEKDAY = 3
 
 logger = logging.getLogger('traffic_scanner/traffic_view.py')
 
+FAST_PNG_COLORS = 64
+
+# Steps between ticks of durations below a day, the first one giving at most 8 ticks is used
+DURATION_TICK_STEPS = tuple(minutes * MINUTE for minutes in (1, 2, 5, 10, 15, 30, 60, 120, 180, 360))
+
 DAYS_OF_WEEK = 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'
 
 
 class TrafficView:
+    """
+    With fast_render, every thread keeps one figure per kind of plot and only replaces the data of its lines,
+    with times of day and durations as plain seconds. The returned figure is reused by the next plot of the thread.
+    Its PNGs have a palette of png_colors colors, which are several times smaller than true color ones.
+    """
 
-    def __init__(self, period):
+    def __init__(self, period, fast_render=False, figsize=None, dpi=None):
         assert period < 24 * 60 * 60
         self.num_time_intervals = math.ceil(DAY / period)
         self.timedelta = period
-
-    def plot_traffic_by_day(self, timestamps, durations, timezone, route_name):
-        durations, nonzero_intervals = sort_days_intervals(np.array(timestamps) + timezone * HOUR,
-                                                           durations,
-                                                           self.timedelta)
-
-        fig = plt.figure()
+        self.fast_render: bool = fast_render
+        self.figsize = figsize
+        self.dpi = dpi
+        self.png_colors: Optional[int] = FAST_PNG_COLORS if fast_render else None
+        self.templates = threading.local()
+
+    def __getstate__(self):
+        # Views are sent to the render processes without their figures
+        state = dict(self.__dict__)
+        del state['templates']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.templates = threading.local()
+
+    def _template(self, name, make_template):
+        template = getattr(self.templates, name, None)
+        if template is None:
+            template = make_template(new_figure(self.figsize, self.dpi))
+            setattr(self.templates, name, template)
+        return template
+
+    def plot_traffic_by_day(self, timestamps, durations, timezone, route_name, weights=None):
+        local_timestamps = np.asarray(timestamps) + timezone * HOUR
+        stats = interval_stats(local_timestamps, durations, self.timedelta, weights=weights, by_day=True)
+        days, intervals = np.divmod(stats.keys, self.num_time_intervals)
+        if self.fast_render:
+            template = self._template('by_day', ByDayTemplate)
+            return template.update([intervals[days == day_idx] * self.timedelta for day_idx in range(7)],
+                                   [stats.mean[days == day_idx] for day_idx in range(7)],
+                                   route_name)
+
+        fig = new_figure(self.figsize, self.dpi)
         ax = fig.gca()
         for day_idx, day in enumerate(DAYS_OF_WEEK):
-            nonzero_intervals_day = np.array(nonzero_intervals[day_idx]) * self.timedelta
+            nonzero_intervals_day = intervals[days == day_idx] * self.timedelta
             if len(nonzero_intervals_day) == 0:
                 continue
-            durations_day = tuple(map(int, map(np.mean, durations[day_idx])))
+            durations_day = tuple(map(int, stats.mean[days == day_idx]))
             if np.max(durations_day) <= DAY:
                 y_labels = tuple(map(datetime.datetime.utcfromtimestamp, durations_day))
                 ax.yaxis.set_major_formatter(md.DateFormatter('%H:%M'))
@@ -46,27 +94,74 @@ class TrafficView:
                 y_labels = [ts / HOUR for ts in durations_day]
                 ax.set_ylabel('Hours')
 
-            x_labels = tuple(map(datetime.datetime.utcfromtimestamp, nonzero_intervals_day))
+            x_labels = tuple(map(datetime.datetime.utcfromtimestamp, nonzero_intervals_day.tolist()))
             ax.xaxis.set_major_formatter(md.DateFormatter('%H:%M'))
             ax.plot(x_labels, y_labels, label=day)
         ax.set_title(route_name)
         fig.legend()
         return fig
 
-    def plot_traffic_minmax(self, timestamps, durations, timezone, route_name):
-        durations, nonzero_intervals = sort_intervals(np.array(timestamps) + timezone * HOUR,
-                                                           durations,
-                                                           self.timedelta)
-        durations = np.concatenate(np.array(durations, dtype=object))
-        nonzero_intervals = np.concatenate(np.array(nonzero_intervals, dtype=object)) * self.timedelta
-        fig = plt.figure()
+    def plot_traffic_minmax(self, timestamps, durations, timezone, route_name, weights=None):
+        """
+        Min, mean and max of durations per time of day. With weights (see RouteTrafficReport) the mean is weighted.
+        """
+        local_timestamps = np.asarray(timestamps) + timezone * HOUR
+        stats = interval_stats(local_timestamps, durations, self.timedelta, weights=weights)
+        return self._plot_minmax(stats.keys * self.timedelta,
+                                 tuple(map(int, stats.min)),
+                                 tuple(map(int, stats.mean)),
+                                 tuple(map(int, stats.max)),
+                                 route_name)
+
+    def plot_rollup_minmax(self, rollup, route_name, quantiles=None):
+        """
+        Same plot as plot_traffic_minmax from a RouteTrafficRollup. Days of week are merged.
+        quantiles are buckets and their p10, p50 and p90 (see RouteTrafficSketches.quantiles), drawn as a band
+        around the median.
+        """
+        rollup = rollup.merge_days()
+        nonzero_buckets = np.flatnonzero(rollup.num_samples[0])
+        bands = None
+        if quantiles is not None:
+            buckets, values = quantiles
+            bands = buckets * rollup.bucket_sec, *(tuple(map(int, row)) for row in values)
+        return self._plot_minmax(nonzero_buckets * rollup.bucket_sec,
+                                 tuple(map(int, rollup.min_duration[0, nonzero_buckets])),
+                                 tuple(map(int, rollup.mean_duration[0, nonzero_buckets])),
+                                 tuple(map(int, rollup.max_duration[0, nonzero_buckets])),
+                                 route_name,
+                                 bands=bands)
+
+    def plot_rollups_comparison(self, rollups, route_names):
+        """
+        Mean durations per time of day of several routes in one plot. Days of week are merged.
+        """
+        if len(rollups) == 0:
+            return self._comparison_template().update([], [], [])
+        merged = [rollup.merge_days() for rollup in rollups]
+        num_samples = np.concatenate([rollup.num_samples for rollup in merged])
+        means = np.concatenate([rollup.mean_duration for rollup in merged])
+        bucket_intervals = np.arange(num_samples.shape[1]) * merged[0].bucket_sec
+        nonzero = num_samples > 0
+        return self._comparison_template().update([bucket_intervals[route_nonzero] for route_nonzero in nonzero],
+                                                  [route_means[route_nonzero] for route_means, route_nonzero
+                                                   in zip(means, nonzero)],
+                                                  route_names)
+
+    def _comparison_template(self):
+        if self.fast_render:
+            return self._template('comparison', ComparisonTemplate)
+        return ComparisonTemplate(new_figure(self.figsize, self.dpi))
+
+    def _plot_minmax(self, nonzero_intervals, durations_min, durations_mean, durations_max, route_name, bands=None):
+        if self.fast_render:
+            return self._template('minmax', MinMaxTemplate).update(
+                nonzero_intervals, durations_min, durations_mean, durations_max, route_name, bands)
+
+        fig = new_figure(self.figsize, self.dpi)
         ax = fig.gca()
         if len(nonzero_intervals) != 0:
 
-            durations_mean = tuple(map(int, map(np.mean, durations)))
-            durations_max = tuple(map(int, map(np.max, durations)))
-            durations_min = tuple(map(int, map(np.min, durations)))
-
             some_days = (np.max(durations_max) > DAY)
             if not some_days:
                 ax.yaxis.set_major_formatter(md.DateFormatter('%H:%M'))
@@ -83,11 +178,129 @@ class TrafficView:
             ax.plot(x_labels, y_mean, linewidth=4, alpha=0.9, label='mean')
             ax.plot(x_labels, y_min, linewidth=3, alpha=0.9, label='min')
 
+            if bands is not None and len(bands[0]) > 0:
+                band_intervals, durations_low, durations_median, durations_high = bands
+                band_labels = tuple(map(datetime.datetime.utcfromtimestamp, band_intervals.tolist()))
+                ax.fill_between(band_labels, prettify_y(durations_low, some_days),
+                                prettify_y(durations_high, some_days), alpha=0.3, label='p10-p90')
+                ax.plot(band_labels, prettify_y(durations_median, some_days), linewidth=2, linestyle='--',
+                        label='median')
+
         ax.set_title(route_name)
         fig.legend()
         return fig
 
 
+def new_figure(figsize=None, dpi=None) -> Figure:
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def format_time_of_day(seconds, _=None) -> str:
+    return f'{int(seconds) // HOUR % 24:02d}:{int(seconds) % HOUR // MINUTE:02d}'
+
+
+def format_hours(seconds, _=None) -> str:
+    return f'{seconds / HOUR:g}'
+
+
+def set_duration_axis(ax, max_duration):
+    """
+    Durations are in seconds, shown as hours and minutes below a day and as hours above.
+    """
+    if max_duration > DAY:
+        ax.yaxis.set_major_formatter(ticker.FuncFormatter(format_hours))
+        ax.yaxis.set_major_locator(ticker.MultipleLocator(HOUR * max(1, int(max_duration // HOUR // 6))))
+        ax.set_ylabel('Hours')
+    else:
+        ax.yaxis.set_major_formatter(ticker.FuncFormatter(format_time_of_day))
+        y_min, y_max = ax.get_ylim()
+        step = next((step for step in DURATION_TICK_STEPS if (y_max - y_min) / step <= 8), DURATION_TICK_STEPS[-1])
+        ax.yaxis.set_major_locator(ticker.MultipleLocator(step))
+        ax.set_ylabel('')
+
+
+def make_time_of_day_axes(fig: Figure):
+    ax = fig.gca()
+    ax.xaxis.set_major_formatter(ticker.FuncFormatter(format_time_of_day))
+    ax.xaxis.set_major_locator(ticker.MultipleLocator(3 * HOUR))
+    ax.set_xlim(0, DAY)
+    return ax
+
+
+class MinMaxTemplate:
+    """
+    Figure of plot_traffic_minmax and plot_rollup_minmax for fast rendering.
+    """
+
+    def __init__(self, fig: Figure):
+        self.fig = fig
+        self.ax = make_time_of_day_axes(fig)
+        self.line_max, = self.ax.plot([], [], linewidth=3, alpha=0.9, label='max')
+        self.line_mean, = self.ax.plot([], [], linewidth=4, alpha=0.9, label='mean')
+        self.line_min, = self.ax.plot([], [], linewidth=3, alpha=0.9, label='min')
+        self.line_median, = self.ax.plot([], [], linewidth=2, linestyle='--', label='median')
+        self.band = self.ax.fill_between([], [], [], alpha=0.3, label='p10-p90')
+        fig.legend()
+
+    def update(self, nonzero_intervals, durations_min, durations_mean, durations_max, route_name, bands=None) \
+            -> Figure:
+        nonzero_intervals = np.asarray(nonzero_intervals)
+        self.line_max.set_data(nonzero_intervals, durations_max)
+        self.line_mean.set_data(nonzero_intervals, durations_mean)
+        self.line_min.set_data(nonzero_intervals, durations_min)
+        band_intervals, durations_low, durations_median, durations_high = \
+            bands if bands is not None else ([], [], [], [])
+        self.line_median.set_data(band_intervals, durations_median)
+        # A filled area has no data to replace, it is drawn again with the color of the template
+        color = self.band.get_facecolor()
+        self.band.remove()
+        self.band = self.ax.fill_between(band_intervals, durations_low, durations_high, alpha=0.3, color=color)
+
+        self.ax.relim()
+        self.ax.autoscale_view(scalex=False)
+        set_duration_axis(self.ax, max(durations_max) if len(durations_max) > 0 else 0)
+        self.ax.set_title(route_name)
+        return self.fig
+
+
+class ByDayTemplate:
+    """
+    Figure of plot_traffic_by_day for fast rendering.
+    """
+
+    def __init__(self, fig: Figure):
+        self.fig = fig
+        self.ax = make_time_of_day_axes(fig)
+        self.lines = [self.ax.plot([], [], label=day)[0] for day in DAYS_OF_WEEK]
+        fig.legend()
+
+    def update(self, intervals_days, durations_days, route_name) -> Figure:
+        for line, intervals, durations in zip(self.lines, intervals_days, durations_days):
+            line.set_data(intervals, durations)
+        self.ax.relim()
+        self.ax.autoscale_view(scalex=False)
+        set_duration_axis(self.ax, max((max(durations) for durations in durations_days if len(durations) > 0),
+                                       default=0))
+        self.ax.set_title(route_name)
+        return self.fig
+
+
+def figure_png(fig: Figure, colors=None) -> bytes:
+    """
+    PNG of the figure, with a palette of the given number of colors if given.
+    """
+    with io.BytesIO() as buf:
+        if colors is None:
+            fig.savefig(buf, format='png')
+        else:
+            fig.canvas.draw()
+            image = Image.fromarray(np.asarray(fig.canvas.buffer_rgba())[..., :3])
+            image.quantize(colors, method=Image.Quantize.FASTOCTREE).save(buf, format='png')
+        return buf.getvalue()
+
+
 def prettify_y(durations, some_days):
     if not some_days:
         return tuple(map(datetime.datetime.utcfromtimestamp, durations))
@@ -95,57 +308,112 @@ def prettify_y(durations, some_days):
         return [ts / HOUR for ts in durations]
 
 
+@dataclass
+class IntervalStats:
+    """
+    Statistics of durations per non-empty interval, ordered by interval key: time of day interval,
+    or day of week * intervals per day + time of day interval.
+    """
+    keys: np.ndarray
+    num_samples: np.ndarray
+    mean: np.ndarray
+    min: np.ndarray
+    max: np.ndarray
+
+
+def interval_keys(timestamps, timedelta, by_day=False) -> np.ndarray:
+    """
+    Interval of the day of every timestamp, with integer arithmetic on seconds. Timestamps are taken as UTC,
+    shift them to the local time first.
+    """
+    timestamps = np.asarray(timestamps).astype(np.int64)
+    keys = timestamps % DAY // timedelta
+    if by_day:
+        keys += ((timestamps // DAY + EPOCH_WEEKDAY) % 7) * math.ceil(DAY / timedelta)
+    return keys
+
+
+def group_intervals(keys) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Sorts samples by interval, keeping their order within an interval.
+    Returns the order, keys of non-empty intervals and the start of every interval in the sorted samples.
+    """
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.diff(sorted_keys, prepend=-1))
+    return order, sorted_keys[starts], starts
+
+
+def interval_stats(timestamps, durations, timedelta, weights=None, by_day=False) -> IntervalStats:
+    """
+    Count, min, max and mean of durations per interval. With weights the mean is weighted,
+    samples with zero weights only count for min and max.
+    """
+    order, keys, starts = group_intervals(interval_keys(timestamps, timedelta, by_day))
+    durations = np.asarray(durations)[order]
+    if len(keys) == 0:
+        return IntervalStats(keys, *(np.empty(0) for _ in range(4)))
+    weights = np.ones(len(durations)) if weights is None else np.asarray(weights)[order]
+    weighted_sums = np.add.reduceat(durations * weights.astype(np.float64), starts)
+    return IntervalStats(keys=keys,
+                         num_samples=np.diff(np.append(starts, len(durations))),
+                         mean=weighted_sums / np.add.reduceat(weights, starts),
+                         min=np.minimum.reduceat(durations, starts),
+                         max=np.maximum.reduceat(durations, starts))
+
+
 def sort_intervals(timestamps, durations, timedelta):
-    dates = np.array(list(map(datetime.datetime.fromtimestamp, timestamps)))
-    durations = np.array(durations)
-    durations_days_intervals = []
-    nonzero_intervals = []
-
-    dates_intervals_indices = argsort_time(dates, timedelta)
-    nonzero_intervals.append([i for i in range(len(dates_intervals_indices))
-                              if len(dates_intervals_indices[i]) > 0])
-
-    durations_days_intervals.append([durations[dates_intervals_idx]
-                                     for dates_intervals_idx in dates_intervals_indices
-                                     if len(durations[dates_intervals_idx]) > 0])
+    """
+    Durations of every non-empty time of day interval and the intervals' numbers.
+    """
+    order, keys, starts = group_intervals(interval_keys(timestamps, timedelta))
     return (
-        durations_days_intervals,
-        nonzero_intervals
+        [np.split(np.asarray(durations)[order], starts[1:]) if len(keys) > 0 else []],
+        [keys.tolist()]
     )
 
 
 def sort_days_intervals(timestamps, durations, timedelta):
-    dates = np.array(list(map(datetime.datetime.fromtimestamp, timestamps)))
-    durations = np.array(durations)
-    dates_days_indices = argsort_days(dates)
-    durations_days_intervals = []
-    nonzero_intervals = []
-    for dates_day_idx in dates_days_indices:
-        dates_day = dates[dates_day_idx]
-        durations_day = durations[dates_day_idx]
-        dates_intervals_indices = argsort_time(dates_day, timedelta)
-        nonzero_intervals.append([i for i in range(len(dates_intervals_indices))
-                                  if len(dates_intervals_indices[i]) > 0])
-
-        durations_days_intervals.append([durations_day[dates_intervals_idx]
-                                         for dates_intervals_idx in dates_intervals_indices
-                                         if len(durations_day[dates_intervals_idx]) > 0])
+    """
+    Same as sort_intervals for every day of week.
+    """
+    num_intervals = math.ceil(DAY / timedelta)
+    order, keys, starts = group_intervals(interval_keys(timestamps, timedelta, by_day=True))
+    durations_intervals = np.split(np.asarray(durations)[order], starts[1:]) if len(keys) > 0 else []
+    days, intervals = np.divmod(keys, num_intervals)
     return (
-        durations_days_intervals,
-        nonzero_intervals
+        [[durations_intervals[i] for i in np.flatnonzero(days == day)] for day in range(7)],
+        [intervals[days == day].tolist() for day in range(7)]
     )
 
 
-def argsort_days(dates):
-    return [[j for j in range(len(dates)) if dates[j].weekday() % 7 == i] for i in range(7)]
-
-
-def date_in_interval(time_interval, i, date):
-    return time_interval * i <= date.hour * HOUR + date.minute * MINUTE + date.second < time_interval * (i + 1)
-
-
-def argsort_time(dates, time_interval):
-    num_intervals = math.ceil(DAY / time_interval)
-    return [[j for j in range(len(dates))
-             if date_in_interval(time_interval, i, dates[j])]
-            for i in range(num_intervals)]
+class ComparisonTemplate:
+    """
+    Figure of plot_rollups_comparison, lines are added when more routes are compared than before.
+    """
+
+    def __init__(self, fig: Figure):
+        self.fig = fig
+        self.ax = make_time_of_day_axes(fig)
+        self.lines = []
+        self.legend = None
+
+    def update(self, intervals_routes, durations_routes, route_names) -> Figure:
+        while len(self.lines) < len(route_names):
+            self.lines.append(self.ax.plot([], [], linewidth=3, alpha=0.9)[0])
+        for i, line in enumerate(self.lines):
+            if i < len(route_names):
+                line.set_data(intervals_routes[i], durations_routes[i])
+                line.set_label(route_names[i])
+            else:
+                line.set_data([], [])
+                line.set_label('_unused')
+        self.ax.relim()
+        self.ax.autoscale_view(scalex=False)
+        set_duration_axis(self.ax, max((max(durations) for durations in durations_routes if len(durations) > 0),
+                                       default=0))
+        self.ax.set_title(' / '.join(route_names))
+        if self.legend is not None:
+            self.legend.remove()
+        self.legend = self.fig.legend()
+        return self.fig
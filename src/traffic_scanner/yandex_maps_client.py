@@ -1,25 +1,33 @@
+import json
 import logging
+import os
 import random
 import string
 import time
 import urllib
 import re
+import threading
 
 import numpy as np
 import requests as r
+from requests.adapters import HTTPAdapter
+
+from traffic_scanner.rate_limiter import TokenBucket, AdaptiveTokenBucket
 
 logger = logging.getLogger('traffic_scanner/yandex_maps_client.py')
-REQUESTS_DELAY = 0.1
+REQUESTS_PER_SECOND = 10
+MIN_REQUESTS_PER_SECOND = 0.2
+MAX_REQUESTS_PER_SECOND = 50
 
 DAY = 60 * 60 * 24
 
 LOCATION_TITLE_REGEX = re.compile(r'<meta property=\"og:title\" content=\"(.*?)\">')
 
 
-def sleep_before_run(func):
-    def closure(*args, **kwargs):
-        time.sleep(REQUESTS_DELAY)
-        return func(*args, **kwargs)
+def rate_limited(func):
+    def closure(client, *args, **kwargs):
+        client.rate_limiter.acquire()
+        return func(client, *args, **kwargs)
 
     return closure
 
@@ -33,8 +41,9 @@ def make_s(source):
      }(t)) : ""
      """
     n = np.int32(5381)
-    for r in range(len(source)):
-        n = np.int32(33) * np.int32(n) ^ np.int32(ord(source[r]))
+    with np.errstate(over='ignore'):  # numpy error state is per thread, so scan workers need it too
+        for r in range(len(source)):
+            n = np.int32(33) * np.int32(n) ^ np.int32(ord(source[r]))
     return np.uint32(n)
 
 
@@ -47,12 +56,28 @@ class YandexMapsClient:
         'Accept-Language': 'en-us'
     }
 
-    def __init__(self, session_timeout=DAY):
+    def __init__(self, session_timeout=DAY, rate_limiter=None, pool_size=1, state_path=None, endpoint=ENDPOINT):
+        self.endpoint = endpoint
         self.session_timeout = session_timeout
-        self.cookies = None
+        self.rate_limiter: TokenBucket = rate_limiter or AdaptiveTokenBucket(REQUESTS_PER_SECOND,
+                                                                             min_rate=MIN_REQUESTS_PER_SECOND,
+                                                                             max_rate=MAX_REQUESTS_PER_SECOND)
+        self.session_lock = threading.RLock()
+        # Keep-alive connections are reused across requests, one per concurrent scan worker
+        self.http = r.Session()
+        self.http.headers.update(self.HEADERS)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        self.state_path = state_path
         self.csrf_token = None
         self.session_id = None
         self.t_session_start = -1
+        self.load_state()
+
+    @property
+    def cookies(self):
+        return self.http.cookies
 
     @staticmethod
     def generate_random_session_id():
@@ -60,36 +85,92 @@ class YandexMapsClient:
         suffix = ''.join(random.choices(string.digits, k=6))
         return '{}_{}'.format(prefix, suffix)
 
-    @sleep_before_run
+    def load_state(self):
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except ValueError:
+            logger.warning(f'Ignoring corrupted session state {self.state_path}')
+            return
+        if time.time() - state['t_session_start'] > self.session_timeout:
+            logger.info('Saved session has expired.')
+            return
+        for cookie in state['cookies']:
+            self.http.cookies.set(**cookie)
+        self.csrf_token = state['csrf_token']
+        self.session_id = state['session_id']
+        self.t_session_start = state['t_session_start']
+        logger.info(f'Restored session {self.session_id}')
+
+    def save_state(self):
+        if self.state_path is None:
+            return
+        with self.session_lock:
+            state = {
+                'cookies': [{'name': cookie.name, 'value': cookie.value, 'domain': cookie.domain, 'path': cookie.path}
+                            for cookie in self.http.cookies],
+                'csrf_token': self.csrf_token,
+                'session_id': self.session_id,
+                't_session_start': self.t_session_start,
+            }
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_path)
+
+    def session_expired(self):
+        return time.time() - self.t_session_start > self.session_timeout
+
     def update_session(self, force=False):
-        if force or time.time() - self.t_session_start > self.session_timeout:
-            resp = r.get(self.ENDPOINT, headers=self.HEADERS)
-            resp.raise_for_status()
-            self.cookies = resp.cookies
-            self.renew_csrf_token()
-            self.session_id = self.generate_random_session_id()
-            self.t_session_start = time.time()
-
-    @sleep_before_run
+        if not (force or self.session_expired()):
+            return
+        with self.session_lock:
+            # Another worker could have renewed the session while we were waiting for the lock
+            if force or self.session_expired():
+                self._start_session()
+                self.save_state()
+
+    @rate_limited
+    def _start_session(self):
+        self.http.cookies.clear()
+        resp = self.http.get(self.endpoint)
+        resp.raise_for_status()
+        self.csrf_token = self._fetch_csrf_token()
+        self.session_id = self.generate_random_session_id()
+        self.t_session_start = time.time()
+
+    @rate_limited
+    def _fetch_csrf_token(self):
+        resp = self.http.get(self.endpoint + 'api/router/buildRoute/')
+        resp.raise_for_status()
+        try:
+            return resp.json()['csrfToken']
+        except (ValueError, KeyError) as e:
+            logger.error(f'Invalid response: {resp.text}')
+            raise e
+
     def renew_csrf_token(self, csrf_token=None):
-        if csrf_token is None:
-            resp = r.get(self.ENDPOINT + 'api/router/buildRoute/', headers=self.HEADERS, cookies=self.cookies)
-            resp.raise_for_status()
-            self.cookies.update(resp.cookies)
-            try:
-                csrf_token = resp.json()['csrfToken']
-            except ValueError or IndexError as e:
-                logger.error(f'Invalid response: {resp.text}')
-                raise e
-
-        self.csrf_token = csrf_token
-
-    @sleep_before_run
+        with self.session_lock:
+            self.csrf_token = csrf_token or self._fetch_csrf_token()
+            self.save_state()
+
+    @staticmethod
+    def sign_params(params):
+        params = {key: value for key, value in params.items() if key != 's'}
+        params['s'] = make_s(urllib.parse.urlencode(params))
+        return params
+
+    @rate_limited
     def make_api_request(self, url, params, retry=True):
         self.update_session()
-        resp = r.get(self.ENDPOINT + url, params=params,
-                     headers=self.HEADERS, cookies=self.cookies)
-        self.cookies.update(resp.cookies)
+        resp = self.http.get(self.endpoint + url, params=params)
+        if resp.status_code == 429:
+            logger.warning('Upstream is throttling: HTTP 429')
+            self.rate_limiter.on_throttled()
+        elif resp.status_code >= 500:
+            self.rate_limiter.on_error()
         resp.raise_for_status()
         try:
             resp_json = resp.json()
@@ -99,17 +180,25 @@ class YandexMapsClient:
 
         resp_keys = resp_json.keys()
         if 'data' in resp_keys:
+            self.rate_limiter.on_success()
             return resp_json
         if retry is False:
+            if 'csrfToken' in resp_keys:
+                # The token was rejected again right after renewing it
+                self.rate_limiter.on_throttled()
             raise ValueError(resp_json)
 
         if 'csrfToken' in resp_keys:
             self.renew_csrf_token(resp_json['csrfToken'])
+            if 'csrfToken' in params:
+                params = self.sign_params(dict(params, csrfToken=self.csrf_token))
         if 'error' in resp_keys:
             logger.warning('error in api response: ' + str(resp))
+            self.rate_limiter.on_error()
         return self.make_api_request(url, params, retry=False)
 
     def build_route(self, start_coords, end_coords):
+        self.update_session()
         coords_str = f'{start_coords[0]},{start_coords[1]}~{end_coords[0]},{end_coords[1]}'
         params = {
             'activeComparisonMode': 'auto',
@@ -124,12 +213,10 @@ class YandexMapsClient:
             'sessionId': self.session_id,
             'type': 'auto',
         }
-        params_string = urllib.parse.urlencode(params)
-        params['s'] = make_s(params_string)
         logger.info(f'Building route for coordinates: {coords_str}')
-        return self.make_api_request('api/router/buildRoute/', params=params)
+        return self.make_api_request('api/router/buildRoute/', params=self.sign_params(params))
 
-    # @sleep_before_run
+    # @rate_limited
     # def get_location_title(self, coords):
     #     coords_str = f'{coords[1]},{coords[0]}'
     #     logger.info(f'Getting title for location at coordinates: {coords_str}')
@@ -138,7 +225,7 @@ class YandexMapsClient:
     #         'text': coords_str,  # User verbose format
     #         'z': '1'
     #     }
-    #     resp = r.get(self.ENDPOINT, params=params, headers=self.HEADERS, cookies=self.cookies)
+    #     resp = self.http.get(self.endpoint, params=params)
     #     resp.raise_for_status()
     #     regex_matches = LOCATION_TITLE_REGEX.search(resp.text)
     #     if regex_matches is None:
@@ -0,0 +1,190 @@
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from traffic_scanner.rate_limiter import TokenBucket
+
+logger = logging.getLogger('traffic_scanner/yandex_maps_stub.py')
+
+DAY = 24 * 60 * 60
+
+BUILD_ROUTE_PATH = '/maps/api/router/buildRoute/'
+
+
+def synthetic_duration(rll, timestamp):
+    """
+    Deterministic duration of a route: a base depending on the coordinates plus two daily rush hours.
+    """
+    base = 600 + zlib.crc32(rll.encode()) % 3000
+    time_of_day = timestamp % DAY / DAY
+    rush = math.exp(-((time_of_day - 0.33) / 0.05) ** 2) + math.exp(-((time_of_day - 0.75) / 0.06) ** 2)
+    return int(base * (1 + rush))
+
+
+class ResponseRecorder:
+    """
+    Records successful buildRoute responses of a real YandexMapsClient, so they can be replayed by YandexMapsStub.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.responses = {}
+
+    def attach(self, yandex_maps_client):
+        yandex_maps_client.http.hooks['response'].append(self.hook)
+
+    def hook(self, resp, *args, **kwargs):
+        url = urlparse(resp.url)
+        if not url.path.endswith('api/router/buildRoute/'):
+            return
+        rll = parse_qs(url.query).get('rll', [None])[0]
+        try:
+            resp_json = resp.json()
+        except ValueError:
+            return
+        if rll is not None and 'data' in resp_json:
+            with self.lock:
+                self.responses[rll] = resp_json
+
+    def save(self):
+        with self.lock:
+            with open(self.path, 'w') as f:
+                json.dump(self.responses, f)
+        logger.info(f'Saved {len(self.responses)} responses to {self.path}')
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return json.load(f)
+
+
+class YandexMapsStub:
+    """
+    Local stand-in for the part of yandex maps used by YandexMapsClient.
+
+    `latency` seconds are spent on every buildRoute request, `error_rate` of them fail with an error payload
+    or HTTP 500, and requests above `max_rps` are throttled with HTTP 429. The csrf token is rotated every
+    `csrf_ttl` seconds. Routes found in `recording` (see ResponseRecorder) are replayed, others are synthetic.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, max_rps=None, csrf_ttl=None,
+                 recording=None, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle = TokenBucket(max_rps, capacity=max_rps) if max_rps is not None else None
+        self.csrf_ttl = csrf_ttl
+        self.recording = recording or {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.csrf_token = None
+        self.t_csrf_token = -1
+        self.stats = {'sessions': 0, 'routes': 0, 'csrf': 0, 'errors': 0, 'throttled': 0}
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/maps/'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f'Serving yandex maps stub at {self.endpoint}')
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def current_csrf_token(self):
+        with self.lock:
+            expired = self.csrf_ttl is not None and time.time() - self.t_csrf_token > self.csrf_ttl
+            if self.csrf_token is None or expired:
+                self.csrf_token = uuid.uuid4().hex
+                self.t_csrf_token = time.time()
+            return self.csrf_token
+
+    def _count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def build_route(self, params):
+        """
+        Returns HTTP status and json payload of a buildRoute request.
+        """
+        if self.throttle is not None and not self.throttle.try_acquire():
+            self._count('throttled')
+            return 429, {'error': {'code': 429, 'message': 'Too many requests'}}
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.lock:
+            failed = self.random.random() < self.error_rate
+            server_error = self.random.random() < 0.5
+        if failed:
+            self._count('errors')
+            if server_error:
+                return 500, {'error': {'code': 500, 'message': 'Internal error'}}
+            return 200, {'error': {'code': 'ROUTER_ERROR', 'message': 'Something went wrong'}}
+
+        csrf_token = self.current_csrf_token()
+        if params.get('csrfToken') != csrf_token:
+            self._count('csrf')
+            return 200, {'csrfToken': csrf_token}
+
+        self._count('routes')
+        rll = params.get('rll', '')
+        if rll in self.recording:
+            return 200, self.recording[rll]
+        duration = synthetic_duration(rll, int(time.time()))
+        return 200, {'data': {'routes': [{'duration': duration, 'durationInTraffic': duration}]}}
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _reply(self, status, body, content_type='application/json', cookie=None):
+                body = body.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                if cookie is not None:
+                    self.send_header('Set-Cookie', cookie)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == BUILD_ROUTE_PATH:
+                    params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                    status, payload = stub.build_route(params)
+                    self._reply(status, json.dumps(payload))
+                elif url.path == '/maps/':
+                    stub._count('sessions')
+                    self._reply(200, '<html></html>', content_type='text/html',
+                                cookie=f'yandexuid={uuid.uuid4().int % 10 ** 19}; Path=/')
+                else:
+                    self._reply(404, json.dumps({'error': 'Not found'}))
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler